@@ -0,0 +1,199 @@
+#!/usr/bin/env python3.6
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# What the heck is this file? :D
+# word_test.py checks that word does the right thing, this file checks how FAST it does it
+# it starts a pretend datamuse (mock_datamuse.py), points word at it, and times:
+#   parse      how many queries a second parse() can read
+#   fetch      how long go_fetch() takes, with and without the cache, and how many
+#              queries a second it manages when more of them run at once
+#   render     how long print_response() takes to print 20, 100 and 1000 words
+#   rhymes     rhymes (and near rhymes) from the pronouncing dictionary, next to the same
+#              queries over http
+#   cli        how long "word" takes from the commandline, start to finish
+# and saves the numbers in a JSON file, so you can compare two versions of word:
+#
+#   python bench/bench.py --out before.json
+#   (change something)
+#   python bench/bench.py --out after.json
+
+import os, sys, io, json, time, shlex, platform, tempfile, threading, subprocess, argparse
+from contextlib import redirect_stdout
+from statistics import median
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+
+from mock_datamuse import make_mock
+
+def timings(seconds):
+  """ A few numbers that sum up a list of timings (in milliseconds). """
+  seconds = sorted(seconds)
+  return {"runs": len(seconds),
+          "median_ms": round(median(seconds) * 1000, 3),
+          "min_ms": round(seconds[0] * 1000, 3),
+          "p90_ms": round(seconds[int(len(seconds) * 0.9) - 1 if len(seconds) > 1 else 0] * 1000, 3)}
+
+def timed(function, *args):
+  """ How many seconds function(*args) takes. """
+  start = time.perf_counter()
+  function(*args)
+  return time.perf_counter() - start
+
+def bench_parse(word, corpus, rounds):
+  """ parse() throughput over the whole corpus. """
+  def parse_all():
+    for args in corpus:
+      word.query_type = None
+      word.parse(list(args), {})
+  parse_all()
+  seconds = [timed(parse_all) for _ in range(rounds)]
+  best = min(seconds)
+  return {"queries": len(corpus), "rounds": rounds,
+          "queries_per_second": round(len(corpus) / best),
+          "us_per_query": round(best / len(corpus) * 1e6, 2)}
+
+def bench_fetch(word, runs, latency):
+  """ go_fetch() latency (cold and cached) and throughput with more queries at once. """
+  def fetch(text):
+    word.query_type = None
+    return word.go_fetch(word.parse(text.split(), {}))
+  results = {}
+  # every query is different, so nothing comes from the cache or shares a request
+  word.use_cache = False
+  cold = [timed(fetch, f"rhymes with cold{i}") for i in range(runs)]
+  results["cold"] = timings(cold)
+  results["cold"]["overhead_ms"] = round(results["cold"]["median_ms"] - latency * 1000, 3)
+  results["definition"] = timings([timed(fetch, f"cold{i} defined") for i in range(runs)])
+  word.use_cache = True
+  fetch("rhymes with warm")
+  results["cached"] = timings([timed(fetch, "rhymes with warm") for _ in range(runs)])
+  word.use_cache = False
+  # the same number of queries, with more and more of them running at once
+  scaling = {}
+  for workers in (1, 2, 4, 8, 16, 32):
+    count = max(workers * 4, 16)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      start = time.perf_counter()
+      list(pool.map(fetch, [f"rhymes with many{workers}x{i}" for i in range(count)]))
+      seconds = time.perf_counter() - start
+    scaling[str(workers)] = {"queries": count, "queries_per_second": round(count / seconds, 1)}
+  results["concurrency"] = scaling
+  word.use_cache = True
+  return results
+
+def bench_render(word, runs):
+  """ print_response() for answers of 20, 100 and 1000 words, in the grid and as tsv. """
+  results = {}
+  word.use_cache = False
+  for maximum in (20, 100, 1000):
+    word.query_type = None
+    responses = word.go_fetch(word.parse(f"rhymes with render max {maximum}".split(), {}))
+    for output_format in ("grid", "tsv"):
+      word.output_format = output_format
+      def render():
+        with redirect_stdout(io.StringIO()):
+          word.print_response(responses)
+      render()
+      results[f"{output_format}_{maximum}"] = timings([timed(render) for _ in range(runs)])
+  word.output_format = "grid"
+  word.use_cache = True
+  return results
+
+def bench_rhymes(word, runs):
+  """ Rhymes from the local rhyme index (straight, and through go_fetch) against the pretend api. """
+  from word_lexicon import Lexicon, LEXICON_FILE
+  # the real dictionary if you have it, or the little sample that comes with the benchmark
+  path = LEXICON_FILE if os.path.isfile(LEXICON_FILE) else os.path.join(HERE, "cmudict.sample")
+  start = time.perf_counter()
+  lexicon = Lexicon.from_file(path)
+  results = {"lexicon": os.path.basename(path), "words": len(lexicon.sounds),
+             "load_ms": round((time.perf_counter() - start) * 1000, 3)}
+  # every word in the sample, or a spread of words from the real thing
+  words = sorted(lexicon.sounds)[::max(1, len(lexicon.sounds) // 200)]
+  for param in ("rel_rhy", "rel_nry"):
+    # the first time sorts each bucket, every time after that is one lookup
+    first = timed(lambda: [lexicon.answer({param: w, "max": 100}) for w in words])
+    best = min(timed(lambda: [lexicon.answer({param: w, "max": 100}) for w in words]) for _ in range(runs))
+    results[param] = {"queries": len(words), "first_us_per_query": round(first / len(words) * 1e6, 2),
+                      "us_per_query": round(best / len(words) * 1e6, 2),
+                      "queries_per_second": round(len(words) / best)}
+  # the whole trip, parse() to answer, locally and over http (with no cache, so every one asks)
+  def fetch(text):
+    word.query_type = None
+    return word.go_fetch(word.parse(text.split(), {}))
+  texts = [f"rhymes with {w}" for w in words][:runs]
+  word.use_cache = False
+  word.backends[:] = [lexicon]
+  word.use_local = True
+  results["local"] = timings([timed(fetch, text) for text in texts])
+  word.use_local = False
+  results["http"] = timings([timed(fetch, text) for text in texts])
+  word.backends[:] = []
+  word.use_cache = True
+  results["speedup"] = round(results["http"]["median_ms"] / (results["local"]["median_ms"] or 0.001), 1)
+  return results
+
+def bench_cli(runs, environment):
+  """ "word" from the commandline: just starting up, and a whole query. """
+  script = os.path.join(ROOT, "word.py")
+  def run(*args):
+    subprocess.run([sys.executable, script, *args], env=environment, check=False,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return {"help": timings([timed(run, "--help") for _ in range(runs)]),
+          "query": timings([timed(run, "--no-cache", "rhymes", "with", "norse") for _ in range(runs)])}
+
+def git_version():
+  """ Which commit we're benchmarking (or None, if this isn't a git checkout). """
+  try:
+    return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip() or None
+  except OSError:
+    return None
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark word against a pretend datamuse.")
+  parser.add_argument("--latency", type=float, default=0.05, help="seconds the pretend api waits (default 0.05)")
+  parser.add_argument("--runs", type=int, default=20, help="how many times to time each thing (default 20)")
+  parser.add_argument("--out", default=os.path.join(HERE, "results.json"), help="where to save the results")
+  options = parser.parse_args()
+
+  server = make_mock(options.latency)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  # point word at the pretend api before it's imported (it reads these when it starts)
+  # with no rate limit, and its cache somewhere that won't mix with your real one
+  scratch = tempfile.mkdtemp(prefix="word-bench-")
+  environment = dict(os.environ, WORD_DATAMUSE_URL=server.datamuse_url, WORD_OWLBOT_URL=server.owlbot_url,
+                     WORD_RATE_LIMITS="*=1000000", XDG_CACHE_HOME=scratch)
+  os.environ.update(environment)
+  import word
+  word.CACHE_FILE = os.path.join(scratch, "responses.sqlite3")
+
+  with open(os.path.join(HERE, "queries.txt"), encoding="utf-8") as f:
+    corpus = [shlex.split(line) for line in f if line.strip()]
+
+  results = {"meta": {"version": git_version(), "python": platform.python_version(),
+                      "platform": platform.platform(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                      "latency_ms": options.latency * 1000, "runs": options.runs}}
+  for name, bench in (("parse", lambda: bench_parse(word, corpus, options.runs)),
+                      ("fetch", lambda: bench_fetch(word, options.runs, options.latency)),
+                      ("render", lambda: bench_render(word, options.runs)),
+                      ("rhymes", lambda: bench_rhymes(word, options.runs)),
+                      ("cli", lambda: bench_cli(max(3, options.runs // 4), environment))):
+    print(f"{name}...", file=sys.stderr)
+    results[name] = bench()
+  results["meta"]["api_requests"] = server.requests
+  server.shutdown()
+
+  with open(options.out, "w") as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.write("\n")
+  print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3.6
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# What the heck is this file? :D
+# a pretend datamuse (and owlbot), for benchmarking word without the internet
+# it answers with the sample answers in recorded.json, after waiting a while
+# (like the real internet would), so we can see how word copes with slow answers
+#
+#   python bench/mock_datamuse.py --latency 0.05
+#
+# then point word at it with the WORD_DATAMUSE_URL and WORD_OWLBOT_URL it prints
+# (the paths have "datamuse" and "owlbot.info" in them, because that's how word tells
+#  the answers apart)
+
+import os, json, time, threading, argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+RECORDED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded.json")
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  # every request gets its own thread, so slow answers can overlap like they do on the internet
+  daemon_threads = True
+  # let lots of connections wait to be accepted (the default of 5 is for much quieter servers)
+  request_queue_size = 128
+
+def padded(sample, count):
+  """ count entries, made by repeating the sample (with numbers on the end after the first go). """
+  entries = []
+  for i in range(count):
+    entry = dict(sample[i % len(sample)])
+    if i >= len(sample):
+      entry["word"] = f"{entry['word']}{i // len(sample)}"
+      entry["score"] = max(1, entry["score"] - i)
+    entries.append(entry)
+  return entries
+
+def make_mock(latency=0.05, port=0):
+  """ A pretend api server on 127.0.0.1. Its requests attribute counts what it's been asked. """
+  with open(RECORDED, encoding="utf-8") as f:
+    recorded = json.load(f)
+
+  class MockApi(BaseHTTPRequestHandler):
+    def do_GET(self):
+      url = urlparse(self.path)
+      params = {key: values[0] for key, values in parse_qs(url.query).items()}
+      with lock:
+        server.requests += 1
+      time.sleep(latency)
+      if url.path.startswith("/owlbot.info/api/v2/dictionary/"):
+        body = recorded["owlbot"]
+      elif url.path == "/api.datamuse.com/words":
+        if params.get("qe") == "sp":
+          body = recorded["datamuse"]["define"]
+        elif any(param.startswith("rel_") for param in params):
+          body = padded(recorded["datamuse"]["rel_rhy"], int(params.get("max", 100)))
+        else:
+          body = padded(recorded["datamuse"]["ml"], int(params.get("max", 100)))
+      else:
+        self.send_response(404)
+        self.end_headers()
+        return
+      data = json.dumps(body).encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def log_message(self, format, *args):
+      pass
+
+  lock = threading.Lock()
+  server = ThreadingHTTPServer(("127.0.0.1", port), MockApi)
+  server.requests = 0
+  host, port = server.server_address
+  server.datamuse_url = f"http://{host}:{port}/api.datamuse.com/words"
+  server.owlbot_url = f"http://{host}:{port}/owlbot.info/api/v2/dictionary/"
+  return server
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="A pretend datamuse and owlbot for benchmarks.")
+  parser.add_argument("--port", type=int, default=8700)
+  parser.add_argument("--latency", type=float, default=0.05, help="seconds to wait before answering")
+  options = parser.parse_args()
+  server = make_mock(options.latency, options.port)
+  print(f"export WORD_DATAMUSE_URL={server.datamuse_url}")
+  print(f"export WORD_OWLBOT_URL={server.owlbot_url}")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
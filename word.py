@@ -23,21 +23,46 @@
 
 # HOW TO READ THIS FILE
 # like many programs, it starts executing from near the bottom
-# skip to line 684-ish if you want to see what code runs first
+# skip to the line that says if __name__ == "__main__": if you want to see what code runs first
+# (and then to def main(args), just above it)
 # from here down to there are a bunch of variables and functions
 
 # get code from other libraries that we'll need
-import sys, re, requests
-from subprocess import call
-from colorama import init as colorama_init
+import time
+# when word started (for --timings -- everything above this line is python starting up)
+STARTED = time.perf_counter()
+import sys, re, os, io, json, codecs, threading, shlex
+from urllib.parse import urlencode, urlparse, parse_qs
+from collections import deque, OrderedDict
+from contextlib import redirect_stdout, redirect_stderr, contextmanager
+from functools import lru_cache
+from bisect import bisect_left
 # re is a library for regular expressions
+# os is a library for talking to the operating system (files, folders, settings)
+# time is a library for clocks (we use it to know how old a saved answer is)
+# threading lets several bits of the program run at the same time (we use its Lock)
+# io, json and codecs are for reading and writing text (json is explained in print_response())
+# urllib.parse is for building and taking apart web addresses
+# collections has some handy extra kinds of lists and dictionaries (deque and OrderedDict)
+# contextlib is for "word serve" (see the server section)
+# functools has tools for functions (lru_cache, see fuzzy_keyword())
+# shlex splits a line of text into words the same way your shell does (quotes and all)
 # sys(tem) is a library for interacting with the computer "outside" the program
-# requests is an HTTP library for talking to websites on the internet
-# subprocess is a library for running other programs (any programs, not just python)
-# colorama is a library for displaying ANSI escape codes correctly on Windows
 # notice that in some cases we import the entire library (import _libraryname_)
 # and in others we import only a function or two (from _libraryname_ import _function_)
-# in colorama we even rename the function (because init() is too vague, imo)
+
+# some libraries are slow to load, so we don't import them up here
+# instead, the functions that need them import them the first time they run
+# (python remembers libraries it has already loaded, so importing twice is free)
+# that way "word --help", or asking a running "word serve", never waits for them:
+# requests is an HTTP library for talking to websites on the internet (~100 milliseconds!)
+# sqlite3 is a tiny database that lives in a single file (more on that in the cache section)
+# concurrent.futures is an easier way to hand jobs to threads and collect the answers
+# subprocess is a library for running other programs (any programs, not just python)
+# colorama is a library for displaying ANSI escape codes correctly on Windows
+# http.server and http.client are for "word serve" (see the server section)
+# try this to see how long each library takes to load:
+#   python -X importtime word.py --help
 
 #### CONSTANTS
 # Here we declare global contants that will be used throughout the program
@@ -54,6 +79,28 @@ Commandline interface to Datamuse and Owlbot APIs
 
     -v[vv]                           verbose modes.
     -h, --help                       Print this help.
+    -i, --interactive                Keep asking for queries (with history and tab completion).
+    --no-cache                       Don't read or save answers in the local cache.
+    --refresh                        Ask the APIs again, and save the new answers.
+    --local                          Answer from the pronouncing dictionary when it can
+                                     (rhymes, sounds like, spelled like 'cens?r').
+    --offline                        Only answer from the pronouncing dictionary.
+    --prefetch                       After a definition or pronunciation, fetch the other
+                                     one (and synonyms and rhymes) into the cache.
+    --format <format>                grid (the default), or for other programs:
+                                     json (exactly what the API sent), jsonl, tsv, plain
+    --batch [file]                   Read one query per line from file (or stdin)
+                                     and print the answers in the same order.
+    --jobs <number>                  How many batch queries to look up at once (default 8).
+    --timings [json]                 Say how long each step took (on stderr).
+    --profile [file.pstats]          Save a python profile of the whole run (word.pstats).
+    --metrics <file|statsd://host:port>
+                                     Save counters and timings for prometheus, or send
+                                     them to statsd (WORD_METRICS does the same).
+    serve [port]                     Keep word running in the background, so other
+                                     word commands start faster (default port 8642).
+    build-index [wordlist]           Compile a word list (or the pronouncing dictionary)
+                                     so spelled like patterns work without the internet.
 
 Primary modifier examples:
    meaning          "word meaning feeling tired"
@@ -64,11 +111,20 @@ Primary modifier examples:
    spelled like     "word spelled like 'cens?r'"
    defined          "word nostrum defined" 
    pronunciation    "word pronunciation of otolaryngology"
+   synonyms of      "word synonyms of happy"
+   opposite of      "word opposite of happy"
+   described by     "word described by gradual"
+   parts of         "word parts of a car"
 
 Secondary modifiers:
    max              "word like beautiful max 7"         (default is 20)
    about            "word meaning refuse about trash"   (max is 5 nouns)
                     "word meaning refuse about negotiation contracts"
+   with syllables   "word rhymes with norse with 2 syllables"   (or 1-3)
+   as a             "word synonyms of happy as an adjective"   (noun, verb, adverb)
+   frequency        "word sounds like tung frequency 10"   (uses per million words)
+   sorted by        "word rhymes with culminate sorted by frequency"
+                    (score, frequency, syllables, length, alphabet, blend)
 
 word tries to guess your intent. If it messes up, use quotes.
                     word meaning of life              == ml=of+life
@@ -101,7 +157,12 @@ GLOSS = { "ml": "have a meaning like",
           "rel_cns": "have the same consonants as",
           "lc": "often follow",
           "rc": "often come before",
-          "topics": "are about" }
+          "topics": "are about",
+          # these last few are for word_rank.py, not datamuse (see RANKING)
+          "syllables": "have this many syllables:",
+          "pos": "are used as a",
+          "frequency": "are used at least this many times in a million words:",
+          "sort": "are sorted by" }
 
 # in RESTful APIs, data is exchanged via http using a limited number of "verbs"
 # you are familiar with GET from sites like youtube:
@@ -110,45 +171,233 @@ GLOSS = { "ml": "have a meaning like",
 
 # GLOSS is a matching dictionary of parameters and what those parameters mean
 
+# Variables for the response cache
+# datamuse's answers don't change very often (it tells browsers to keep them for a day)
+# so we save every answer in a little database file and reuse it next time
+# XDG is a standard that says where programs should keep their files on linux
+# ($XDG_CACHE_HOME if the user set it, otherwise ~/.cache)
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                         os.path.join(os.path.expanduser("~"), ".cache"), "dusty-word")
+CACHE_FILE = os.path.join(CACHE_DIR, "responses.sqlite3")
+# how many seconds an answer stays fresh (default is one day, same as datamuse says)
+CACHE_TTL = int(os.environ.get("WORD_CACHE_TTL", 86400))
+# how many answers we keep before throwing out the ones used least recently
+CACHE_SIZE = int(os.environ.get("WORD_CACHE_SIZE", 5000))
+# how many of those we also keep in memory
+RECENT_SIZE = 500
+# reading an answer only writes down when it was used if the last time was longer ago than
+# this (in seconds) -- every write waits for the disk, and "used an hour ago" is plenty
+# for deciding which answers to throw out
+USED_RESOLUTION = 3600
+
+# where the apis are (WORD_DATAMUSE_URL and WORD_OWLBOT_URL point word at a stand-in
+# server instead, like the one in bench/ -- keep "datamuse" and "owlbot.info/.../dictionary/"
+# in them, because that's how print_response() tells the answers apart)
+DATAMUSE_URL = os.environ.get("WORD_DATAMUSE_URL") or "https://api.datamuse.com/words"
+OWLBOT_URL = os.environ.get("WORD_OWLBOT_URL") or "https://owlbot.info/api/v2/dictionary/"
+
+# how many seconds to wait for each api before giving up on it
+# (the bash version of word does the same thing with curl -m 15)
+FETCH_TIMEOUT = 15
+# and how long requests itself waits for each step of a request (in seconds)
+# (connecting, then reading -- a little over 3 seconds is a traditional connect timeout,
+#  because that's when computers usually retry a lost "hello" packet)
+HTTP_TIMEOUT = (3.05, FETCH_TIMEOUT)
+# how many open connections to keep around for each website
+HTTP_POOL_SIZE = 32
+
+# how many requests per second word may send to each website
+# datamuse allows 100,000 requests a day, so everybody sharing "word serve" has to take turns
+# set WORD_RATE_LIMITS to change them, like "api.datamuse.com=5,owlbot.info=1,*=10"
+# (* is every other website)
+def read_rates(text):
+  """ Read per-website budgets like "api.datamuse.com=5,*=10" (requests per second). """
+  rates = {"*": 10.0}
+  for part in text.split(","):
+    host, _, rate = part.partition("=")
+    try:
+      rates[host.strip().lower()] = float(rate)
+    # ignore anything we can't read, rather than refusing to start
+    except ValueError:
+      pass
+  return rates
+RATE_LIMITS = read_rates(os.environ.get("WORD_RATE_LIMITS", ""))
+# when a website says "slow down" (429) or "I'm broken" (5xx), try again this many times
+RETRIES = 3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# waiting longer each time: up to 0.25 seconds, then 0.5, then 1 (but never more than 4)
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 4
+# after this many failures in a row, stop asking a website for a while
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30
+
+# the ways word can print its answers (see --format)
+FORMATS = ["grid", "json", "jsonl", "tsv", "plain"]
+
+# how many bytes of an answer to read at a time when printing it
+CHUNK_SIZE = 4096
+
+# how many queries --batch looks up at the same time (unless you say --jobs)
+BATCH_JOBS = 8
+
+# where "word serve" listens, and the file where it writes that down for everyone else
+SERVE_PORT = int(os.environ.get("WORD_PORT", 8642))
+SERVE_FILE = os.path.join(CACHE_DIR, "serve.port")
+
+# where --metrics sends its numbers when you don't say (see METRICS)
+# a file name for prometheus, or statsd://host:port
+METRICS_TARGET = os.environ.get("WORD_METRICS") or None
+STATSD_ADDRESS = ("127.0.0.1", 8125)
+
 #
 #### END CONSTANTS
 
 #### HELPER FUNCTIONS
 #
 
+# main() sets these from the commandline, but they need to exist before that
+# for programs that import word and call go_fetch() and print_response() directly
+query_type = None   # "DEF" or "PRO" for definitions and pronunciations (see parse())
+verbose = 0         # how many v's in -v, -vv, -vvv
+
+#### FUZZY KEYWORDS
+# Rhymes is hard to spell :3 (and pronounced, and pronunciation, and...)
+# we used to keep a list of every misspelling we'd seen, and check them one at a time
+# but people keep inventing new ones! so now we measure how *different* a word is
+# from each keyword -- the "edit distance" -- and forgive a typo or two
+#
+# edit distance is how many single-letter changes turn one word into another:
+#   rhymes -> ryhmes   swap h and y                = 1
+#   rhymes -> rhyms    delete e                    = 1
+#   pronounced -> pernounced   r->e, o->r          = 2
+#
+# comparing against every keyword would be slow, so we use a trick called
+# "symmetric delete" (from a spelling checker called SymSpell):
+# when the program starts, we delete one or two letters from each keyword in every
+# possible way, and write all of those down in a dictionary. to check a word, we do the
+# same to the word, and look each result up in that dictionary (which is instant)
+# if two words are within 2 edits of each other, they always share a "deleted" version
+
+# keywords we forgive typos in, and how many
+# most get one -- two typos away from a keyword is often a real word that means something
+# else (acronyms/antonyms, definitive/definition, trigger/triggered), so only the long ones
+# with no real words nearby get two
+# (some keywords aren't here at all, because one typo away is a real word: spelled/smelled,
+#  sounds/rounds, defined/refined, preceeds/proceeds)
+FUZZY_KEYWORDS = {"rhymes": 1, "pronounced": 2, "pronunciation": 2, "definition": 1,
+                  "associated": 1, "triggered": 1, "describes": 1, "described": 1,
+                  "synonyms": 2, "antonyms": 1, "opposite": 1}
+
+# misspellings we've seen that are too far away to guess (they count as exact matches)
+KNOWN_TYPOS = {
+  "rhymes": ["rhytms", "rhytems", "ryhms", "rhyms", "rhymnes", "ryhmes", "rhimes",
+             "rymes", "rhtyms", "ryhtyms", "rhyemes", "rhymmes", "rymhs", "rhmes",
+             "rhyhms", "rhytams", "ryphmes"],
+  "pronounced": ["pronounsed", "pronouced", "pronouned", "pronounciated", "prenounced",
+                 "prounouced", "pernounced", "purnounced", "pronoused", "pronuced",
+                 "pronunced", "pronnounced", "pronanced", "prononced", "prounounced",
+                 "prononsed", "prononuced"],
+  "pronunciation": ["pernunciation", "prononciation", "prounciation", "pronouciation",
+                    "pronounciation", "pronanciation", "prononcation", "pernounciation",
+                    "prononceation", "prenunciation", "prononseation", "prounouciation",
+                    "pronuniation", "pronunication", "prenounciation", "pronuntiation",
+                    "pronuncition", "pronociation", "prenunsiation", "pronounsation",
+                    "pronounceation", "pronounication", "pronauciation", "pronounciacion",
+                    "pronounsiation"],
+}
+
+def typos_allowed(keyword):
+  """ How many typos we forgive in a keyword. """
+  return FUZZY_KEYWORDS[keyword]
+
+def could_be_typo(word, keyword):
+  """ Does word start and end the way a typo of keyword would? """
+  # people almost never get the first letter wrong, and a real word with a different ending
+  # is usually the same word used differently (opposites, associates, triggers, rhymer)
+  # -- a typo can still swap the last two letters, like rhymse
+  return word[:1] == keyword[:1] and word[-1:] in keyword[-2:]
+
+def deletes(word, distance):
+  """ Every way of deleting up to distance letters from word (including none). """
+  # a set is like a list, but it ignores duplicates
+  # (that happens a lot: "pronounced" minus its first n or its second n, then minus the other
+  #  one, is "proouced" both ways)
+  found = {word}
+  edge = {word}
+  for _ in range(distance):
+    # word[:i] + word[i+1:] is word with the letter at i cut out
+    edge = {w[:i] + w[i+1:] for w in edge for i in range(len(w))}
+    found |= edge
+  return found
+
+def edit_distance(a, b):
+  """ How many letters to add, delete, change, or swap to turn a into b. """
+  # this is a classic "dynamic programming" algorithm
+  # row[j] is the distance between the first i letters of a and the first j letters of b
+  # we only ever need this row and the two before it, so we don't keep the whole table
+  previous, row = None, list(range(len(b) + 1))
+  for i in range(1, len(a) + 1):
+    before, previous, row = previous, row, [i] + [0] * len(b)
+    for j in range(1, len(b) + 1):
+      cost = 0 if a[i-1] == b[j-1] else 1
+      row[j] = min(previous[j] + 1,          # delete a letter from a
+                   row[j-1] + 1,             # add a letter to a
+                   previous[j-1] + cost)     # change a letter (or keep it, if they match)
+      # swap two letters next to each other (rhymes -> ryhmes)
+      if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+        row[j] = min(row[j], before[j-2] + 1)
+  return row[len(b)]
+
+def build_fuzzy_index(keywords):
+  """ Make the dictionary of deleted keywords: {deleted version: [keywords it came from]} """
+  index = {}
+  for keyword in keywords:
+    for deleted in deletes(keyword, typos_allowed(keyword)):
+      index.setdefault(deleted, []).append(keyword)
+  return index
+
+# build the index once, when the program starts (it takes about a millisecond)
+FUZZY_INDEX = build_fuzzy_index(FUZZY_KEYWORDS)
+# and turn the known typos around: {typo: keyword}
+TYPO_INDEX = {typo: keyword for keyword in KNOWN_TYPOS for typo in KNOWN_TYPOS[keyword]}
+
+# lru_cache remembers the answers for the last few thousand words it was asked about
+# (so a word we've seen before doesn't have to be worked out again)
+@lru_cache(maxsize=4096)
+def fuzzy_keyword(word):
+  """ Which keyword was word meant to be? Returns the keyword, or None. """
+  # (lower() converts word to lowercase)
+  word = word.lower()
+  if word in TYPO_INDEX: return TYPO_INDEX[word]
+  # look up every deleted version of word, to find keywords that might be close
+  # (lots of deleted versions lead to the same keyword, so collect them in a set first)
+  nearby = {keyword for deleted in deletes(word, 2) for keyword in FUZZY_INDEX.get(deleted, ())}
+  # then measure how close each one really is, and keep the closest
+  best, best_distance = None, 3
+  for keyword in sorted(nearby):
+    distance = edit_distance(word, keyword)
+    if distance <= typos_allowed(keyword) and distance < best_distance and could_be_typo(word, keyword):
+      best, best_distance = keyword, distance
+  return best
+
+def is_keyword(keyword):
+  """ Make a function that says whether a word is (a misspelling of) keyword. """
+  # this is a function that makes functions! the phrase tables below use them
+  # e.g. is_keyword("synonyms") gives a function f, where f("synomyns") == True
+  return lambda word: fuzzy_keyword(word) == keyword
+
 def is_rhymes(word):
   """ Rhymes is hard to spell :3 """
-  rhymes = ["rhymes", "rhytms", "rhytems", "ryhms", "rhyms", "rhymnes", "ryhmes", "rhimes", \
-            "rymes", "rhtyms", "ryhtyms", "rhyemes", "rhymmes", "rymhs", "rhmes", "rhyms", \
-            "rhyhms", "rhytams", "ryphmes"]
-  # go through the list of mispellings, one at a time
-  for r in rhymes:
-    # if we get a match, return true
-    # (lower() converts word to lowercase)
-    if word.lower() == r:
-      return True
-  # if nothing matches, return false
-  return False
+  return fuzzy_keyword(word) == "rhymes"
   # the point of returning true or false from a function is that
   # we can use this function later inside an "if" statement
 
 def is_pronounced(word):
   """ Pronounced is also hard to spell """
-  pronounced = ["pronounced", "pronunciation", "pronounsed", "pronouced", "pronouned", \
-                "pronounciated", "prenounced", "prounouced", "pernounced", "purnounced", \
-                "pronoused", "pronuced", "pronunced", "pronnounced", "pronanced", \
-                "prononced", "prounounced", "prononsed", "prononuced", "pernunciation", \
-                "prononciation", "prounciation", "pronouciation", "pronounciated", \
-                "pronounciation", "pronanciation", "prononcation", "pernounciation", \
-                "prononceation", "prenunciation", "prononseation", "prounouciation", \
-                "pronuniation", "pronunication", "prenounciation", "pronuntiation", \
-                "pronuncition", "pronociation", "prenunsiation", "pronounsation", \
-                "pronounceation", "pronounication", "pronauciation", "pronounciacion", \
-                "pronounsiation"]
-  for p in pronounced:
-    if word.lower() == p:
-      return True
-  return False
+  return fuzzy_keyword(word) in ("pronounced", "pronunciation")
+
+#### END FUZZY KEYWORDS
 
 def convert_num(num):
   """ Let's let the user enter alphabetical numbers to set the max results they want """
@@ -171,226 +420,1205 @@ def convert_num(num):
       # set user's max to be nothing, i.e. false
       return None
 
+#### GRAMMAR
+# parse() used to be a giant if/elif ladder: "is the first word 'comes' and the second
+# 'after'? no? is it 'follows'? no? is it..." -- for every single word you typed
+# now the phrases word understands are written down as a table (just data!)
+# and that table is turned into a "trie" once, when the program starts
+#
+# a trie is a tree of words. each phrase is a path from the top of the tree:
+#
+#   (top) --comes--> * --after--> * --WORD--> "lc"
+#                     \--before-> * --WORD--> "rc"
+#
+# to read the user's query, we walk down the tree one word at a time
+# so "comes" and "comes after" and "comes before" are all checked in a single walk
+# adding a new datamuse relation means adding a line to the table, not more code
+
+# WORD in a phrase means "any word" -- it's the word you want to look up
+# (None is fine for this: no real word is ever None)
+WORD = None
+
+# these will be useful later (a phrase like "meaning ..." keeps going until one of these)
+STOP_WORDS = ("and", "meaning", "means", "max", "about", "which", "that", "sorted")
+
+# the "actions" for the fancier phrases
+# each one gets the query, the list of words, and the place to start reading (i)
+# and returns the place where the next phrase starts
+
+def filter_makes_sense(action, words):
+  """ Is a filter phrase really a filter ("with 2 syllables"), or just words ("with many syllables")? """
+  # "with", "frequency" and "ranked by" are everyday words too ("radio frequency band",
+  # "songs ranked by critics"), so they only count with a number or an order we know
+  if action == "syllables": return read_range(words[0]) is not None
+  if action == "frequency":
+    try:
+      float(words[0])
+      return True
+    except ValueError:
+      return False
+  if action == "sort":
+    from word_rank import SORTS
+    return SORT_ALIASES.get(words[0], words[0]) in SORTS
+  # every other phrase is exactly what it says
+  return True
+
+def phrase_at(args, i):
+  """ The phrase starting at args[i] (like read_phrase()), or None -- skipping filters that aren't. """
+  found = read_phrase(PHRASE_TRIE, args, i)
+  if found and not filter_makes_sense(found[1], found[2]): return None
+  return found
+
+def starts_filter(args, i):
+  """ Does one of our filters (as a noun, with 2 syllables, frequency 10, sorted by...) start at args[i]? """
+  # "meaning happy as an adjective" should stop before "as", just like at a stop word
+  found = phrase_at(args, i)
+  return bool(found) and found[1] in (set_part_of_speech, "syllables", "frequency", "sort")
+
+def collect_meaning(query, args, i):
+  """ Example: meaning feeling tired -- take every word until a stop word. """
+  # b/c if we have "meaning deer and sounds like roe" we don't want
+  # query["ml"] == "deer and sounds like roe" -- it should be just "deer"
+  start = i
+  while i < len(args) and args[i] not in STOP_WORDS and not starts_filter(args, i):
+    i += 1
+  add_words(query, "ml", args[start:i])
+  return i
+# an example to make things clearer
+# say args == ["means", "egg", "beater", "and", "max", "35"]
+# "means" matches, so we start reading at i == 1 ("egg")
+# "egg" is NOT in STOP_WORDS, so i becomes 2 ("beater")
+# "beater" is NOT in STOP_WORDS, so i becomes 3 ("and")
+# "and" IS in STOP_WORDS, so we stop, and args[1:3] == ["egg", "beater"]
+# the query is now {ml: "egg beater"}, and the next phrase starts at "and"
+
+def collect_topics(query, args, i):
+  """ Example: about negotiation contracts -- the topic of our query. """
+  start = i
+  # Datamuse allows a max of five topic words, but plan() splits longer lists into
+  # several queries, so read as many as there are
+  while i < len(args) and args[i] not in STOP_WORDS and not starts_filter(args, i):
+    i += 1
+  add_words(query, "topics", args[start:i])
+  return i
+
+def set_maximum(query, args, i):
+  """ Example: max 7 -- how many results to return (max 1000). """
+  user_max = convert_num(args[i]) if i < len(args) else None
+  if user_max and int(user_max) <= 1000:
+    query["max"] = user_max
+  # skip the number (even if it was something silly like "max elephants")
+  return i + 1
+
+def set_part_of_speech(query, args, i):
+  """ Example: as a noun -- only words that can be used that way. """
+  # the phrase ends with the part of speech, so it's the word just before i
+  # (and "nouns" means the same as "noun")
+  query["pos"] = args[i - 1][:-1] if args[i - 1].endswith("s") else args[i - 1]
+  return i
+
+def skip(query, args, i):
+  """ Remove filler words if they weren't parsed out by a longer phrase. """
+  return i
+
+def add_words(query, param, words):
+  """ Add some words onto the end of a query parameter (like ml or topics). """
+  if not words: return
+  # join() glues a list of words together with spaces (once, instead of word by word)
+  # teranary operator prevents KeyError if param not already in query dictionary
+  query[param] = " ".join(([query[param]] if param in query else []) + list(words))
+
+# the parts of speech "as a noun" knows (see RANKING)
+POS_WORDS = ("noun", "nouns", "verb", "verbs", "adjective", "adjectives", "adverb", "adverbs")
+
+# Phrases for synonyms, etc
+# each line is (the phrase, what to do when we see it)
+# a word in the phrase can be:
+#   a string           -- exactly that word, e.g. "with"
+#   a tuple of strings -- any one of them, e.g. ("comes", "follows")
+#   a function         -- any word the function says yes to, e.g. is_rhymes
+#                         (is_keyword("...") is the same thing for any fuzzy keyword)
+#   WORD               -- any word at all (the one that gets looked up)
+# what to do is either the name of a datamuse parameter (which is set to the WORD)
+# or a function (see above) for phrases that take more than one word
+# when two phrases could both match, the longer one wins, and then the one higher up
+PHRASES = [
+  # Example: sounds like doe but spelled differently
+  ((("sounds", "sounding"), "like", WORD, ("but", "except"), "spelled", ("different", "differently")),
+                                                                      "rel_hom"),
+  # Example: sounding like tung
+  ((("sounds", "sounding"), "like", WORD),                             "sl"),
+  # Example: spelled like 'cens?r'
+  ((("spelled", "spelling"), "like", WORD),                            "sp"),
+  # Example: rhymes with culminate
+  ((is_rhymes, "with", WORD),                                          "rel_rhy"),
+  # Example: almost rhymes with culminate
+  (("almost", is_rhymes, "with", WORD),                                "rel_nry"),
+  # Example: comes after sea
+  (("comes", "after", WORD),                                           "lc"),
+  (("follows", WORD),                                                  "lc"),
+  (("comes", "before", WORD),                                          "rc"),
+  ((("preceeds", "precedes"), WORD),                                   "rc"),
+  # Example: describes paint
+  ((is_keyword("describes"), WORD),                                    "rel_jjb"),
+  # Example: described by gradual
+  ((is_keyword("described"), "by", WORD),                              "rel_jja"),
+  # Example: associated with feet
+  ((is_keyword("associated"), "with", WORD),                           "rel_trg"),
+  ((is_keyword("triggered"), "by", WORD),                              "rel_trg"),
+  # Example: synonyms of happy
+  ((is_keyword("synonyms"), ("of", "for"), WORD),                      "rel_syn"),
+  # Example: opposite of happy
+  ((is_keyword("antonyms"), ("of", "for"), WORD),                      "rel_ant"),
+  ((is_keyword("opposite"), ("of", "for"), WORD),                      "rel_ant"),
+  # Example: parts of a car
+  ((("parts", "part"), "of", ("a", "an", "the"), WORD),                "rel_com"),
+  ((("parts", "part"), "of", WORD),                                    "rel_com"),
+  # Example: meaning feeling tired
+  ((("means", "meaning", "like"),),                                    collect_meaning),
+  # Discover the topic of our query
+  (("about",),                                                         collect_topics),
+  # How many results to return (max 1000)
+  ((("max", "maximum", "only"),),                                      set_maximum),
+  # Filters and orders that word does itself (see RANKING)
+  # Example: with 2 syllables, with 1-3 syllables
+  (("with", WORD, ("syllable", "syllables")),                          "syllables"),
+  # Example: as a noun
+  (("as", ("a", "an"), POS_WORDS),                                     set_part_of_speech),
+  (("as", POS_WORDS),                                                  set_part_of_speech),
+  # Example: frequency 10 (used at least 10 times in every million words)
+  (("frequency", WORD),                                                "frequency"),
+  # Example: sorted by frequency
+  ((("sorted", "sort", "ranked"), "by", WORD),                         "sort"),
+  # Remove filler words if they weren't parsed out above
+  ((("that", "which", "and", "like", "is"),),                          skip),
+]
+
+# Phrases that ask for a definition or a pronunciation
+# these only count at the very start of the query, and the WORD is the word to look up
+# Example: nostrum defined
+# Example: pronunciation of otolaryngology
+LOOKUPS = [
+  (("define", WORD),                                                   "d"),
+  ((WORD, "defined"),                                                  "d"),
+  # (exactly "definition" -- after a word, a near miss like "definitive" is part of a meaning)
+  ((WORD, "definition"),                                               "d"),
+  ((WORD, "means", "what"),                                            "d"),
+  ((WORD, "is", "said", "how"),                                        "r"),
+  ((is_keyword("definition"), ("of", "for"), WORD),                    "d"),
+  ((is_pronounced, ("of", "for"), WORD),                               "r"),
+]
+
+def compile_phrases(phrases):
+  """ Turn a table of phrases into a trie (a tree of words) for read_phrase(). """
+  # each node in the tree is a dictionary:
+  #   "words": {word: next node}   -- for exact words
+  #   "tests": [(function, next node)] -- for words like is_rhymes
+  #   WORD: next node              -- for "any word"
+  #   "done": (rank, action)       -- if a phrase ends here
+  root = {"words": {}, "tests": []}
+  for rank, (phrase, action) in enumerate(phrases):
+    # a tuple like ("sounds", "sounding") means the phrase can go down several branches
+    # so we keep a list of all the nodes we're at, and move each of them along
+    nodes = [root]
+    for part in phrase:
+      following = []
+      for node in nodes:
+        if part is WORD:
+          following.append(node.setdefault(WORD, {"words": {}, "tests": []}))
+        elif callable(part):
+          for test, child in node["tests"]:
+            if test is part: break
+          else:
+            child = {"words": {}, "tests": []}
+            node["tests"].append((part, child))
+          following.append(child)
+        else:
+          # a single word is the same as a tuple with one word in it
+          for word in ((part,) if isinstance(part, str) else part):
+            following.append(node["words"].setdefault(word, {"words": {}, "tests": []}))
+      nodes = following
+    for node in nodes:
+      # if two phrases end in the same place, the one higher up the table wins
+      if "done" not in node: node["done"] = (rank, action)
+  return root
+
+def read_phrase(trie, args, i):
+  """ Find the longest phrase in the trie starting at args[i]. Returns (end, action, words) or None. """
+  best = None
+  # we walk down the tree with a list of (node, place in args, WORDs so far)
+  # (a word can follow more than one branch, e.g. "like" could be exact or "any word")
+  walking = [(trie, i, [])]
+  while walking:
+    node, j, captured = walking.pop()
+    if "done" in node:
+      rank, action = node["done"]
+      # longest first, then highest up the table (lowest rank)
+      if best is None or (j, -rank) > (best[0], -best[3]):
+        best = (j, action, captured, rank)
+    if j == len(args): continue
+    token = args[j]
+    if token in node["words"]:
+      walking.append((node["words"][token], j + 1, captured))
+    for test, child in node["tests"]:
+      if test(token): walking.append((child, j + 1, captured))
+    if WORD in node:
+      walking.append((node[WORD], j + 1, captured + [token]))
+  return best and best[:3]
+
+# compile the tables once, when the program starts
+PHRASE_TRIE = compile_phrases(PHRASES)
+LOOKUP_TRIE = compile_phrases(LOOKUPS)
+
+def lookup_kind(query):
+  """ "DEF" or "PRO" if the query is for a definition or pronunciation, otherwise None. """
+  if query.get("qe") != "sp": return None
+  return {"d": "DEF", "r": "PRO"}.get(query.get("md"))
+
 def parse(args, query):
   """ Parse the commandline args into a dictionary data structure. """
 
   global query_type
 
+  query = read_query(args, query)
+  # remember what kind of query this was, for go_fetch() and print_response()
+  # (only lookups change it, so batch mode and the server reset it between queries)
+  if lookup_kind(query): query_type = lookup_kind(query)
+  return query
+
+def read_query(args, query):
+  """ Like parse(), without touching query_type (so it's safe to use from many threads). """
+
   # Deal first with requests for definition or pronunciation
-  # 1. Make the code easier to read
-  first_word = args[0]
-  second_word = args[1] if len(args) > 1 else ""
-  third_word = args[2] if len(args) > 2 else ""
-  fourth_word = args[3] if len(args) > 3 else ""
-  # we use the teranary operator (this if ____ else that) to avoid an IndexError
-  # IndexError would be raised if we tried to access the second element (args[1])
-  # in a list which contained only one item (eg args == ["lonely"])
-  # the teranary operator (in most languages it looks like "____ ? this : that")
-  # returns "this" when the if is true and "that" when the if is false
-  # meaning, if len(args) is NOT greater than 1, second_word == ""
-
-  # 2. Check for keywords in the list of arguments
-  # Example: nostrum defined
-  # Example: pronunciation of otolaryngology
-  if first_word == "define":
-    # e.g. if the first word is "define" we'll add the second word to the query
-    query = {"sp": second_word, "md": "d", "max": "1", "qe": "sp", "ipa": "1"}
+  found = read_phrase(LOOKUP_TRIE, args, 0)
+  if found:
+    end, md, words = found
+    # e.g. "nostrum defined" gives md == "d" and words == ["nostrum"]
+    query = {"sp": words[0], "md": md, "max": "1", "qe": "sp", "ipa": "1"}
     # the query is a dictionary of GET parameters for the http request, eg
-    # https://api.datamuse.com/words?max=1&sp=SECOND_WORD_HERE&qe=sp&md=d&ipa=1
-  elif second_word == "defined" or second_word == "definition":
-    query = {"sp": first_word, "md": "d", "max": "1", "qe": "sp", "ipa": "1"}
-  # this one uses string interpolation (the f"" stuff)
-  elif f"{second_word} {third_word}" == "means what":
-    query = {"sp": first_word, "md": "d", "max": "1", "qe": "sp", "ipa": "1"}
-  elif f"{second_word} {third_word} {fourth_word}" == "is said how":
-    query = {"sp": first_word, "md": "r", "max": "1", "qe": "sp", "ipa": "1"}
-  # this one uses regular expressions -- i.e. if the second_word is "of" or "for"
-  elif first_word == "definition" and re.match(r'(of)|(for)',second_word):
-    query = {"sp": third_word, "md": "d", "max": "1", "qe": "sp", "ipa": "1"}
-  # the is_pronounced function returns true if first_word is a (mis)spelling of pronounced
-  elif re.match(r'(of)|(for)',second_word) and is_pronounced(first_word):
-    query = {"sp": third_word, "md": "r", "max": "1", "qe": "sp", "ipa": "1"}
-  # the ordering in the above list is not entirely random
-  # since an if-elif-else statement won't keep evaluating after it finds a match
-  # it makes sense to put the most computationally complex clauses at the end
-  # >>> import timeit
-  # >>> timeit.timeit('from word_helpers import is_pronounced; is_pronounced("pronounced")', number=10000)
-  # 0.022870146989589557
-  # >>> timeit.timeit('args = ["defined"]; args[0] == "defined"', number=10000)
-  # 0.002359684993280098
-  # it takes 2 milliseconds to compare a string in a list 10,000 times
-  # -- versus 2 centiseconds to run is_pronounced 10,000 times
-  # (on my Intel Core i5 2.67GHz CPU -- obviously speed depends on the processor)
-  # it's also worth noting that readability counts more than speed optimization (most of the time!)
-
-  # Quick way to check if any of the above if statements matched
-  if "sp" in query:
+    # https://api.datamuse.com/words?max=1&sp=nostrum&qe=sp&md=d&ipa=1
     # if so, we are done in this function
-    if query["md"] == "r": query_type = "PRO"
-    if query["md"] == "d": query_type = "DEF"
     return query
 
-  # these will be useful later
-  STOP_WORDS = ("and", "meaning", "means", "max", "about", "which", "that")
-
   # Parse more complicated requests for synonyms, etc
-  # 0 is false in python, so this loop will run until we've removed all the args
-  while len(args):
-    # we must reset these vars each time the loop starts
-    # in case we've deleted items from the args list
-    first_word = args[0]
-    second_word = args[1] if len(args) > 1 else ""
-    third_word = args[2] if len(args) > 2 else ""
-    # we use the teranary operator (this if ____ else that) to avoid an IndexError
-    # IndexError would be raised if we tried to access the second element (args[1])
-    # in a list which contained only one item (eg args == ["lonely"])
-    # the teranary operator (in most languages it looks like "____ ? this : that")
-    # returns "this" when the if is true and "that" when the if is false
-    # meaning, if len(args) is NOT greater than 1, second_word == ""
-
-    # Disambiguate homonym requests from spelling correction requests
-    # Example: sounding like tung
-    # Example: sounds like doe but spelled differently
-    if re.match(r'sound((s)|(ing)) like',f"{first_word} {second_word}"):
-
-      # again, use len(args) to avoid an IndexError
-      if len(args) >= 6 and \
-         re.match(r'((but)|(except)) spelled different(ly)?',f"{args[3]} {args[4]} {args[5]}"):
-        # but instead of teranary operator,
-        # use "short circuit logic" -- when python sees "if __A__ and __B__ ",
-        # it knows that if A is false, the whole thing will be false
-        # (you can't have "ice cream and potatoes" for dinner if you don't have ice cream)
-        # and it won't waste time evaluating B, so re.match won't run and args[4]
-        # won't be accessed and no IndexError will be raised, yay!
-        # regex explained: ? means the prior thing matched zero or one times
-        #                    different(ly)? matches "different" and "differently"
-        query["rel_hom"] = third_word
-        # now, delete 6 items from args, starting at item 0
-        del args[0:6]
+  # i is where we are in the list of args -- instead of deleting words from the
+  # front of the list once we've read them (which makes python shuffle every other
+  # word along by one), we just move i past them
+  i = 0
+  while i < len(args):
+    found = phrase_at(args, i)
+    if found:
+      end, action, words = found
+      # a function does its own thing, and tells us where it stopped reading
+      if callable(action):
+        i = action(query, args, end)
+      # otherwise, set that datamuse parameter to the WORD in the phrase
       else:
-        query["sl"] = third_word
-        del args[0:3]
-
-    # Example: spelled like 'cens?r'
-    elif re.match(r'spell((ed)|(ing)) like',f"{first_word} {second_word}"):
-      # two stars (**) means "unpack" a dictionary
-      # just like unpacking a suitcase, we've dumped the old contents of query
-      # into a new dictionary (which we are saving with the same variable name!)
-      query = {**query,"sp": third_word}
-      # query["sp"] = third_word also works fine
-      # just showing off how to combine two dictionaries :)
-      del args[0:3]
-
-    # Example: rhymes with culminate
-    elif len(args) > 2 and second_word == "with" and is_rhymes(first_word):
-      query["rel_rhy"] = third_word
-      del args[0:3]
-
-    # Example: almost rhymes with culminate
-    elif len(args) > 3 and \
-         f"{first_word} {third_word}" == "almost with" and \
-         is_rhymes(second_word):
-      query["rel_nry"] = args[3] # fourth_word
-      del args[0:4]
-
-    # Example: comes after sea
-    elif f"{first_word} {second_word}" == "comes after":
-      query["lc"] = third_word
-      del args[0:3]
-    elif first_word == "follows":
-      query["lc"] = second_word
-      del args[0:2]
-    elif f"{first_word} {second_word}" == "comes before":
-      query["rc"] = third_word
-      del args[0:3]
-    elif first_word == "preceeds":
-      query["rc"] = second_word
-      del args[0:2]
-
-    # Example: describes paint
-    elif first_word == "describes":
-      query["rel_jjb"] = second_word
-      del args[0:2]
-
-    # Example: associated with feet
-    elif f"{first_word} {second_word}" == "associated with" or \
-         f"{first_word} {second_word}" == "triggered by":
-      query["rel_trg"] = third_word
-      del args[0:3]
-
-    # Example: meaning feeling tired
-    elif first_word in ["means","meaning","like"]:
-      # get rid of first_word
-      del args[0]
-      # now short circuit logic again, plus using the tuple from ealier
-      # b/c if we have "meaning deer and sounds like roe" we don't want
-      # query["ml"] == "deer and sounds like roe" -- it should be just "deer"
-      while len(args) and args[0] not in STOP_WORDS:
-        # teranary operator prevents KeyError if "ml" not already in query dictionary
-        query["ml"] = f"{query['ml']} {args[0]}" if "ml" in query else args[0]
-        del args[0]
-    # an example with the previous code to make things clearer
-    # say args == ["means", "egg", "beater", "and", "max", "35"]
-    # first_word IS in ["means","meaning","like"]
-    # del first_word, args is now ["egg", "beater", "and", "max", "35"]
-    # len(args) == 5, args[0] is NOT in STOP_WORDS
-    # "ml" is NOT in query, so teranary returns args[0] ("egg")
-    # args[0] is copied to query["ml"] (query is now {ml: "egg"})
-    # del args[0], args is now ["beater", "and", "max", "35"]
-      # return to top of while loop, len(args) == 4, args[0] is NOT in STOP_WORDS
-      # "ml" IS in query, so teranary returns f"{query['ml']} {args[0]}" ("egg beater") 
-      # f"{query['ml']} {args[0]}" is copied to query["ml"]
-      # (query is now {ml: "egg beater"})
-      # del args[0], args is now ["and", "max", "35"]
-        # return to top of while loop, len(args) == 3,
-        # args[0] IS in STOP_WORDS (args[0] == "and")
-        # DO NOT enter the while loop, continue past this code block
-
-    # Discover the topic of our query
-    elif first_word == "about":
-      del args[0]
-      count = 0
-      # Datamuse allows a max of five topic words
-      while len(args) and args[0] not in STOP_WORDS and count <= 5:
-        query["topics"] = f"{query['topics']} {args[0]}" if "topics" in query else args[0]
-        del args[0]
-        # count += 1 is the same as count = count + 1
-        count += 1
-
-    # How many results to return (max 1000)
-    elif first_word in ["max", "maximum", "only"]:
-      user_max = convert_num(second_word)
-      if user_max and int(user_max) <= 1000:
-        query["max"] = user_max
-      del args[0:2]
-
-    # Remove filler words if they weren't parsed out above
-    elif first_word in ["that","which","and","like","is"]:
-      del args[0]
-
+        query[action] = words[0]
+        i = end
     # Add anything not otherwise parsable to the ml parameter
+    # (grab all the words in a row that aren't the start of a phrase, then add them at once)
+    else:
+      start = i
+      i += 1
+      while i < len(args) and not phrase_at(args, i):
+        i += 1
+      add_words(query, "ml", args[start:i])
+
+  return query
+
+#### END GRAMMAR
+
+#### HTTP SESSION
+# every time you call requests.get(), it opens a brand new connection to the website
+# for https that means a "TLS handshake" -- several trips back and forth across the
+# internet to agree on encryption keys -- before it can even ask its question!
+# a Session keeps connections open after each request ("keep-alive") and reuses them,
+# so we only pay for the handshake once per website, not once per word
+
+# the shared session (None until the first time we need it)
+# it can be swapped out for anything with a get() method that works like requests.get()
+session = None
+session_lock = threading.Lock()
+
+def get_session():
+  """ Make the shared session the first time it's needed, then keep reusing it. """
+  global session
+  # the lock stops two threads from both making a session at the same moment
+  with session_lock:
+    if session is None:
+      import requests
+      session = requests.Session()
+      # an adapter is the part of requests that keeps the pool of open connections
+      # pool_maxsize is how many connections to each website we keep open at once
+      # (one per thread that might be talking to that website)
+      adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+      session.mount("https://", adapter)
+      session.mount("http://", adapter)
+      # gzip squishes the answers, so there's less to download
+      session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+  return session
+
+class TokenBucket(object):
+  """ Lets through rate requests per second (on average), and never more than burst at once. """
+  # picture a bucket that fills up with tokens at a steady rate
+  # every request takes a token out; if the bucket is empty, it waits for the next one
+  # a full bucket lets a few requests through at once (the "burst"), then it's steady
+
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self.burst = burst or max(1, rate)
+    self.tokens = self.burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def take(self):
+    """ Take a token, waiting until there is one. """
+    # sleep after letting go of the lock, so other threads can get in line meanwhile
+    wait = self.reserve()
+    if wait: time.sleep(wait)
+
+  def reserve(self):
+    """ Take a token, and say how many seconds to wait before using it. """
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      # taking a token we don't have yet "reserves" it -- the bucket goes below zero, and
+      # the next thread in line waits a bit longer than we do (so nobody cuts in line)
+      self.tokens -= 1
+      return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class CircuitBreaker(object):
+  """ Stops asking a website that keeps failing, then tries again after a while. """
+  # named after the switch in your house that cuts the power when something is wrong
+  # "closed" means requests go through, "open" means they don't
+
+  def __init__(self, failures=None, cooldown=None):
+    self.failures = failures or BREAKER_FAILURES
+    self.cooldown = cooldown or BREAKER_COOLDOWN
+    self.failed_in_a_row = 0
+    self.opened = None
+    self.lock = threading.Lock()
+
+  def allow(self):
+    """ May we ask the website right now? """
+    with self.lock:
+      if self.opened is None: return True
+      if time.monotonic() - self.opened < self.cooldown: return False
+      # it's been a while -- let one request through to see if the website is back
+      # (and keep everybody else out until we know, by starting the wait over)
+      self.opened = time.monotonic()
+      return True
+
+  def succeeded(self):
+    with self.lock:
+      self.failed_in_a_row, self.opened = 0, None
+
+  def failed(self):
+    with self.lock:
+      self.failed_in_a_row += 1
+      if self.failed_in_a_row >= self.failures: self.opened = time.monotonic()
+
+# one bucket and one breaker for every website (made the first time we talk to it)
+# these are shared by every thread, so "word serve" and --batch stay under the budget too
+buckets = {}
+breakers = {}
+
+def guards(url):
+  """ The token bucket and circuit breaker for the website url is on. """
+  host = (urlparse(url).hostname or "").lower()
+  with session_lock:
+    if host not in buckets:
+      buckets[host] = TokenBucket(RATE_LIMITS.get(host, RATE_LIMITS["*"]))
+      breakers[host] = CircuitBreaker()
+  return buckets[host], breakers[host]
+
+def backoff(attempt, response=None):
+  """ How long to wait before trying again. """
+  import random
+  # if the website told us how long to wait (in seconds), do that
+  try:
+    return min(BACKOFF_CAP, float(response.headers["Retry-After"]))
+  except (AttributeError, KeyError, TypeError, ValueError):
+    pass
+  # otherwise wait twice as long as last time, but pick a random amount up to that
+  # (the "jitter" -- if lots of programs were told no at once, they won't all try again
+  #  at the same moment, and get told no all over again)
+  return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+def http_get(url, params=None, deadline=None):
+  """ Like requests.get(), but with the shared session, a timeout, a budget, and retries. """
+  import requests
+  # every try (and every wait in between) has to be over by the deadline (a time.monotonic())
+  # -- after that, go_fetch() has stopped waiting for us, and nobody would see the answer
+  if deadline is None: deadline = time.monotonic() + FETCH_TIMEOUT
+  bucket, breaker = guards(url)
+  # a website that keeps failing gets a rest (cached_get() has a plan B)
+  if not breaker.allow():
+    count("broken")
+    return failed_response(url)
+  for attempt in range(RETRIES + 1):
+    bucket.take()
+    start = time.perf_counter()
+    # without a timeout, a website that never answers would make us wait forever
+    # (and a try never gets longer than what's left before the deadline)
+    left = max(0.1, deadline - time.monotonic())
+    timeout = (min(HTTP_TIMEOUT[0], left), min(HTTP_TIMEOUT[1], left))
+    error = None
+    try:
+      response = get_session().get(url, params=params, timeout=timeout)
+    # no internet, no answer in time, or an answer cut off halfway (all RequestExceptions)
+    # might be a blip, so it's worth another try too
+    except requests.RequestException as e:
+      if metrics: note_upstream(url, None, start)
+      error, response = e, None
     else:
-      query["ml"] = f"{query['ml']} {first_word}" if "ml" in query else first_word
-      del args[0]
+      if metrics: note_upstream(url, response.status_code, start)
+      if response.status_code not in RETRY_STATUSES: break
+    # give up if that was the last try, or if the next one couldn't finish in time
+    wait = backoff(attempt, response)
+    if attempt == RETRIES or time.monotonic() + wait >= deadline:
+      if error is None: break
+      breaker.failed()
+      raise error
+    count("retries")
+    time.sleep(wait)
+  if response.status_code in RETRY_STATUSES:
+    breaker.failed()
+  else:
+    breaker.succeeded()
+  return response
 
-    # this is the bottom of that massive while loop
-    # if args is not empty by now, we'll start over from the top ^
+#### END HTTP SESSION
 
+#### METRICS
+# --timings is for one person looking at one query; metrics are for a program that runs
+# word (or "word serve") all day and wants to draw graphs of it:
+#
+#   word_query_seconds                              how long go_fetch() took (its _count
+#                                                   is how many queries it answered)
+#   word_print_seconds{format="grid"}               how long print_response() took
+#   word_upstream_requests_total{backend,status}    requests to datamuse and owlbot,
+#                                                   by status code ("error" if no answer)
+#   word_upstream_seconds{backend}                  how long those took
+#   word_fetch_total{result}                        fetch_stats (cache hits, misses, ...)
+#   word_queue_depth, word_in_flight                requests waiting for a helper
+#                                                   thread, and being asked right now
+#
+# the *_seconds ones are "histograms": instead of remembering every time, they count
+# how many were under 5ms, under 10ms, under 25ms, ... which is what prometheus wants
+# they can be printed as prometheus text (a file, or GET /metrics from "word serve")
+# or sent to a statsd server (a little program that collects numbers over udp)
+#
+# when nobody asked for metrics, "metrics" is None and every "if metrics:" is skipped,
+# so they cost (almost) nothing
+
+# the histogram buckets, in seconds
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics(object):
+  """ Counters and histograms, shared by every thread. """
+
+  def __init__(self):
+    # both are keyed by (name, labels), where labels is a tuple like (("backend", "owlbot"),)
+    self.counters = {}
+    # each histogram is [count in each bucket..., count bigger than every bucket,
+    #                    count of everything, sum of everything]
+    self.histograms = {}
+    # what statsd hasn't heard about yet (statsd wants every time, not buckets)
+    self.unsent = deque(maxlen=10000)
+    self.sent = {}
+    self.lock = threading.Lock()
+
+  def count(self, name, amount=1, **labels):
+    """ Add amount to a counter. """
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + amount
+
+  def observe(self, name, seconds, **labels):
+    """ Add one time to a histogram. """
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      if key not in self.histograms: self.histograms[key] = [0] * (len(METRIC_BUCKETS) + 3)
+      histogram = self.histograms[key]
+      # bisect finds the first bucket this time fits in (it also fits in every one after it,
+      # but prometheus adds those up itself, in prometheus())
+      histogram[bisect_left(METRIC_BUCKETS, seconds)] += 1
+      histogram[-2] += 1
+      histogram[-1] += seconds
+      self.unsent.append((key, seconds))
+
+  def gauges(self):
+    """ The numbers that are only worth reading when somebody asks (not counted as we go). """
+    with flight_lock:
+      stats, flying = dict(fetch_stats), len(in_flight)
+    # _work_queue isn't officially public, but it's the only way to see the queue
+    queued = fetch_pool._work_queue.qsize() if fetch_pool is not None else 0
+    return ([(("word_fetch_total", (("result", name),)), value) for name, value in stats.items()] +
+            [(("word_queue_depth", ()), queued), (("word_in_flight", ()), flying)])
+
+  def prometheus(self):
+    """ Everything, in prometheus' text format. """
+    def labelled(name, labels, *extra):
+      labels = labels + extra
+      if not labels: return name
+      return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+    with self.lock:
+      counters = sorted(self.counters.items())
+      histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+    lines, described = [], set()
+    def describe(name, kind):
+      # prometheus wants to know what kind of number each name is, once
+      if name not in described:
+        described.add(name)
+        lines.append(f"# TYPE {name} {kind}")
+    for (name, labels), value in counters:
+      describe(name, "counter")
+      lines.append(f"{labelled(name, labels)} {value}")
+    for (name, labels), value in self.gauges():
+      describe(name, "counter" if name.endswith("_total") else "gauge")
+      lines.append(f"{labelled(name, labels)} {value}")
+    for (name, labels), histogram in histograms:
+      describe(name, "histogram")
+      # prometheus buckets count everything up to their size ("le" is "less or equal")
+      total = 0
+      for size, amount in zip(METRIC_BUCKETS + ("+Inf",), histogram):
+        total += amount
+        lines.append(f"{labelled(name + '_bucket', labels, ('le', size))} {total}")
+      lines.append(f"{labelled(name + '_count', labels)} {histogram[-2]}")
+      lines.append(f"{labelled(name + '_sum', labels)} {histogram[-1]:.6f}")
+    return "\n".join(lines) + "\n"
+
+  def statsd(self):
+    """ What statsd hasn't heard yet, as statsd lines (and forget it, so it's only sent once). """
+    def dotted(name, labels):
+      # plain statsd has no labels, so they go on the end of the name
+      return ".".join([name] + [str(value) for _, value in labels])
+    lines = []
+    with self.lock:
+      # statsd adds counters up itself, so send how much each went up since last time
+      for key, value in self.counters.items():
+        if value != self.sent.get(key, 0):
+          lines.append(f"{dotted(*key)}:{value - self.sent.get(key, 0)}|c")
+          self.sent[key] = value
+      while self.unsent:
+        key, seconds = self.unsent.popleft()
+        lines.append(f"{dotted(*key)}:{seconds * 1000:.3f}|ms")
+    for key, value in self.gauges():
+      lines.append(f"{dotted(*key)}:{value}|g")
+    return lines
+
+  def send_statsd(self, address=STATSD_ADDRESS):
+    """ Send the new numbers to statsd (over udp, which never waits for an answer). """
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+      packet = b""
+      # keep each packet small enough that it won't get split up on the way
+      for line in self.statsd():
+        line = line.encode("utf-8")
+        if packet and len(packet) + len(line) >= 1400:
+          sock.sendto(packet.rstrip(b"\n"), address)
+          packet = b""
+        packet += line + b"\n"
+      if packet: sock.sendto(packet.rstrip(b"\n"), address)
+
+# this is set by --metrics (or WORD_METRICS, or "word serve"), or by a program that
+# uses word: word.metrics = word.Metrics()
+metrics = None
+# and this is where main() sends them when it's done (a file name, or statsd://host:port)
+metrics_target = METRICS_TARGET
+
+def measured(name):
+  """ Put this on a function (@measured("word_query_seconds")) to time every call. """
+  from functools import wraps
+  def decorate(function):
+    @wraps(function)
+    def timed(*args, **kwargs):
+      if metrics is None: return function(*args, **kwargs)
+      start = time.perf_counter()
+      # finally, because print_response() can sys.exit()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        # print_response() is the only one with a format worth knowing about
+        labels = {"format": output_format} if name == "word_print_seconds" else {}
+        metrics.observe(name, time.perf_counter() - start, **labels)
+    return timed
+  return decorate
+
+def backend_name(url):
+  """ A short name for the api a url belongs to (datamuse, owlbot or the website). """
+  if url.startswith(DATAMUSE_URL): return "datamuse"
+  if url.startswith(OWLBOT_URL): return "owlbot"
+  return urlparse(url).hostname or "unknown"
+
+def note_upstream(url, status, start):
+  """ Count one request to an api (status is None if it never answered). """
+  backend = backend_name(url)
+  metrics.count("word_upstream_requests_total", backend=backend, status=status or "error")
+  metrics.observe("word_upstream_seconds", time.perf_counter() - start, backend=backend)
+
+def export_metrics(target):
+  """ Send the metrics where --metrics said: statsd://host:port, or a prometheus file. """
+  if target.startswith("statsd"):
+    where = urlparse(target if "://" in target else "statsd://")
+    metrics.send_statsd((where.hostname or STATSD_ADDRESS[0], where.port or STATSD_ADDRESS[1]))
+    return
+  # write the whole file and swap it in, so whatever reads it never sees half of it
+  with open(target + ".tmp", "w") as f:
+    f.write(metrics.prometheus())
+  os.replace(target + ".tmp", target)
+
+#### END METRICS
+
+#### CACHE
+# a cache is a place to keep answers we've already worked out, so we don't have to
+# work them out again (your browser does the same thing with pictures on websites)
+# ours is a sqlite database: one file with one table, which looks like this
+#
+#   key                                            url          body       stored      used
+#   https://api.datamuse.com/words?max=20&ml=egg   https://...  b'[{...'   1517540025  1517540099
+#
+# stored is when we got the answer from the internet (to know when it's too old)
+# used is when we last read it (to know which answers nobody wants anymore)
+
+# these get changed by the --no-cache and --refresh flags
+use_cache = True
+refresh_cache = False
+# the open database connection (None until the first time we need it)
+cache_db = None
+# the answers we've used most recently are also kept in memory, which is even faster
+# than the database (this matters most for "word serve", which runs for a long time)
+# an OrderedDict remembers the order things were put in it, so the oldest is always first
+recent = OrderedDict()
+# sqlite doesn't like two threads writing at the same moment, so they take turns
+cache_lock = threading.Lock()
+
+def cache_key(url, params=None):
+  """ Make one string that is the same for queries that mean the same thing. """
+  # sorted() puts the parameters in alphabetical order and lower() ignores capitals
+  # so {"ml": "Egg", "max": "20"} and {"max": "20", "ml": "egg"} share a key
+  params = sorted((str(k).lower(), str(v).lower()) for k, v in (params or {}).items())
+  return f"{url.lower()}?{urlencode(params)}"
+
+def open_cache():
+  """ Open (or create) the cache database, or return None if we can't. """
+  global cache_db
+  import sqlite3
+  if cache_db is None:
+    try:
+      os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+      # check_same_thread=False lets our threads share the connection (we use cache_lock instead)
+      cache_db = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+      cache_db.execute("CREATE TABLE IF NOT EXISTS responses "
+                       "(key TEXT PRIMARY KEY, url TEXT, body BLOB, stored REAL, used REAL)")
+      # an index is like the one in the back of a book: it keeps the rows sorted by used,
+      # so finding the least recently used ones doesn't mean reading every row
+      cache_db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+    # if the disk is full or read-only, carry on without a cache
+    except (OSError, sqlite3.Error):
+      cache_db = False
+  return cache_db or None
+
+def remember(key, url, body, stored):
+  """ Keep an answer in memory, forgetting the oldest if there are too many. (Hold cache_lock!) """
+  recent[key] = (url, body, stored)
+  recent.move_to_end(key)
+  # the memory never holds more than the database does
+  while len(recent) > min(RECENT_SIZE, CACHE_SIZE):
+    # popitem(last=False) takes the oldest thing out
+    recent.popitem(last=False)
+
+def cache_get(key, ttl=None):
+  """ Look up a saved answer. Returns (url, body) or None if it's missing or too old. """
+  import sqlite3
+  ttl = CACHE_TTL if ttl is None else ttl
+  now = time.time()
+  with cache_lock:
+    # look in memory first
+    if key in recent and now - recent[key][2] <= ttl:
+      recent.move_to_end(key)
+      return recent[key][0], recent[key][1]
+  # then look in the database
+  db = open_cache()
+  if not db: return None
+  with cache_lock:
+    try:
+      row = db.execute("SELECT url, body, stored, used FROM responses WHERE key = ?", (key,)).fetchone()
+      if row is None or now - row[2] > ttl: return None
+      # remember that somebody still wants this one (that's the "LRU" in LRU eviction)
+      # (unless we already did recently -- see USED_RESOLUTION)
+      if now - (row[3] or 0) > USED_RESOLUTION:
+        db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+        db.commit()
+    except sqlite3.Error:
+      return None
+    remember(key, row[0], row[1], row[2])
+  return row[0], row[1]
+
+def cache_put(key, url, body):
+  """ Save an answer, and throw out old answers if the cache is full. """
+  import sqlite3
+  now = time.time()
+  with cache_lock:
+    remember(key, url, body, now)
+  db = open_cache()
+  if not db: return
+  with cache_lock:
+    try:
+      db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                 (key, url, body, now, now))
+      # LRU means "least recently used" -- keep the CACHE_SIZE newest, delete the rest
+      db.execute("DELETE FROM responses WHERE key NOT IN "
+                 "(SELECT key FROM responses ORDER BY used DESC LIMIT ?)", (CACHE_SIZE,))
+      db.commit()
+    except sqlite3.Error:
+      pass
+
+def cached_response(url, body):
+  """ Dress up a saved answer so it looks exactly like a fresh one from requests.get() """
+  import requests
+  response = requests.Response()
+  response.status_code = requests.codes.OK
+  response.url = url
+  response._content = body
+  # tell requests the whole body is already here (it isn't waiting on the internet)
+  response._content_consumed = True
+  response.encoding = "utf-8"
+  return response
+
+# "single flight": if two threads ask the same question at the same moment, only one of
+# them asks the internet, and the other one waits for that answer instead of asking again
+# (this happens a lot with "word serve", when several programs want the same rhymes)
+# in_flight has a future (see go_fetch) for every question being asked right now
+in_flight = {}
+flight_lock = threading.Lock()
+# how well it's working (the server shows these at /stats):
+#   hits        answered from the cache
+#   misses      asked the internet
+#   coalesced   waited for somebody else's question instead of asking again
+#   retries     asked again after a website said no (see http_get)
+#   broken      didn't ask, because the website has been failing (see CircuitBreaker)
+#   stale       the internet failed, so we used an old answer from the cache
+#   prefetched  asked in the background, before anybody wanted it (see PREFETCH)
+fetch_stats = {"hits": 0, "misses": 0, "coalesced": 0, "retries": 0, "broken": 0, "stale": 0,
+               "prefetched": 0}
+
+def count(stat):
+  """ Add one to a fetch_stats counter. """
+  with flight_lock:
+    fetch_stats[stat] += 1
+
+def shared_response(response):
+  """ A copy of a response, for a thread that waited for somebody else to fetch it. """
+  import requests
+  copy = requests.Response()
+  copy.status_code, copy.url, copy.headers = response.status_code, response.url, response.headers
+  copy._content, copy._content_consumed = response.content, True
+  copy.encoding = response.encoding
+  return copy
+
+def stale_response(key):
+  """ The last good answer to a question, however old it is (or None). """
+  # answers stay in the cache after they're too old, until they get evicted
+  saved = cache_get(key, ttl=float("inf")) if use_cache else None
+  if not saved: return None
+  count("stale")
+  return cached_response(*saved)
+
+def cached_get(url, params=None, deadline=None):
+  """ Like http_get(), but try the cache first and save good answers in it. """
+  import requests
+  from concurrent.futures import Future
+  key = cache_key(url, params)
+  if use_cache and not refresh_cache:
+    saved = cache_get(key)
+    if saved:
+      count("hits")
+      return cached_response(*saved)
+  # is somebody already asking? (the cache key means "the same question", so it's ours too)
+  with flight_lock:
+    flight = in_flight.get(key)
+    if flight is None:
+      flight = in_flight[key] = Future()
+      fetch_stats["misses"] += 1
+      waiting = False
+    else:
+      fetch_stats["coalesced"] += 1
+      waiting = True
+  # if they are, wait for their answer (result() raises their exception if they got one)
+  if waiting: return shared_response(flight.result())
+  try:
+    # if the website is broken, an old answer is better than none (if we have one)
+    try:
+      response = http_get(url, params, deadline)
+    except requests.RequestException:
+      response = stale_response(key)
+      if response is None: raise
+    else:
+      if response.status_code in RETRY_STATUSES:
+        response = stale_response(key) or response
+      # only save answers that worked -- we don't want to remember a 503 for a whole day
+      elif use_cache and response.status_code == requests.codes.OK:
+        cache_put(key, response.url, response.content)
+    flight.set_result(response)
+    return response
+  # (even ctrl-c, or the threads waiting for us would wait forever)
+  except BaseException as e:
+    flight.set_exception(e)
+    raise
+  finally:
+    # the next person to ask this question will find it in the cache (or ask again)
+    with flight_lock:
+      del in_flight[key]
+
+#### END CACHE
+
+# a pool of helper threads for talking to the APIs
+# (a thread is like a second pair of hands: while one waits for datamuse, the other
+#  can wait for owlbot -- waiting on the internet doesn't need the CPU, so this is cheap)
+# (threads are only started when there's work for them, so a big pool costs nothing)
+fetch_pool = None
+
+def get_pool():
+  """ Make the pool of helper threads the first time it's needed. """
+  global fetch_pool
+  from concurrent.futures import ThreadPoolExecutor
+  # session_lock is just as good as a new lock here -- nobody holds it for long
+  with session_lock:
+    if fetch_pool is None:
+      fetch_pool = ThreadPoolExecutor(max_workers=32)
+  return fetch_pool
+
+def failed_response(url):
+  """ A pretend response for when we couldn't reach an api at all. """
+  import requests
+  response = requests.Response()
+  response.url = url
+  # 503 means "service unavailable", which is what happened from our point of view
+  response.status_code = 503
+  response._content = b''
+  response._content_consumed = True
+  return response
+
+def fetch_one(url, params=None, deadline=None):
+  """ Fetch one url without crashing -- a broken api becomes a failed response instead. """
+  import requests
+  start = time.perf_counter()
+  try:
+    response = cached_get(url, params, deadline)
+  # RequestException covers everything requests can go wrong with (no internet, timeouts, etc)
+  except requests.RequestException:
+    response = failed_response(url)
+  if timing: note_request(response, time.perf_counter() - start)
+  return response
+
+#### BACKENDS
+# word can answer some questions without the internet, from a pronouncing dictionary
+# on your computer (see word_lexicon.py for how)
+# a "backend" is anything with a name and an answer(query) method, which gives back
+# a list shaped like datamuse's answer -- or None, if it can't answer that query
+
+# these get changed by the --local and --offline flags
+use_local = False    # ask the backends first, and the internet for whatever they can't answer
+offline = False      # never ask the internet at all
+
+# the backends get loaded the first time they're needed (reading the dictionary takes a
+# moment, but "word serve" only has to do it once)
+backends = []
+
+def get_backends():
+  """ Load the local backends the first time they're needed. """
+  with session_lock:
+    if not backends:
+      from word_lexicon import Lexicon
+      backends.append(Lexicon.from_file())
+  return backends
+
+def lexicon_ready():
+  """ Load the pronouncing dictionary, or say where it should be. Returns True if it's there. """
+  try:
+    get_backends()
+    return True
+  except OSError:
+    from word_lexicon import LEXICON_FILE
+    print(f"\033[0;36mCouldn't read the pronouncing dictionary\033[0m at {LEXICON_FILE}. See the README for where to get one.")
+    return False
+
+# the spelling index (see word_index.py) is so quick to open that word uses it whenever
+# it's there -- False means we looked, and there isn't one
+index = None
+
+def get_index():
+  """ Open the spelling index the first time it's needed. Returns a list of 0 or 1 backends. """
+  global index
+  with session_lock:
+    if index is None:
+      from word_index import WordIndex, INDEX_FILE
+      try:
+        index = WordIndex.from_file(INDEX_FILE)
+      # no index (or a broken one) just means asking datamuse like we always did
+      except (OSError, ValueError):
+        index = False
+  return [index] if index else []
+
+def ask_backends(query, backends):
+  """ Ask each local backend in turn. Returns a pretend response, or None if none can answer. """
+  for backend in backends:
+    entries = backend.answer(query)
+    if entries is not None:
+      # dress the answer up like one from datamuse, so print_response() can't tell
+      return cached_response(f"local://{backend.name}?{urlencode(query)}",
+                             json.dumps(entries).encode("utf-8"))
+  return None
+
+def build_index(wordlist=None):
+  """ Compile a word list into the spelling index. """
+  from word_index import build, read_wordlist, INDEX_FILE
+  from word_lexicon import LEXICON_FILE
+  # with no word list, use the pronouncing dictionary (it has syllables in it, too)
+  wordlist = wordlist or LEXICON_FILE
+  try:
+    with open(wordlist, encoding="utf-8", errors="replace") as f:
+      count = build(read_wordlist(f), INDEX_FILE)
+  except OSError as e:
+    print(f"\033[0;36mCouldn't build the index:\033[0m {e}")
+    sys.exit(1)
+  print(f"\033[0;36mIndexed {count} words\033[0m from {wordlist} into {INDEX_FILE}")
+
+def answer_locally(query, kind, use_local=False, offline=False):
+  """ Answer from this computer if we can. Returns a response, or None if we have to go online. """
+  # definitions and pronunciations come from the APIs, so they always have to go online
+  local = None
+  if kind not in ("DEF", "PRO"):
+    # spelling patterns come from the index, if "word build-index" has made one
+    if "sp" in query: local = ask_backends(query, get_index())
+    # and --local and --offline ask the pronouncing dictionary too
+    if local is None and (use_local or offline): local = ask_backends(query, get_backends())
+  # offline, a question the dictionary can't answer is just like having no internet
+  if local is None and offline: return failed_response("local://offline")
+  return local
+
+#### END BACKENDS
+
+#### PLANNER
+# datamuse answers one relation (rel_syn, rel_rhy...) per query, and reads at most five
+# topics -- ask for more in one go, and the answers get worse, not better
+# so plan() splits a query like that into several datamuse queries, we ask them all at
+# the same time, and merge_answers() puts the answers back together:
+#
+#   synonyms of happy that rhyme with bee
+#   {"rel_syn": "happy", "rel_rhy": "bee"}  ->  {"rel_syn": "happy"} and {"rel_rhy": "bee"}
+#   a word has to be in both answers ("glee"), and gets both scores added up
+#
+# topics only change the order of the answers, so a word can come from any chunk of topics
+
+TOPICS_PER_QUERY = 5
+
+def plan(query):
+  """ Split a query into the datamuse queries that answer it (usually it's just the one). """
+  relations = [param for param in query if param.startswith("rel_")]
+  topics = query.get("topics", "").split()
+  if len(relations) <= 1 and len(topics) <= TOPICS_PER_QUERY: return [query]
+  # everything else (ml, sp, lc...) datamuse can do alongside one relation
+  shared = {param: value for param, value in query.items()
+            if not param.startswith("rel_") and param != "topics"}
+  # ask for as many words as datamuse will give, so the answers have a chance to overlap
+  shared["max"] = 1000
+  chunks = [" ".join(topics[i:i + TOPICS_PER_QUERY])
+            for i in range(0, len(topics), TOPICS_PER_QUERY)]
+  queries = []
+  for relation in relations or [None]:
+    for chunk in chunks or [None]:
+      part = dict(shared)
+      if relation: part[relation] = query[relation]
+      if chunk: part["topics"] = chunk
+      queries.append(part)
+  return queries
+
+def merge_answers(query, queries, answers):
+  """ Put the answers to plan()'s queries back together into one answer. """
+  # scores from different relations aren't on the same scale, so each answer's scores
+  # count as a fraction of its best score (the best word in every answer gets 1)
+  relations = {}
+  for part, entries in zip(queries, answers):
+    relation = next((param for param in part if param.startswith("rel_")), None)
+    scores, seen = relations.setdefault(relation, ({}, {}))
+    best = max([entry.get("score", 0) for entry in entries] + [1])
+    for entry in entries:
+      scores[entry["word"]] = scores.get(entry["word"], 0) + entry.get("score", 0) / best
+      seen.setdefault(entry["word"], entry)
+  groups = list(relations.values())
+  # a word has to be in the answer for every relation
+  words = set(groups[0][0]).intersection(*(scores for scores, seen in groups[1:]))
+  total = {word: sum(scores[word] for scores, seen in groups) for word in words}
+  best = sorted(words, key=lambda word: (-total[word], word))[:int(query.get("max", MAXIMUM))]
+  return [dict(groups[0][1][word], score=round(1000 * total[word])) for word in best]
+
+def planned_response(query, queries, responses):
+  """ One response for the whole query, from the responses to plan()'s queries. """
+  import requests
+  # if any of them failed, the merged answer would be wrong, so pass the failure on
+  for response in responses:
+    if response.status_code != requests.codes.OK: return response
+  merged = merge_answers(query, queries, [json.loads(response.content) for response in responses])
+  return cached_response(f"plan://datamuse?{urlencode(query)}", json.dumps(merged).encode("utf-8"))
+
+#### END PLANNER
+
+#### RANKING
+# "with 2 syllables", "as a noun", "frequency 10" and "sorted by frequency" aren't things
+# datamuse understands, so go_fetch() takes them out of the query before it asks,
+# and asks for lots of words (with their syllables, parts of speech and frequency)
+# then word_rank.py throws away the ones that don't fit, and puts the rest in order
+
+# the query parameters that are ours, not datamuse's
+FILTERS = ("syllables", "pos", "frequency", "sort")
+# the metadata (md) datamuse has to send for each filter and order
+# (s is syllables, p is parts of speech, f is frequency)
+FILTER_METADATA = {"syllables": "s", "pos": "p", "frequency": "f"}
+SORT_METADATA = {"syllables": "s", "frequency": "f", "blend": "f"}
+# other ways of saying the orders in word_rank.SORTS
+SORT_ALIASES = {"alphabetical": "alphabet", "alphabetically": "alphabet", "common": "frequency",
+                "commonness": "frequency", "popularity": "frequency", "size": "length"}
+
+def read_range(text):
+  """ "2" -> (2, 2), "1-3" -> (1, 3), and anything else -> None. """
+  low, _, high = text.partition("-")
+  low, high = convert_num(low), convert_num(high or low)
+  if low is None or high is None: return None
+  return int(low), int(high)
+
+def take_filters(query):
+  """ Take our filters out of a query, and ask datamuse for what they need. Returns them (or None). """
+  asked = {param: query.pop(param) for param in FILTERS if param in query}
+  if not asked: return None
+  from word_rank import PARTS_OF_SPEECH, SORTS
+  wanted = {"limit": int(query.get("max", MAXIMUM)),
+            "sort": SORT_ALIASES.get(asked.get("sort"), asked.get("sort"))}
+  if "syllables" in asked: wanted["syllables"] = read_range(asked["syllables"])
+  if "pos" in asked: wanted["pos"] = PARTS_OF_SPEECH[asked["pos"]][1]
+  if "frequency" in asked:
+    try:
+      wanted["frequency"] = float(asked["frequency"])
+    # "frequency elephants" doesn't filter anything
+    except ValueError:
+      pass
+  if wanted["sort"] not in SORTS: wanted["sort"] = None
+  # if none of them turned out to mean anything, leave the query alone
+  if not any(wanted.get(name) is not None for name in ("syllables", "pos", "frequency", "sort")):
+    return None
+  # keeping 20 words out of 20 would leave hardly any, so ask for as many as datamuse gives
+  query["max"] = "1000"
+  md = query.get("md", "")
+  needs = {FILTER_METADATA[param] for param in asked if param in FILTER_METADATA}
+  needs.update(SORT_METADATA.get(wanted["sort"], ""))
+  query["md"] = md + "".join(sorted(needs - set(md)))
+  # the frequency comes as a tag like "f:12.3" -- if we asked for it, we'll take it back out
+  wanted["hide_frequency"] = "f" not in md
+  return wanted
+
+def refined(responses, wanted):
+  """ Filter and re-rank datamuse's answers with word_rank.py (if the query asked). """
+  if not wanted: return responses
+  import requests
+  from word_rank import refine
+  options = {name: value for name, value in wanted.items() if name != "hide_frequency"}
+  finished = []
+  for response in responses:
+    # owlbot's definitions (and anything that went wrong) are passed on as they are
+    if response.status_code != requests.codes.OK or "owlbot" in str(response.url):
+      finished.append(response)
+      continue
+    # (a 200 that isn't JSON goes on as it is too, and print_response() deals with it)
+    try:
+      entries = refine(json.loads(response.content), **options)
+    except ValueError:
+      finished.append(response)
+      continue
+    if wanted["hide_frequency"]:
+      for entry in entries:
+        if "tags" in entry: entry["tags"] = [tag for tag in entry["tags"] if not tag.startswith("f:")]
+    finished.append(cached_response(response.url, json.dumps(entries).encode("utf-8")))
+  return finished
+
+#### END RANKING
+
+def finish_query(query):
+  """ Fill in the parts of a query the user didn't say. """
+  # Let's set a default
+  if "max" not in query: query["max"] = MAXIMUM
+
+  # jsonl and tsv promise the number of syllables, which datamuse only sends if we ask
+  # (md is "metadata": d is definitions, r is pronunciation, s is syllables)
+  if output_format in ("jsonl", "tsv") and "s" not in query.get("md", ""):
+    query["md"] = query.get("md", "") + "s"
   return query
-  # and this is the end of the "def parse(args, query)" function
-  # whew!
 
-def go_fetch(query):
+def api_calls(query, kind):
+  """ The (url, params) of every api that answers this query. """
+  calls = [(DATAMUSE_URL, query)]
+  # definitions come from owlbot too
+  if kind == "DEF": calls.append((OWLBOT_URL + query['sp'], None))
+  return calls
+
+#### PREFETCH
+# after "word nostrum defined", the next question is usually how to say it, or what
+# else it rhymes with -- so --prefetch asks those questions straight away, in the
+# background, and puts the answers in the cache, where the next "word" will find them
+# (the prefetch runs in the helper threads; a plain "word" waits for them before it
+#  quits, after it has printed its answer -- "word serve" doesn't have to wait at all)
+
+# what gets fetched after a definition or pronunciation (except the one that was asked)
+SIBLINGS = [("DEF", "define {}"),
+            ("PRO", "{} is said how"),
+            (None,  "synonyms of {}"),
+            (None,  "rhymes with {}")]
+# don't start prefetching anything after this many seconds
+PREFETCH_BUDGET = 5
+
+# this gets changed by the --prefetch flag (WORD_PREFETCH=1 turns it on for every word,
+# which is handy for "word serve")
+PREFETCH = os.environ.get("WORD_PREFETCH", "") not in ("", "0")
+prefetching = PREFETCH
+
+def prefetch(word, kind):
+  """ Fetch the questions people usually ask next about word into the cache. """
+  # without the cache, there'd be nowhere to keep the answers
+  if not use_cache: return
+  deadline = time.monotonic() + PREFETCH_BUDGET
+  for sibling, template in SIBLINGS:
+    if sibling == kind: continue
+    # reading the query the same way parse() would means it gets the same cache key
+    query = finish_query(read_query(template.format(word).split(), {}))
+    for url, params in api_calls(query, sibling):
+      get_pool().submit(prefetch_one, url, params, deadline)
+
+def prefetch_one(url, params, deadline):
+  """ Fetch one url into the cache, unless the prefetch has run out of time. """
+  if time.monotonic() > deadline: return
+  count("prefetched")
+  fetch_one(url, params)
+
+#### END PREFETCH
+
+@measured("word_query_seconds")
+def go_fetch(query, kind=None):
   """ Turn the query dictionary into a real http request using the requests library! """
-  responses = []
   explained = ""
   global query_type
   global verbose
   global GLOSS
   global MAXIMUM
 
-  if   query_type == "PRO": explained = f"You asked for the pronunciation of '{query['sp']}'."
-  elif query_type == "DEF": explained = f"You asked for the definition of '{query['sp']}'."
+  # kind is the query_type for *this* query
+  # (batch mode fetches lots of queries at once, so it can't share the global one)
+  if kind is None: kind = query_type
+
+  if   kind == "PRO": explained = f"You asked for the pronunciation of '{query['sp']}'."
+  elif kind == "DEF": explained = f"You asked for the definition of '{query['sp']}'."
   else:
     # loop through the dictionary, one key at a time, and explain what each entry is for
     query_glossed = []
@@ -403,14 +1631,53 @@ def go_fetch(query):
       # explained[0] == f"{GLOSS['sp']} {query['sp']} == "are spelled like dear"
     explained = "You asked for words which " + " and ".join(query_glossed)
 
-  # Let's set a default
-  if "max" not in query: query["max"] = MAXIMUM
+  finish_query(query)
+  # the filters are for us, not datamuse (see RANKING)
+  wanted = take_filters(query)
+
+  # answer from this computer when we can (see BACKENDS above)
+  local = answer_locally(query, kind, use_local, offline)
+  if local is not None:
+    if verbose: print(explained)
+    return refined([local], wanted)
+
+  responses = refined(fetch_apis(query, kind), wanted)
+
+  # people who look up a definition usually want the pronunciation next (see PREFETCH)
+  if prefetching and kind in ("DEF", "PRO"): prefetch(query["sp"], kind)
+
+  # print out helpful info if the user asked for it
+  if verbose: print(explained)  # Plain english description of our query
+
+  return responses
+
+def fetch_apis(query, kind):
+  """ Ask datamuse (and owlbot, for definitions) at the same time. Returns their responses. """
+  from concurrent.futures import as_completed, TimeoutError as FuturesTimeout, wait
+  responses = []
+  # we wait FETCH_TIMEOUT seconds at most, so the helpers shouldn't keep retrying after that
+  deadline = time.monotonic() + FETCH_TIMEOUT
+
+  # if datamuse can't answer it in one go, ask all the parts at once (see PLANNER)
+  queries = plan(query) if kind is None else [query]
+  if len(queries) > 1:
+    url = DATAMUSE_URL
+    futures = [get_pool().submit(fetch_one, url, part, deadline) for part in queries]
+    wait(futures, timeout=FETCH_TIMEOUT)
+    parts = [future.result() if future.done() else failed_response(url) for future in futures]
+    return [planned_response(query, queries, parts)]
 
   # there's a TON of stuff going on in this line
-  datamuse = requests.get('https://api.datamuse.com/words',params=query)
+  datamuse = get_pool().submit(fetch_one, DATAMUSE_URL, query, deadline)
+  # submit() hands the job to a helper thread and comes back straight away
+  # the helper runs fetch_one(), which runs cached_get(), which looks in our cache
+  # first, and only asks the internet (with session.get()) if it has to
+  # what we get back is a "future" -- a ticket we can trade in for the response later
+  # meanwhile, inside the helper thread, session.get()...
   # first, the requests library's get() function "urlencodes" the url and parameters
   # e.g. if query == {"ml": "ringing in the ears"}, it becomes "?ml=ringing+in+the+ears"
-  # next, it opens an http connection to datamuse.com, something like:
+  # next, it opens an http connection to datamuse.com (or reuses one it already has open)
+  # something like:
   # *   Trying 54.225.209.164...
   # * Connected to api.datamuse.com (54.225.209.164) port 443 (#0)
   # then, it sends an http request which consists of a "header" and (optionally) a "body"
@@ -435,38 +1702,193 @@ def go_fetch(query):
   #
   # then the response is parsed into a python object
   # (sticks the headers in one variable, the body into another, etc)
-  # and the object is returned from get() and we store it in "datamuse"
-  # finally, we stick the response object into a list, like so:
-  responses.append(datamuse)
+  # and the object is returned from get() and the future holds onto it for us
+  # we remember which url each future is fetching (in case it never finishes)
+  futures = {datamuse: DATAMUSE_URL}
 
   # If a definition is asked for, we'll use two APIs
-  if query_type == "DEF":
-    owlbot = requests.get(f"https://owlbot.info/api/v2/dictionary/{query['sp']}")
-    responses.append(owlbot)
-
-  # print out helpful info if the user asked for it
-  if verbose: print(explained)  # Plain english description of our query
+  # both requests run at the same time, so we wait for the slower one, not for both added up
+  if kind == "DEF":
+    owlbot_url = OWLBOT_URL + query['sp']
+    futures[get_pool().submit(fetch_one, owlbot_url, None, deadline)] = owlbot_url
+
+  # as_completed() hands us each future as soon as it's done (fastest first)
+  # finally, we stick each response object into a list, like so:
+  try:
+    for future in as_completed(futures, timeout=FETCH_TIMEOUT):
+      responses.append(future.result())
+  # if one api is too slow, give up on it (but keep the answers we already have)
+  except FuturesTimeout:
+    for future, url in futures.items():
+      if not future.done(): responses.append(failed_response(url))
 
   return responses
 
+# the fortune files on this computer (None until we need them, see word_fortune.py)
+fortunes = None
+# the fortune program and the website each get this many seconds, at most
+FORTUNE_TIMEOUT = 2
+# a regular expression in python can be "compiled"
+# which a) makes it a tiny bit faster (important if you are using the same one many times)
+# and b) gives access to some more advanced features, like re.MULTILINE
+# www.bsdfortune.com doesn't have an API, so this regex is for getting the fortune out
+# of the source code of a human-readable webpage
+FORTUNE_RX = re.compile(r'http://www\.aasted\.org -->\n(.*)<br/> \n</p>\n<a href="./" rel="self" title="BSD Fortune">',re.MULTILINE|re.DOTALL)
+
 def fortune_cookie():
-  """ Give the user something nice if the query fails :) """
-  r = requests.get('http://www.bsdfortune.com')
-  # a regular expression in python can be "compiled"
-  # which a) makes it a tiny bit faster (important if you are using the same one many times)
-  # and b) gives access to some more advanced features, like re.MULTILINE
-  # www.bsdfortune.com doesn't have an API, so this regex is for getting the fortune out
-  # of the source code of a human-readable webpage
-  rx = re.compile(r'http://www\.aasted\.org -->\n(.*)<br/> \n</p>\n<a href="./" rel="self" title="BSD Fortune">',re.MULTILINE|re.DOTALL)
-  s = re.search(rx,r.text)
+  """ Give the user something nice if the query fails :) (or None if we can't find one) """
+  global fortunes
+  # 1. the fortune files on this computer -- no other programs, no internet
+  if fortunes is None:
+    from word_fortune import Fortunes
+    fortunes = Fortunes.from_dirs()
+  quote = fortunes.pick()
+  if quote: return quote
+  # 2. the fortune program, if it's installed (it might know files we don't)
+  import subprocess
+  try:
+    done = subprocess.run(["fortune", "-s"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          timeout=FORTUNE_TIMEOUT)
+    quote = done.stdout.decode("utf-8", errors="replace").strip()
+    if quote: return quote
+  # FileNotFoundError means it isn't installed
+  except (OSError, subprocess.TimeoutExpired):
+    pass
+  # 3. a website (just one try, and not for long -- it's only a fortune cookie)
+  import requests
+  try:
+    r = get_session().get('http://www.bsdfortune.com', timeout=FORTUNE_TIMEOUT)
+  except requests.RequestException:
+    return None
+  s = FORTUNE_RX.search(r.text)
+  if s is None: return None
   # then use substitution to remove "<br/>" tags (substitution: replace with nothing, lol)
   # s.groups() returns the caputred groups in the regex above in a list
   # s.groups()[0] gets the first item in the list (in this case, the text of the fortune)
   quote = re.sub(r'<br/>','',s.groups()[0])
   return quote
 
+def is_empty_list(body):
+  """ Is this JSON just an empty list? (Without turning all of it into python.) """
+  # regex explained: \s* means "any amount of whitespace (spaces, newlines...)"
+  # so this matches "[]" and "[ ]" and "\n[\n]\n", but stops at the first real character
+  return re.match(rb'\s*\[\s*\]\s*$', body or b'') is not None
+
+def iter_json_list(chunks):
+  """ Read a JSON list one item at a time, as the bytes come in (a "streaming" parser). """
+  # the json library can only read a *whole* document, but it has a helper, raw_decode(),
+  # which reads one thing from the start of a string and tells us where it stopped
+  # so we skip the [ at the start and the commas between items ourselves,
+  # and let raw_decode() read each item
+  decoder = json.JSONDecoder()
+  # a utf-8 letter can be split between two chunks, so let codecs glue those back together
+  text = codecs.getincrementaldecoder("utf-8")()
+  buffer, started = "", False
+  for chunk in chunks:
+    buffer += text.decode(chunk)
+    position = 0
+    while True:
+      # skip whitespace (and commas, once we're inside the list)
+      while position < len(buffer) and (buffer[position].isspace() or
+                                        (started and buffer[position] == ",")):
+        position += 1
+      if position == len(buffer): break
+      if not started:
+        if buffer[position] != "[": raise ValueError("expected a JSON list")
+        started = True
+        position += 1
+        continue
+      if buffer[position] == "]": return
+      try:
+        item, position = decoder.raw_decode(buffer, position)
+      # this item isn't all here yet -- wait for the next chunk
+      except ValueError:
+        break
+      yield item
+    # forget what we've already read (so memory doesn't grow with the answer)
+    buffer = buffer[position:]
+  if buffer.strip() or not started: raise ValueError("the JSON list ended too soon")
+
+def write_bytes(data):
+  """ Write raw bytes to stdout, exactly as they are. """
+  # sys.stdout is for text, but it has a .buffer underneath it for bytes
+  # (flush() first, so anything already printed comes out before our bytes)
+  if hasattr(sys.stdout, "buffer"):
+    sys.stdout.flush()
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+  # (when somebody swapped stdout for something without a buffer, like "word serve" does)
+  else:
+    sys.stdout.write(data.decode("utf-8"))
+
+def print_records(responses):
+  """ Print the answers for other programs to read, in output_format. """
+  import requests
+  good = [response for response in responses if response.status_code == requests.codes.OK]
+  # errors go to stderr, so they don't end up mixed in with the data
+  if good == []:
+    sys.stderr.write("Unable to reach API. Check your internet connection.\n")
+    sys.exit(1)
+  found = False
+  for response in good:
+    # json: pass datamuse's answer straight through, without reading it at all
+    if output_format == "json":
+      write_bytes(response.content.strip() + b"\n")
+      found = found or not is_empty_list(response.content)
+      continue
+    # owlbot doesn't put the word in its answer, so get it from the url (like print_response())
+    owlbot = re.search(r'owlbot\.info/.*dictionary/(.*)$', response.url)
+    for entry in iter_json_list(response.iter_content(CHUNK_SIZE)):
+      found = True
+      if owlbot: entry = {"word": owlbot.groups()[0], **entry}
+      # jsonl: "JSON lines", one JSON dictionary per line
+      if output_format == "jsonl":
+        line = json.dumps(entry, ensure_ascii=False)
+      # tsv: "tab separated values", one word per line with its details in columns
+      # (datamuse gives word, score, syllables, tags; owlbot gives word, type, definition)
+      elif output_format == "tsv":
+        columns = (["word", "type", "definition"] if owlbot else
+                   ["word", "score", "numSyllables", "tags", "defs"])
+        values = [entry.get(column, "") for column in columns]
+        # lists (like tags) become "a, b", and tabs inside values would break the columns
+        values = [", ".join(v) if isinstance(v, list) else str(v) for v in values]
+        line = "\t".join(v.replace("\t", " ") for v in values)
+      # plain: just the words (or just the definitions)
+      else:
+        line = entry["definition"] if owlbot else entry["word"]
+      sys.stdout.write(line + "\n")
+  # no results is still a failure, for scripts that check the exit code
+  if not found: sys.exit(1)
+
+def setup_colors():
+  """ Get the terminal ready for colors (only Windows needs any help). """
+  global colors_ready
+  if colors_ready: return
+  colors_ready = True
+  # this is because Windows doesn't understand ANSI color codes >:(
+  # e.g. \033[0;36m means "turn the text after me blue" -- but windows is like "??"
+  # so the colorama library translates the ANSI codes
+  # everyone else understands them already, and if we aren't printing to a terminal
+  # (isatty() is false when you pipe word into another program) there's nothing to translate
+  if sys.platform == "win32" and sys.stdout.isatty():
+    try:
+      # in colorama we even rename the function (because init() is too vague, imo)
+      from colorama import init as colorama_init
+      colorama_init()
+    # colorama is optional -- without it, windows just shows the codes
+    except ImportError:
+      pass
+
+# setup_colors() only needs to run once
+colors_ready = False
+
+# how print_response() prints (this gets changed by the --format flag)
+output_format = "grid"
+
+@measured("word_print_seconds")
 def print_response(responses):
   """ Turn JSON formatted responses into nice printable output. """
+  import requests
   connection_error, empty_results = False, False
 
   # the "global" keyword tells python that these variables are defined
@@ -475,37 +1897,39 @@ def print_response(responses):
   global verbose
   # you should mostly avoid global variables, but they are sometimes handy
 
+  # other programs don't want our pretty grid (see --format)
+  if output_format != "grid": return print_records(responses)
+
   # First, check if we have gotten any errors when connecting to the api
-  # enumerate() returns each item in a list along with the item's index
-  for index, response in enumerate(responses):
+  # we copy the good responses into a new list, instead of deleting the bad ones
+  # (deleting from a list while looping over it makes the loop skip the next item!)
+  good_responses = []
+  for response in responses:
     # an http status code is a number sent from the web server
     # everyone knows the dreaded "404" (not found)
     # there is also 200 (ok), 503 (service unavailable), 418 (i'm a teapot -- not joking!)
     # and dozens of others
     if response.status_code != requests.codes.OK:
       connection_error = True
-      del responses[index]
     # we also check if the response is empty
     # (that means the api found no words matching our query)
-    elif response.json() == []:
+    elif is_empty_list(response.content):
       empty_results = True
-      del responses[index]
+    else:
+      good_responses.append(response)
+  responses = good_responses
 
-  # this is because Windows doesn't understand ANSI color codes >:(
-  # e.g. \033[0;36m means "turn the text after me blue" -- but windows is like "??"
-  # so the colorama library translates the ANSI codes
-  colorama_init()
+  setup_colors()
 
-  if responses == [] and connection_error == True:
+  if responses == [] and connection_error == True and offline:
+    print("\033[0;36mCan't answer that offline.\033[0m The pronouncing dictionary only knows rhymes, sounds like, and spelled like.")
+    sys.exit(1)
+  elif responses == [] and connection_error == True:
     print("\033[0;36mUnable to reach API.\033[0m Check your internet connection or try again with more feeling.")
     sys.exit(1)
   elif responses == [] and empty_results == True:
-    # if the user has the BSD 'fortune' program installed, use it
-    try:
-      fortune = call(['fortune','-s'])
-    except FileNotFoundError:
-      # otherwise, get a fortune from the web
-      fortune = fortune_cookie()
+    # from the fortune files on this computer, or the fortune program, or the web
+    fortune = fortune_cookie()
     if fortune:
       print("\033[0;36mNo results found!\033[0m Have a fortune cookie:")
       print(fortune)
@@ -599,7 +2023,7 @@ def print_response(responses):
       # lots of work, but now we print it! \o/
       print(f"\033[0;36m{api}\033[0m says word \033[0;32m{word}\033[0m means")
       print(definition)
-  if query_type == "PRO":
+  elif query_type == "PRO":
     # print out helpful info if the user asked for it
     if verbose > 1: print("The answer came from: ",responses[0].url)
     if verbose > 2: print("The raw JSON response was: ",responses[0].text)
@@ -618,27 +2042,32 @@ def print_response(responses):
     # print out helpful info if the user asked for it
     if verbose > 1: print("The answer came from: ",responses[0].url)
     if verbose > 2: print("The raw JSON response was: ",responses[0].text)
-    payload = responses[0].json()
     # this will be fun to explain but. . .
-    # 1. go through each entry. if it has tags (a list), turn the list into a string
-    for entry in payload:
-      entry['tags'] = ', '.join(entry['tags']) if 'tags' in entry else ''
+    # we don't wait to turn the whole answer into python before printing anything
+    # (with max 1000 that's a lot of waiting, and a lot of memory)
+    # instead we print each row of three words as soon as we've read them
+    # 1. print the heading straight away
+    print("\033[0;36mdatamuse thinks these words may help!\033[0m".rjust(94))
     # 2. create a function which takes one argument (entry -- a dictionary)
     #    and returns a formatted string with justification and coloring
+    #    if it has tags (a list), the list is turned into a string
     fentry = lambda entry: (f"\033[0;32m{entry['word'].rjust(13)}\033[0m "
-                            f"\033[0;36m{entry['tags'].rjust(13)}\033[0m ")
-    # 3. for each entry in the payload list, run fentry(entry)*
-    #    (all the entries are now formatted as strings)
-    entries = list(map(fentry, payload))
-    # 4. starting at 0, go up to len(entries)-1 in steps of 3 (0,3,6,9. . .)
-    #    for each step *i*, take a slice of entries from i to i+3
-    #    join them together
-    #    this creates a single string containing three list entries
-    #    store all the strings in a list in the variable lines
-    lines = (''.join(entries[i:i+3]) for i in range(0,len(entries),3))
-    print("\033[0;36mdatamuse thinks these words may help!\033[0m".rjust(94))
-    # 5. join the lines together with \n in between each
-    print('\n'.join(lines))
+                            f"\033[0;36m{', '.join(entry.get('tags', ())).rjust(13)}\033[0m ")
+    # 3. for each entry in the answer, run fentry(entry)*
+    #    iter_json_list() hands us the entries one by one, as it reads them
+    #    and map() formats each one only when the loop below asks for it
+    entries = map(fentry, iter_json_list(responses[0].iter_content(CHUNK_SIZE)))
+    # 4. collect entries in a row until there are three of them
+    #    then join them together into a single string and write it out in one go
+    #    (sys.stdout.write() is print() without the extras -- no spaces, no newline)
+    row = []
+    for entry in entries:
+      row.append(entry)
+      if len(row) == 3:
+        sys.stdout.write(''.join(row) + '\n')
+        row = []
+    # 5. and the last row, if it didn't have three entries in it
+    if row: sys.stdout.write(''.join(row) + '\n')
 
     # * extra note here about map()
     # since you are interested in data stuff :3
@@ -682,47 +2111,925 @@ def print_response(responses):
     # 7
     # 8
 
+def run_batch(lines, jobs=BATCH_JOBS):
+  """ Look up one query per line, a few at a time, and print the answers in order. """
+  global query_type
+  from concurrent.futures import ThreadPoolExecutor, Future
+  failures = 0
+  pool = ThreadPoolExecutor(max_workers=jobs)
+  # a deque ("deck") is a list that's quick to add to at one end and take from the other
+  # it holds the queries we've started but haven't printed yet
+  pending = deque()
+
+  def print_next():
+    """ Wait for the oldest query and print its answer (or its error). """
+    global query_type
+    line, kind, future = pending.popleft()
+    # (other programs reading --format output don't want our headings in the way)
+    if output_format == "grid": print(f"\033[0;36m==> {line}\033[0m")
+    try:
+      # print_response() reads query_type, so set it to this query's type
+      query_type = kind
+      print_response(future.result())
+    # print_response() calls sys.exit() when there are no answers
+    # in batch mode we just count it as a failure and keep going
+    except SystemExit as e:
+      return 1 if e.code else 0
+    # a bad query (or a surprising answer) shouldn't stop the rest of the batch
+    except Exception as e:
+      print(f"\033[0;36mSomething went wrong:\033[0m {e!r}")
+      return 1
+    return 0
+
+  for line in lines:
+    line = line.strip()
+    # skip blank lines and # comments, so batch files can have notes in them
+    if not line or line.startswith("#"): continue
+    try:
+      # parse() sets the global query_type, so reset it first
+      # (otherwise "nostrum defined" would make every line after it a definition)
+      query_type = None
+      query = parse(shlex.split(line), {})
+      future = pool.submit(go_fetch, query, query_type)
+    # if we couldn't understand the line, make a future that "failed" straight away
+    # so the error gets printed in the right place, along with everything else
+    except Exception as e:
+      future = Future()
+      future.set_exception(e)
+    pending.append((line, query_type, future))
+    # don't run too far ahead of the printing -- this keeps memory flat for huge batches
+    # and lets the first answers show up while later lines are still being read
+    while len(pending) > jobs * 2:
+      failures += print_next()
+
+  # print whatever is left
+  while pending:
+    failures += print_next()
+  pool.shutdown()
+  return failures
+
+#### ENGINE
+# everything above is built for the commandline: it prints, it calls sys.exit(), and
+# it keeps track of the query in global variables (which two threads would fight over)
+# the Engine is for other python programs -- it hands back plain lists and dictionaries
 #
-#### END HELPER FUNCTIONS
+#   engine = word.Engine(maximum=10)
+#   engine.query("rhymes with norse")
+#   await engine.aquery("rhymes with norse")     # inside asyncio
+#
+# both give back the same thing:
+#   {"query": {"rel_rhy": "norse", "max": 10}, "type": None,
+#    "responses": [{"url": "https://api.datamuse.com/words?...", "status": 200,
+#                   "json": [{"word": "horse", "score": 2000}, ...]}]}
+# (type is "DEF" or "PRO" for definitions and pronunciations, and status isn't 200
+#  when an api couldn't be reached -- then json is None, and so is a 200 that wasn't
+#  JSON at all, like the login page of some cafe's wifi)
+# the cache, the rate limits and the connections are shared by every engine
+
+def read_json(response):
+  """ The JSON in a response, or None if it didn't work (or isn't JSON). """
+  if response.status_code != 200: return None
+  try:
+    return json.loads(response.content)
+  except ValueError:
+    return None
+
+def summarize(query, kind, responses):
+  """ What a query found, as plain lists and dictionaries. """
+  return {"query": query, "type": kind,
+          "responses": [{"url": str(r.url), "status": r.status_code, "json": read_json(r)}
+                        for r in responses]}
+
+class Engine(object):
+  """ Look words up from python, without printing, exiting, or global variables. """
+
+  def __init__(self, maximum=MAXIMUM, local=False, offline=False, prefetch=False, client=None):
+    # maximum is the default max (a query can still say "max 5")
+    # local, offline and prefetch work like --local, --offline and --prefetch
+    # client is for aquery(): anything with "async def get(url, params, timeout)" that
+    # gives back something with status_code, content and url, like httpx.AsyncClient
+    # (without one, aquery() makes an httpx client -- or uses threads, if there's no httpx)
+    self.maximum, self.local, self.offline, self.prefetch = maximum, local, offline, prefetch
+    self.client = client
+    self.client_loop = None
+    self.own_client = False
+    # the single flight idea from cached_get(), for tasks on the event loop
+    self.flights = {}
+
+  def read(self, text):
+    """ Turn text into a datamuse query, and say what kind of query it is. """
+    query = read_query(shlex.split(text), {})
+    if "max" not in query: query["max"] = self.maximum
+    return query, lookup_kind(query)
+
+  @measured("word_query_seconds")
+  def query(self, text):
+    """ Look up one query (like "rhymes with norse"). Safe to call from many threads at once. """
+    query, kind = self.read(text)
+    wanted = take_filters(query)
+    local = answer_locally(query, kind, self.local, self.offline)
+    if local is not None: return summarize(query, kind, refined([local], wanted))
+    responses = refined(fetch_apis(query, kind), wanted)
+    if self.prefetch and kind in ("DEF", "PRO"): prefetch(query["sp"], kind)
+    return summarize(query, kind, responses)
+
+  async def aquery(self, text):
+    """ Like query(), for asyncio -- thousands of these can wait on one event loop. """
+    import asyncio
+    query, kind = self.read(text)
+    wanted = take_filters(query)
+    local = answer_locally(query, kind, self.local, self.offline)
+    if local is not None: return summarize(query, kind, refined([local], wanted))
+    client = self.async_client()
+    queries = plan(query) if kind is None else [query]
+    fetches = ([(DATAMUSE_URL, part) for part in queries]
+               if len(queries) > 1 else api_calls(query, kind))
+    # without an async http library, the helper threads can do the waiting instead
+    # (one fetch_one() per request -- fetch_apis() would sit in a helper thread waiting for
+    #  other helper threads, and with enough queries at once there'd be none left to help)
+    if client is None:
+      deadline = time.monotonic() + FETCH_TIMEOUT
+      responses = await asyncio.gather(*(in_thread(fetch_one, url, params, deadline)
+                                         for url, params in fetches))
+    else:
+      responses = await asyncio.gather(*(self.afetch(client, url, params) for url, params in fetches))
+    if len(queries) > 1: responses = [planned_response(query, queries, responses)]
+    if self.prefetch and kind in ("DEF", "PRO"): prefetch(query["sp"], kind)
+    return summarize(query, kind, refined(list(responses), wanted))
+
+  def async_client(self):
+    """ The async http client (made the first time it's needed, for each event loop). """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    # a client made by somebody else is theirs to look after
+    if self.client is not None and not self.own_client: return self.client
+    # connections belong to the event loop that opened them, so a new loop needs a new client
+    if self.client is None or self.client_loop is not loop:
+      try:
+        import httpx
+      except ImportError:
+        return None
+      self.client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE),
+        headers={"Accept-Encoding": "gzip, deflate"})
+      self.client_loop, self.own_client = loop, True
+    return self.client
+
+  async def aclose(self):
+    """ Close the http client, if aquery() made one. """
+    if self.own_client and self.client is not None: await self.client.aclose()
+    self.client, self.own_client = None, False
+
+  async def afetch(self, client, url, params=None):
+    """ The async version of fetch_one(): cache first, then one request per question. """
+    import asyncio
+    key = cache_key(url, params)
+    if use_cache and not refresh_cache:
+      # sqlite makes us wait for the disk, so a helper thread does that part (see in_thread)
+      saved = await in_thread(cache_get, key)
+      if saved:
+        count("hits")
+        return cached_response(*saved)
+    flight = self.flights.get(key)
+    if flight is None:
+      count("misses")
+      flight = self.flights[key] = asyncio.ensure_future(self.aget(client, key, url, params))
+      flight.add_done_callback(lambda done: self.flights.pop(key, None))
+    else:
+      count("coalesced")
+    # shield() means one waiter giving up doesn't cancel the request for everybody else
+    return await asyncio.shield(flight)
+
+  async def aget(self, client, key, url, params):
+    """ The async version of http_get() (and the plan B from cached_get()). """
+    import asyncio
+    bucket, breaker = guards(url)
+    response = None
+    if not breaker.allow():
+      count("broken")
+    else:
+      for attempt in range(RETRIES + 1):
+        await asyncio.sleep(bucket.reserve())
+        start = time.perf_counter()
+        try:
+          response = await client.get(url, params=params, timeout=FETCH_TIMEOUT)
+        # every http library has its own exceptions, but they all mean "that didn't work"
+        except Exception:
+          response = None
+        if metrics: note_upstream(url, response and response.status_code, start)
+        if response is not None and response.status_code not in RETRY_STATUSES: break
+        if attempt < RETRIES:
+          count("retries")
+          await asyncio.sleep(backoff(attempt, response))
+      if response is None or response.status_code in RETRY_STATUSES:
+        breaker.failed()
+      else:
+        breaker.succeeded()
+    if response is None or response.status_code in RETRY_STATUSES:
+      stale = await in_thread(stale_response, key)
+      if stale is not None: return stale
+      return response if response is not None else failed_response(url)
+    if use_cache and response.status_code == 200:
+      await in_thread(cache_put, key, str(response.url), response.content)
+    return response
+
+async def in_thread(function, *args):
+  """ Run function(*args) in a helper thread, so the event loop can get on with other tasks. """
+  # anything that waits without await (like sqlite reading the disk) would stop every
+  # task on the loop until it's done -- in a helper thread, only this task waits
+  import asyncio
+  return await asyncio.get_running_loop().run_in_executor(get_pool(), function, *args)
+
+async def aquery(text, **options):
+  """ Look up one query with a new Engine (see Engine for the options). """
+  engine = Engine(**options)
+  try:
+    return await engine.aquery(text)
+  finally:
+    await engine.aclose()
+
+#### END ENGINE
+
+#### SERVER
+# most of the time word takes to answer is spent starting python and loading requests,
+# not actually talking to datamuse
+# "word serve" starts word once and leaves it running in the background (a "daemon")
+# then every other "word ..." just asks the server, which is already warmed up:
+# its http session has connections open, and it remembers recent answers in memory
+#
+# the server speaks http, but only to programs on this computer (127.0.0.1)
+#   GET  /query?q=rhymes+with+norse     -> the answer as JSON, for other programs
+#   POST /run  {"argv": ["-v", "platypus"]}  -> exactly what "word -v platypus" would print
+#   GET  /stats                         -> fetch_stats, as JSON
+#   GET  /metrics                       -> everything in METRICS, for prometheus
+
+def make_server(port):
+  """ Build (but don't start) the word server. """
+  from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+  # a class inside a function is unusual, but it lets us wait to import http.server
+  # until somebody actually wants a server (the class needs it to exist)
+  class WordServer(BaseHTTPRequestHandler):
+    """ Answers word queries over http, so the slow start-up only happens once. """
+
+    def do_GET(self):
+      url = urlparse(self.path)
+      # parse_qs turns "q=rhymes+with+norse" into {"q": ["rhymes with norse"]}
+      params = parse_qs(url.query)
+      if url.path == "/query" and "q" in params:
+        try:
+          self.reply(200, answer(params["q"][0]))
+        except Exception as e:
+          self.reply(400, {"error": repr(e)})
+      # how many questions came from the cache, the internet, or somebody else's question
+      elif url.path == "/stats":
+        with flight_lock:
+          stats = dict(fetch_stats)
+        self.reply(200, stats)
+      # the same and more, for prometheus (see METRICS)
+      elif url.path == "/metrics":
+        self.reply(200, (metrics or Metrics()).prometheus())
+      else:
+        self.reply(404, {"error": "try /query?q=your+query, /stats or /metrics"})
+
+    def do_POST(self):
+      if urlparse(self.path).path != "/run":
+        return self.reply(404, {"error": "try POST /run"})
+      try:
+        length = int(self.headers.get("Content-Length", 0))
+        argv = json.loads(self.rfile.read(length).decode("utf-8"))["argv"]
+      except (ValueError, KeyError):
+        return self.reply(400, {"error": 'send {"argv": [...]}'})
+      # the server can't start another server, or read somebody else's stdin
+      if not forwardable(argv):
+        return self.reply(400, {"error": "run that one without the server"})
+      status, output, errors = run_captured(argv)
+      self.reply(200, {"status": status, "output": output, "errors": errors})
+
+    def reply(self, status, data):
+      """ Send a dictionary back as JSON (or a string as plain text). """
+      if isinstance(data, str):
+        body, kind = data.encode("utf-8"), "text/plain; version=0.0.4"
+      else:
+        body, kind = json.dumps(data).encode("utf-8"), "application/json"
+      self.send_response(status)
+      self.send_header("Content-Type", kind)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      # BaseHTTPRequestHandler prints a line for every request -- only do that if asked
+      if verbose: BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  # a thread for every request, so one slow question doesn't keep everybody else waiting
+  # (and two people asking the same thing at once share one request, see cached_get())
+  server = ThreadingHTTPServer(("127.0.0.1", port), WordServer)
+  # don't wait for unfinished requests when the server stops
+  server.daemon_threads = True
+  return server
+
+def answer(text):
+  """ Look up one query and return what the APIs said as plain lists and dictionaries. """
+  # the server answers lots of programs at once, so it can't use the global query_type
+  return Engine().query(text)
+
+# redirect_stdout() swaps out stdout for the whole program, not just one thread, so only
+# one POST /run can be running at a time (GET /query doesn't print, so it doesn't wait)
+run_lock = threading.Lock()
+
+# the settings main() changes from the commandline -- the server keeps running after each
+# "word --refresh ..." it answers, so they have to be put back (or the next one would refresh too)
+RUN_SETTINGS = ("query_type", "verbose", "use_cache", "refresh_cache", "output_format",
+                "use_local", "offline", "prefetching", "timing", "metrics_target")
+
+def run_captured(argv):
+  """ Run main() but catch what it prints, on stdout and stderr (and its exit code). """
+  output, errors = io.StringIO(), io.StringIO()
+  status = 0
+  # redirect_stdout() sends everything print() prints into our StringIO for a while
+  # (and redirect_stderr() does the same for the errors, so they go back to the client too)
+  with run_lock, redirect_stdout(output), redirect_stderr(errors):
+    saved = {name: globals()[name] for name in RUN_SETTINGS}
+    try:
+      main(argv)
+    # sys.exit() works by raising SystemExit, so we can catch it like any other exception
+    # (its code is None for sys.exit(), or the number for sys.exit(1))
+    except SystemExit as e:
+      status = e.code if isinstance(e.code, int) else 0
+    except Exception as e:
+      print(f"\033[0;36mSomething went wrong:\033[0m {e!r}")
+      status = 1
+    finally:
+      globals().update(saved)
+  return status, output.getvalue(), errors.getvalue()
+
+def forwardable(argv):
+  """ Can the server run these arguments for us? (Not help, batch, -i, builds, or another server.) """
+  # read the flags the same way main() does, so "--interactive" counts as much as "-i"
+  try:
+    flags, rest = read_flags(argv)
+  # (main() prints the message for a flag it doesn't know)
+  except ValueError:
+    return False
+  # the subcommand comes after the flags, so look at what's left ("word -v serve" is serve too)
+  # (and not --timings, --profile or --metrics, which are about this word, not the server)
+  return len(rest) > 0 and rest[0] not in ["serve", "build-index"] and \
+         not any(flags[name] for name in ["batch", "interactive", "timing", "profile", "metrics_target"])
+
+def serve(port=SERVE_PORT):
+  """ Run the word server until somebody presses ctrl-c. """
+  server = make_server(port)
+  # port 0 means "any free port", so ask the server which one it really got
+  port = server.server_address[1]
+  # leave a note saying where we are, so "word ..." can find us
+  os.makedirs(os.path.dirname(SERVE_FILE), exist_ok=True)
+  with open(SERVE_FILE, "w") as f:
+    f.write(str(port))
+  print(f"\033[0;36mword is listening on http://127.0.0.1:{port}\033[0m (ctrl-c to stop)")
+  # a server runs for a long time, so it always keeps metrics (GET /metrics)
+  # and with --metrics, it sends them there every few seconds too
+  global metrics
+  if metrics is None: metrics = Metrics()
+  if metrics_target: threading.Thread(target=export_every, args=(metrics_target,), daemon=True).start()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    # take our note down again, so nobody tries to talk to a server that's gone
+    try:
+      os.remove(SERVE_FILE)
+    except OSError:
+      pass
+
+def export_every(target, seconds=10):
+  """ Export the metrics every few seconds, forever (run it in a helper thread). """
+  while True:
+    time.sleep(seconds)
+    try:
+      export_metrics(target)
+    # a statsd or a disk that's gone away shouldn't stop the server
+    except OSError:
+      pass
+
+def serve_in_background(port=0):
+  """ Start the word server in a helper thread, for programs that use word. Returns it. """
+  # e.g. word.metrics = word.Metrics(); word.serve_in_background(9100)
+  # and then prometheus can read http://127.0.0.1:9100/metrics
+  server = make_server(port)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+def forward_to_server(argv):
+  """ Ask a running word server to answer for us. Returns the exit code, or None if we can't. """
+  if not forwardable(argv): return None
+  try:
+    with open(SERVE_FILE) as f:
+      port = int(f.read())
+  # no note means no server (ValueError means the note was scribbled on)
+  except (OSError, ValueError):
+    return None
+  # http.client is the small http library that requests is built on top of
+  # it's plenty for talking to our own server, and much quicker to load
+  from http.client import HTTPConnection
+  connection = HTTPConnection("127.0.0.1", port, timeout=FETCH_TIMEOUT * 2)
+  try:
+    connection.request("POST", "/run", body=json.dumps({"argv": argv}).encode("utf-8"),
+                       headers={"Content-Type": "application/json"})
+    result = json.loads(connection.getresponse().read().decode("utf-8"))
+  # if the server isn't really there (or is broken), we'll just do it ourselves
+  except (OSError, ValueError):
+    return None
+  finally:
+    connection.close()
+  sys.stdout.write(result["output"])
+  sys.stderr.write(result.get("errors", ""))
+  return result["status"]
+
+#### END SERVER
+
+#### TIMINGS
+# "word --timings rhymes with norse" says where the time went:
+#
+#   import        18.2 ms    reading word.py (python itself starting up comes before this)
+#   libraries     48.0 ms    importing requests and sqlite3 (see LAZY_IMPORTS)
+#   parse          0.1 ms    understanding "rhymes with norse"
+#   fetch        161.0 ms    asking the apis (or the cache), with a line for each request
+#   print          1.9 ms    printing the answer
+#
+# ("word --timings json ..." prints the same thing as JSON, for other programs)
+# --batch gets one report for the whole run, and -i one for every query
+# everything goes to stderr, so it doesn't get mixed up with the answer
+# "word --profile ..." goes further, and saves a python profile of every function call
+
+# this gets changed by the --timings flag ("text" or "json")
+timing = None
+# what happened so far: (stage, seconds) and one dictionary per request
+stage_times = []
+request_times = []
+
+# the big libraries word only imports when it first needs them (so --help is quick)
+# importing requests takes longer than most answers from the cache, so --timings imports
+# them up front, as a stage of their own -- otherwise it would look like part of "fetch"
+LAZY_IMPORTS = ("requests", "sqlite3")
+
+@contextmanager
+def stage(name):
+  """ Time everything inside a "with stage(name):" block (if --timings is on). """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    if timing: stage_times.append((name, time.perf_counter() - start))
+
+def note_request(response, seconds):
+  """ Remember how long one request took, and where its answer came from. """
+  # requests measures "elapsed" from sending the request until the answer starts arriving
+  # (that's connecting -- dns, tls -- plus the server thinking), and leaves it at zero
+  # for the answers we make up ourselves, from the cache
+  waited = response.elapsed.total_seconds() if getattr(response, "elapsed", None) else 0
+  request_times.append({"url": response.url, "status": response.status_code,
+                        "source": "internet" if waited else "cache",
+                        "ms": round(seconds * 1000, 3), "waiting_ms": round(waited * 1000, 3)})
+
+def import_libraries():
+  """ Import LAZY_IMPORTS now, and time it (for --timings). """
+  with stage("libraries"):
+    for name in LAZY_IMPORTS:
+      __import__(name)
+
+def report_timings(responses=None, since=None):
+  """ Print what --timings found out (on stderr), for everything since since (or since word started). """
+  stages = OrderedDict()
+  for name, seconds in stage_times:
+    stages[name] = stages.get(name, 0) + seconds
+  # decoding the JSON happens bit by bit while printing, so time it separately here
+  # (this is the only place word decodes it twice, and only with --timings)
+  if responses:
+    start = time.perf_counter()
+    for response in responses:
+      try:
+        json.loads(response.content)
+      except ValueError:
+        pass
+    stages["json decode"] = time.perf_counter() - start
+  report = {"stages_ms": {name: round(seconds * 1000, 3) for name, seconds in stages.items()},
+            "requests": list(request_times),
+            "total_ms": round((time.perf_counter() - (since or STARTED)) * 1000, 3)}
+  if timing == "json":
+    print(json.dumps(report), file=sys.stderr)
+    return
+  for name, ms in report["stages_ms"].items():
+    print(f"\033[0;36m{name:<12}\033[0m {ms:>10.1f} ms", file=sys.stderr)
+    if name == "fetch":
+      for request in report["requests"]:
+        print(f"  {request['source']:<9} {request['status'] or '-':>3} {request['ms']:>10.1f} ms "
+              f"(waiting {request['waiting_ms']:.1f} ms)  {request['url']}", file=sys.stderr)
+  print(f"\033[0;36m{'total':<12}\033[0m {report['total_ms']:>10.1f} ms", file=sys.stderr)
+
+def profiled(path, function, *args):
+  """ Run function(*args) in python's profiler, and save what it found in path. """
+  import cProfile
+  profiler = cProfile.Profile()
+  profiler.enable()
+  try:
+    return function(*args)
+  finally:
+    profiler.disable()
+    profiler.dump_stats(path)
+    # read it with: python -m pstats word.pstats  (then type "sort cumtime" and "stats 20")
+    print(f"\033[0;36mSaved a profile in {path}\033[0m (python -m pstats {path})", file=sys.stderr)
+
+#### END TIMINGS
+
+#### REPL
+# "word -i" keeps asking for queries until you press ctrl-d, so you can explore words
+# without starting word (and connecting to datamuse) every time
+#
+#   word> rhymes with norse
+#   word> :max 50                     <- every query after this gets max 50
+#   word> sounds like tung
+#
+# tab completes the words word understands ("rhy<tab>" -> "rhymes"), and the words
+# in answers you've seen (so you can keep following a chain of words)
+# up and down go through what you've asked before, even last time you ran word -i
+
+HISTORY_FILE = os.path.join(CACHE_DIR, "history")
+
+REPL_HELP = """
+Type a query, like "rhymes with norse" (without "word"). Ctrl-d quits.
+
+    :max <number>          Show this many words for every query (unless it says max).
+    :format <format>       grid, json, jsonl, tsv or plain.
+    :local | :offline | :prefetch | :cache  [on|off]
+                           Like --local, --offline, --prefetch and --no-cache.
+    :verbose <number>      Like -v (1), -vv (2) or -vvv (3).
+    :recent                What you asked recently, and what came back.
+    :help                  This help.
+"""
 
-if __name__ == "__main__":
+# how many of the recent answers' words to offer for tab completion
+RECENT_WORDS = 1000
+
+def keywords():
+  """ Every word in the phrases parse() knows, for tab completion. """
+  found = set(FUZZY_KEYWORDS)
+  for phrase, action in PHRASES + LOOKUPS:
+    for part in phrase:
+      # a part of a phrase is a word, a tuple of words, or WORD (or a test, like is_rhymes)
+      if isinstance(part, str): found.add(part)
+      elif isinstance(part, tuple): found.update(part)
+  return sorted(found)
+
+def answer_words(responses):
+  """ The words in some datamuse answers (or an empty list). """
+  import requests
+  words = []
+  for response in responses:
+    if response.status_code != requests.codes.OK or "owlbot" in str(response.url): continue
+    try:
+      words += [entry["word"] for entry in json.loads(response.content) if "word" in entry]
+    except (ValueError, TypeError):
+      pass
+  return words
+
+class Repl(object):
+  """ The word -i prompt: one query per line, with settings that last until you quit. """
+
+  def __init__(self):
+    self.maximum = None
+    # words from recent answers (newest last) and a table of recent queries
+    self.words = deque(maxlen=RECENT_WORDS)
+    self.asked = deque(maxlen=20)
+    self.keywords = keywords()
+
+  def complete(self, text, state):
+    """ readline calls this with what you've typed so far, and 0, 1, 2... for each guess. """
+    if state == 0:
+      if text.startswith(":"):
+        options = [":max", ":format", ":local", ":offline", ":prefetch", ":cache", ":verbose",
+                   ":recent", ":help"]
+      else:
+        # newest words first, and each one only once
+        options = self.keywords + list(OrderedDict.fromkeys(reversed(self.words)))
+      self.matches = [option for option in options if option.startswith(text)]
+    return self.matches[state] if state < len(self.matches) else None
+
+  def setting(self, line):
+    """ Change a setting (a line starting with a colon). """
+    global output_format, use_local, offline, prefetching, use_cache, verbose
+    name, *values = line[1:].split()
+    value = values[0] if values else None
+    switch = value not in ("off", "no", "0", "false")
+    if name == "max" and value and convert_num(value) and 0 < int(convert_num(value)) <= 1000:
+      self.maximum = convert_num(value)
+    elif name == "format" and value in FORMATS: output_format = value
+    # (only switch to the pronouncing dictionary if there is one)
+    elif name == "local": use_local = switch and lexicon_ready()
+    elif name == "offline": offline = switch and lexicon_ready()
+    elif name == "prefetch": prefetching = switch
+    elif name == "cache": use_cache = switch
+    elif name == "verbose" and value and value.isdigit(): verbose = min(int(value), 3)
+    elif name == "recent":
+      for text, count, words in self.asked:
+        print(f"\033[0;36m{text:<40}\033[0m {count:>4}  {' '.join(words[:5])}")
+    elif name == "help": print(REPL_HELP)
+    else: print(f"Unknown setting {line}. Try :help")
+
+  def run(self, line):
+    """ Answer one query, like main() would (but without quitting afterwards). """
+    global query_type
+    query_type = None
+    # with --timings, every query gets a report of its own
+    started, responses = time.perf_counter(), None
+    stage_times.clear()
+    request_times.clear()
+    try:
+      with stage("parse"):
+        query = parse(shlex.split(line), {})
+        if self.maximum and "max" not in query: query["max"] = self.maximum
+      with stage("fetch"):
+        responses = go_fetch(query)
+      words = answer_words(responses)
+      self.words.extend(words)
+      self.asked.append((line, len(words), words))
+      with stage("print"):
+        try:
+          print_response(responses)
+        # print_response() calls sys.exit() when something went wrong, but we keep going
+        except SystemExit:
+          pass
+    finally:
+      if timing: report_timings(responses, started)
+
+  def loop(self, read=input):
+    """ Read and answer queries until ctrl-d. """
+    while True:
+      try:
+        # (no colors in the prompt -- they confuse readline about how long the line is)
+        line = read("word> ").strip()
+      except EOFError:
+        print()
+        return
+      # ctrl-c gives up on what you were typing (or on a slow query), not on word
+      except KeyboardInterrupt:
+        print()
+        continue
+      if not line: continue
+      try:
+        if line.startswith(":"): self.setting(line)
+        else: self.run(line)
+      except KeyboardInterrupt:
+        print()
+      # a line we can't understand (like an unfinished 'quote) shouldn't end the session
+      except ValueError as e:
+        print(f"\033[0;36mCouldn't read that:\033[0m {e}")
+      # and neither should a file we couldn't open (the cache, say)
+      except OSError as e:
+        print(f"\033[0;36mSomething went wrong:\033[0m {e}")
+
+def repl():
+  """ Start the word -i prompt, with history and tab completion if readline is there. """
+  prompt = Repl()
+  try:
+    import readline
+  # windows doesn't come with readline, so no history or completion there (but it still works)
+  except ImportError:
+    readline = None
+  if readline:
+    try:
+      readline.read_history_file(HISTORY_FILE)
+    except OSError:
+      pass
+    readline.set_history_length(1000)
+    readline.set_completer(prompt.complete)
+    # complete one word at a time (a quote doesn't start a new word, so 'cens? still completes)
+    readline.set_completer_delims(" \t\n")
+    readline.parse_and_bind("tab: complete")
+  try:
+    prompt.loop()
+  finally:
+    if readline:
+      try:
+        os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+        readline.write_history_file(HISTORY_FILE)
+      except OSError:
+        pass
+
+#### END REPL
+
+def read_flags(args):
+  """ Read the option flags at the start of args. Returns (settings, the rest of args). """
+  # main() uses this to set everything up, and forwardable() to see what you asked for
+  # an unknown flag raises ValueError
+  # copy args, so we don't change the caller's list when we pop things off it
+  args = list(args)
+
+  # verbose flag is off (set to zero/false) by default
+  verbose = 0
+
+  # the cache is on by default
+  use_cache, refresh_cache = True, False
+
+  # and so is the internet
+  use_local, offline = False, False
+
+  # prefetching is off, unless WORD_PREFETCH says otherwise
+  prefetching = PREFETCH
+
+  # and we print the grid, unless somebody asks for --format
+  output_format = "grid"
+
+  # batch mode is off by default (when it's on, this is the file to read)
+  batch = None
+  interactive = False
+  jobs = BATCH_JOBS
+
+  # no --timings, --profile, or --metrics either
+  timing, profile, metrics_target = None, None, None
+
+  # Read the option flags (they all start with a dash and come before the query)
+  while len(args) and args[0].startswith("-"):
+    # pop(0) gets rid of the flag from the list, so we don't re-read it later
+    flag = args.pop(0)
+    # Turn on verbose flag if asked (this will output helpful debugging info)
+    # if the flag is a dash followed by 1, 2, or 3 v's
+    if re.match(r"-(?:v){1,3}\b",flag):
+      # set verbose to the number of v's (minus 1 for the dash!)
+      verbose = len(flag) - 1
+    # regex explained: -(?:v){1,3}\b
+    #   -     literal dash
+    #   (?:)  a NON capturing group (will make more sense later)
+    #   v     literal letter v
+    #   {1,3} the prior group, found once, twice, or thrice (in a row)
+    #   \b    word boundary (so we match "-v" or "-vvv" not "-vvvabc")
+    # Skip the cache entirely
+    elif flag == "--no-cache":
+      use_cache = False
+    # Don't trust the cache, but do save the new answers in it
+    elif flag == "--refresh":
+      refresh_cache = True
+    # Answer from the pronouncing dictionary first (and maybe only)
+    elif flag == "--local":
+      use_local = True
+    elif flag == "--offline":
+      offline = True
+    # Look up the pronunciation, synonyms and rhymes of a definition in the background
+    elif flag == "--prefetch":
+      prefetching = True
+    # Read queries from a file (or from stdin if there's no file, or the file is "-")
+    elif flag == "--batch":
+      batch = args.pop(0) if len(args) and not args[0].startswith("-") else "-"
+    # Print the answers for other programs to read
+    elif flag == "--format" and len(args) and args[0] in FORMATS:
+      output_format = args.pop(0)
+    # Keep asking for queries (see REPL)
+    elif flag in ["-i", "--interactive"]:
+      interactive = True
+    elif flag == "--jobs" and len(args) and convert_num(args[0]):
+      jobs = max(1, int(convert_num(args.pop(0))))
+    # Say where the time went (see TIMINGS)
+    elif flag == "--timings":
+      timing = args.pop(0) if len(args) and args[0] == "json" else "text"
+    # Save a python profile (in word.pstats, unless there's a file name ending in .pstats or .prof)
+    elif flag == "--profile":
+      profile = args.pop(0) if len(args) and args[0].endswith((".pstats", ".prof")) else "word.pstats"
+    # Keep metrics, and save them in a file (prometheus) or send them to statsd://host:port
+    elif flag == "--metrics" and len(args):
+      metrics_target = args.pop(0)
+    else:
+      raise ValueError(flag)
+
+
+  settings = dict(verbose=verbose, use_cache=use_cache, refresh_cache=refresh_cache,
+                  use_local=use_local, offline=offline, prefetching=prefetching,
+                  output_format=output_format, batch=batch, interactive=interactive, jobs=jobs,
+                  timing=timing, profile=profile, metrics_target=metrics_target)
+  return settings, args
+
+def main(args):
+  """ Run word with a list of commandline arguments (everything after "word"). """
+  # main() changes these "outside" variables, so the rest of the functions can see them
+  global query_type, verbose, use_cache, refresh_cache, output_format, use_local, offline
+  global prefetching, timing, metrics, metrics_target
+
+  # how long python took to read word.py (see TIMINGS)
+  stage_times[:] = [("import", time.perf_counter() - STARTED)]
+  request_times.clear()
 
   # if there are no comandline arguments or if the first arg is help
-  if len(sys.argv) == 1 or sys.argv[1] in ["-h","--help"]:
+  if len(args) == 0 or args[0] in ["-h","--help"]:
     # print instructions
     print(USAGE)
     # and exit the program
     sys.exit()
-  # sys.argv is a list of stuff you typed to start the program
-  # if you typed "word.py --help" you get sys.argv == ["word.py","--help"]
-
-  # copy sys.argv starting with the second element (index 1)
-  args = sys.argv[1:]
 
   # a flag to set if the user asks for definitions or pronuciation help
   query_type = None
 
-  # verbose flag is off (set to zero/false) by default
-  verbose = 0
+  # Read the option flags (see read_flags() below)
+  try:
+    flags, args = read_flags(args)
+  except ValueError as e:
+    print(f"Unknown option {e}. Try word --help")
+    sys.exit(1)
+  verbose, use_cache, refresh_cache = flags["verbose"], flags["use_cache"], flags["refresh_cache"]
+  use_local, offline, prefetching = flags["use_local"], flags["offline"], flags["prefetching"]
+  output_format, timing, profile = flags["output_format"], flags["timing"], flags["profile"]
+  batch, interactive, jobs = flags["batch"], flags["interactive"], flags["jobs"]
+  # metrics only if there's --metrics, or WORD_METRICS says so
+  metrics_target = flags["metrics_target"] or METRICS_TARGET
+
+  # make sure the pronouncing dictionary is there before we need it
+  if (use_local or offline) and not lexicon_ready():
+    sys.exit(1)
 
-  # Turn on verbose flag if asked (this will output helpful debugging info)
-  # if first comandline arg starts with a dash followed by 1, 2, or 3 v's
-  if re.match(r"-(?:v){1,3}\b",args[0]):
-    # set verbose to the number of v's (minus 1 for the dash!)
-    verbose = len(args[0]) - 1
-    # get rid of the flag from the list, so we don't re-read it later
-    args.pop(0)
-  # regex explained: -(?:v){1,3}\b
-  #   -     literal dash
-  #   (?:)  a NON capturing group (will make more sense later)
-  #   v     literal letter v
-  #   {1,3} the prior group, found once, twice, or thrice (in a row)
-  #   \b    word boundary (so we match "-v" or "-vvv" not "-vvvabc")
+  # (the server keeps its own metrics, which we shouldn't throw away)
+  if metrics_target and metrics is None: metrics = Metrics()
+
+  # --profile watches everything from here on
+  try:
+    if profile:
+      profiled(profile, run, args, batch, jobs, interactive)
+    else:
+      run(args, batch, jobs, interactive)
+  # run() usually ends with sys.exit(), so export the metrics on the way out
+  finally:
+    if metrics_target: export_metrics(metrics_target)
+
+def run(args, batch, jobs, interactive):
+  """ Do what main() read from the commandline. """
+  # in batch mode, the queries come from a file instead of the commandline
+  # (with --timings, the big libraries get timed on their own, before anything needs them)
+  if timing: import_libraries()
+
+  if batch:
+    # "-" is the traditional way of saying "read from stdin instead of a file"
+    lines = sys.stdin if batch == "-" else open(batch)
+    # the queries overlap, so --timings reports on the whole batch at once
+    try:
+      with stage("batch"):
+        failures = run_batch(lines, jobs)
+    finally:
+      # (we opened the file, so we close it -- but stdin isn't ours to close)
+      if lines is not sys.stdin: lines.close()
+      if timing: report_timings()
+    # exit with 1 if anything went wrong, just like a single query would
+    sys.exit(1 if failures else 0)
+
+  # "word -i" asks for queries itself
+  if interactive:
+    repl()
+    sys.exit()
+
+  # "word serve" starts a server instead of looking anything up
+  if len(args) and args[0] == "serve":
+    port = convert_num(args[1]) if len(args) > 1 else None
+    serve(int(port) if port else SERVE_PORT)
+    sys.exit()
+
+  # "word build-index" compiles a word list for spelled like (see word_index.py)
+  if len(args) and args[0] == "build-index":
+    build_index(args[1] if len(args) > 1 else None)
+    sys.exit()
+
+  # if all we got was flags, there's nothing to look up
+  if len(args) == 0:
+    print(USAGE)
+    sys.exit()
 
   # here's the "heart" of the program <3
-  # 1. turn the user input into a usable web address
-  query = parse(args, {})
-  # 2. go get data from that web address
-  responses = go_fetch(query)
-  # 3. print out the response we got back from the internet
-  print_response(responses)
+  # (the "with stage" lines time each step, for --timings)
+  responses = None
+  try:
+    # 1. turn the user input into a usable web address
+    with stage("parse"):
+      query = parse(args, {})
+    # 2. go get data from that web address
+    with stage("fetch"):
+      responses = go_fetch(query)
+    # 3. print out the response we got back from the internet
+    with stage("print"):
+      print_response(responses)
+  # print_response() can sys.exit(), so report the timings on the way out no matter what
+  finally:
+    if timing: report_timings(responses)
+
+#
+#### END HELPER FUNCTIONS
+
+if __name__ == "__main__":
+
+  # sys.argv is a list of stuff you typed to start the program
+  # if you typed "word.py --help" you get sys.argv == ["word.py","--help"]
+  # so sys.argv[1:] (everything from the second element on) is what you asked for
+
+  # if "word serve" is already running, let it answer -- it's already warmed up
+  status = forward_to_server(sys.argv[1:])
+  if status is not None:
+    sys.exit(status)
+
+  # otherwise, do all the work ourselves (see main() above)
+  main(sys.argv[1:])
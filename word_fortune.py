@@ -0,0 +1,137 @@
+#!/usr/bin/env python3.6
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# What the heck is this file? :D
+# when word finds nothing, it gives you a fortune cookie instead
+# it used to start the "fortune" program (or ask a website) for one, which is slow --
+# and if the website never answered, word never finished
+# but the fortunes that "fortune" prints are just files on your computer, so this file
+# reads them itself: no other program, no internet, and about as fast as opening a file
+#
+# a fortune file is plain text, with a line containing only % between fortunes:
+#
+#   Don't Panic.
+#   %
+#   A journey of a thousand miles begins with a cheap tank of gas.
+#   %
+#
+# next to each one is a .dat file made by a program called strfile, which says where
+# every fortune starts -- so we can jump straight to fortune number 1234 without
+# reading the 1233 before it
+
+# get code from other libraries that we'll need
+import os, mmap, random, struct
+
+# where fortune files usually live (set WORD_FORTUNES to look somewhere else --
+# several places can go in it, separated by : like PATH)
+FORTUNE_DIRS = [d for d in os.environ.get("WORD_FORTUNES", "").split(os.pathsep) if d] or [
+  "/usr/share/games/fortunes", "/usr/share/fortune", "/usr/share/fortunes",
+  "/usr/games/lib/fortunes", "/usr/local/share/games/fortunes", "/opt/homebrew/share/games/fortunes"]
+
+# "fortune -s" means short fortunes: 160 letters or fewer
+SHORT = 160
+
+# The .dat format
+# a header of six big endian ("network order", ">" in struct) numbers:
+#   version, how many fortunes, the longest, the shortest, flags,
+#   and the delimiter (usually %) followed by 3 bytes of padding
+# then where each fortune starts in the text file (one more than there are fortunes,
+# so the last one says where the file ends) -- 4 bytes each, or 8 on some newer systems
+HEADER = struct.Struct(">IIIIIc3x")
+# flags: the fortunes are rot13'd (a silly code, used to hide the rude ones)
+ROTATED = 0x4
+
+class FortuneFile(object):
+  """ One fortune file and its .dat index. """
+
+  def __init__(self, text, index):
+    # text and index are anything that acts like bytes -- usually mmaps of the two files
+    version, self.count, longest, shortest, flags, self.delimiter = HEADER.unpack_from(index)
+    self.rotated = bool(flags & ROTATED)
+    self.text, self.index = text, index
+    # work out how big each offset is from the size of the file
+    width = (len(index) - HEADER.size) // (self.count + 1) if self.count else 4
+    if width not in (4, 8): raise ValueError("not a strfile .dat file")
+    self.offset = struct.Struct(">I" if width == 4 else ">Q")
+
+  @classmethod
+  def from_file(cls, path):
+    """ Map a fortune file (and the .dat next to it) into memory. """
+    maps = []
+    for name in (path, path + ".dat"):
+      with open(name, "rb") as f:
+        # the mmap keeps working after the file is closed
+        maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return cls(*maps)
+
+  def span(self, i):
+    """ Where fortune number i starts and ends in the text file. """
+    start = self.offset.unpack_from(self.index, HEADER.size + i * self.offset.size)[0]
+    end = self.offset.unpack_from(self.index, HEADER.size + (i + 1) * self.offset.size)[0]
+    return start, end
+
+  def fortune(self, i):
+    """ Fortune number i, as text. """
+    start, end = self.span(i)
+    text = bytes(self.text[start:end]).decode("utf-8", errors="replace")
+    # every fortune but the last ends with its % line, so cut that off
+    lines = text.rstrip("\n").split("\n")
+    if lines and lines[-1] == self.delimiter.decode("ascii", errors="replace"): lines.pop()
+    text = "\n".join(lines).strip("\n")
+    if self.rotated:
+      import codecs
+      text = codecs.decode(text, "rot13")
+    return text
+
+def find_files(dirs=None):
+  """ Every fortune file with a .dat file next to it (except the rude ones). """
+  found = []
+  for directory in dirs or FORTUNE_DIRS:
+    try:
+      names = sorted(os.listdir(directory))
+    except OSError:
+      continue
+    for name in names:
+      path = os.path.join(directory, name)
+      # (we don't look inside folders, so the rude ones in "off" -- for offensive -- stay there)
+      if name.endswith(".dat") and os.path.isfile(path[:-4]):
+        found.append(path[:-4])
+  return found
+
+class Fortunes(object):
+  """ All the fortune files we found, for picking a random fortune. """
+
+  def __init__(self, files):
+    # the rot13 ones are the rude ones too
+    self.files = [f for f in files if f.count and not f.rotated]
+    self.total = sum(f.count for f in self.files)
+
+  @classmethod
+  def from_dirs(cls, dirs=None):
+    """ Load every fortune file in dirs (or FORTUNE_DIRS). """
+    files = []
+    for path in find_files(dirs):
+      try:
+        files.append(FortuneFile.from_file(path))
+      # a broken file (or one we can't read) is skipped, not the end of the world
+      except (OSError, ValueError, struct.error):
+        pass
+    return cls(files)
+
+  def pick(self, short=SHORT, tries=100, rng=random):
+    """ A random fortune no longer than short letters (or None if there aren't any). """
+    # picking a random fortune and trying again if it's too long takes a few tries at most
+    # (most fortunes are short), and every try is just two numbers from the .dat file
+    for _ in range(tries if self.total else 0):
+      # every fortune has the same chance, whichever file it's in
+      n = rng.randrange(self.total)
+      for f in self.files:
+        if n < f.count: break
+        n -= f.count
+      start, end = f.span(n)
+      # +3 for the "%\n" line (and the newline before it), which isn't part of the fortune
+      if short is None or end - start <= short + 3:
+        text = f.fortune(n)
+        if text and (short is None or len(text) <= short): return text
+    return None
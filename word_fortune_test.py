@@ -0,0 +1,57 @@
+#!/usr/bin/env pytest
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# Tests for word_fortune.py (fortune cookies from strfile files)
+# run them with python -m pytest word_fortune_test.py
+
+import pytest, os, random, struct, codecs
+from word_fortune import Fortunes, FortuneFile, HEADER, ROTATED, find_files
+
+def strfile(path, fortunes, width=4, flags=0):
+  """ Write a fortune file and its .dat, like the strfile program does. """
+  text, offsets = b"", []
+  for fortune in fortunes:
+    offsets.append(len(text))
+    text += fortune.encode("utf-8") + b"\n%\n"
+  offsets.append(len(text))
+  lengths = [len(f) for f in fortunes]
+  with open(path, "wb") as f:
+    f.write(text)
+  with open(path + ".dat", "wb") as f:
+    f.write(HEADER.pack(2, len(fortunes), max(lengths), min(lengths), flags, b"%"))
+    f.write(struct.pack(">%d%s" % (len(offsets), "I" if width == 4 else "Q"), *offsets))
+
+SHORT_ONES = ["Don't Panic.", "You will meet a tall dark stranger.\nOr a short one."]
+LONG_ONE = "All work and no play makes Jack a dull boy. " * 10
+
+@pytest.fixture
+def folder(tmp_path):
+  strfile(str(tmp_path / "wisdom"), SHORT_ONES + [LONG_ONE])
+  strfile(str(tmp_path / "wide"), ["Eight bytes an offset."], width=8)
+  strfile(str(tmp_path / "rude"), [codecs.encode("Something rude.", "rot13")], flags=ROTATED)
+  # a fortune file without a .dat doesn't count
+  (tmp_path / "plain").write_text("No index here.\n%\n")
+  return str(tmp_path)
+
+class TestFortune(object):
+
+  def test_every_fortune_should_be_read_from_its_offset(self, folder):
+    wisdom = FortuneFile.from_file(folder + "/wisdom")
+    assert wisdom.count == 3
+    assert [wisdom.fortune(i) for i in range(3)] == SHORT_ONES + [LONG_ONE]
+    assert FortuneFile.from_file(folder + "/wide").fortune(0) == "Eight bytes an offset."
+    assert FortuneFile.from_file(folder + "/rude").fortune(0) == "Something rude."
+
+  def test_pick_should_only_give_short_polite_fortunes(self, folder):
+    assert [os.path.basename(path) for path in find_files([folder])] == ["rude", "wide", "wisdom"]
+    fortunes = Fortunes.from_dirs([folder])
+    assert fortunes.total == 4
+    picked = {fortunes.pick(rng=random.Random(seed)) for seed in range(50)}
+    assert picked == set(SHORT_ONES + ["Eight bytes an offset."])
+    assert fortunes.pick(short=None, tries=1000, rng=random.Random(1)) is not None
+
+  def test_no_fortunes_should_mean_none(self, tmp_path):
+    assert Fortunes.from_dirs([str(tmp_path / "nowhere")]).pick() is None
+    strfile(str(tmp_path / "long"), [LONG_ONE])
+    assert Fortunes.from_dirs([str(tmp_path)]).pick() is None
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3.6
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# What the heck is this file? :D
+# "word spelled like 'cens?r'" doesn't need datamuse to be clever, it just needs a list
+# of words and a way to check which ones fit the pattern
+# checking every word in a big list one at a time is slow-ish, though, and so is reading
+# the whole list every time word starts up
+# so "word build-index" turns a list of words into one binary file that's
+# a) already sorted and indexed, so a pattern only has to check a few hundred words
+# b) read with mmap, so starting up doesn't read the file at all -- the operating system
+#    fetches the bits we touch (and shares them between every word that's running)
+
+# get code from other libraries that we'll need
+import os, re, sys, mmap, struct
+from array import array
+from bisect import bisect_left
+from word_lexicon import syllables, wildcard
+
+# where the index lives (set WORD_INDEX to put it somewhere else)
+INDEX_FILE = os.environ.get("WORD_INDEX") or \
+             os.path.join(os.environ.get("XDG_DATA_HOME") or
+                          os.path.join(os.path.expanduser("~"), ".local", "share"),
+                          "dusty-word", "words.idx")
+
+# The file format
+# every file starts with the same 8 letters, so we can tell it's really ours
+# (the 1 at the end is the version -- change it whenever the format changes)
+MAGIC = b"WORDIDX1"
+# then the header: which byte order the numbers are in, and where each "section" starts
+# (a section is one big array -- "<" means the header itself is always little endian)
+SECTIONS = ["offsets", "strings", "syllables", "by_length", "length_starts",
+            "grams", "gram_offsets", "postings", "posting_starts"]
+HEADER = struct.Struct("<8s8s" + "QQ" * len(SECTIONS))
+# what's in the sections:
+#   strings         every word, in alphabetical order, squashed together (utf-8)
+#   offsets         where each word starts in strings (word 7 is strings[offsets[7]:offsets[8]])
+#   syllables       how many syllables each word has (0 if we don't know)
+#   by_length       the word numbers again, shortest words first
+#   length_starts   where each length starts in by_length (5 letter words are
+#                   by_length[length_starts[5]:length_starts[6]])
+#   grams           every "trigram" (3 letters in a row) of every word, sorted and squashed
+#                   together (we put ^ and $ on the ends of a word, so "cat" has ^ca cat at$)
+#   gram_offsets    where each trigram starts in grams (just like offsets)
+#   postings        for each trigram, the numbers of the words that have it
+#   posting_starts  where each trigram's list of words starts in postings
+# all the numbers are 4 byte unsigned ints ("I" in array and struct)
+
+def trigrams(text):
+  """ Every 3 letters in a row (as a set, so each one only counts once). """
+  return {text[i:i+3] for i in range(len(text) - 2)}
+
+def read_wordlist(lines):
+  """ Read a word list (one word per line), or a cmudict file. Gives back (word, syllables). """
+  for line in lines:
+    if not line.strip() or line.startswith(";;;"): continue
+    parts = line.split("#")[0].split()
+    if not parts: continue
+    # "read(2)" is just another way to say "read"
+    word = re.sub(r'\(\d+\)$', '', parts[0]).lower()
+    # cmudict lines have the sounds after the word, and then we can count syllables
+    sounds = parts[1:]
+    if sounds and all(re.match(r'^[A-Z]+[012]?$', p) for p in sounds):
+      yield word, syllables(sounds)
+    else:
+      yield word, 0
+
+def build(entries, path=INDEX_FILE):
+  """ Write an index of (word, syllables) entries to path. Returns how many words it has. """
+  counts = {}
+  for word, count in entries:
+    # the first pronunciation of a word wins (just like in word_lexicon.py)
+    if word not in counts: counts[word] = count
+  words = sorted(counts)
+  sections = dict((name, array("I")) for name in SECTIONS)
+  strings = bytearray()
+  for word in words:
+    sections["offsets"].append(len(strings))
+    strings += word.encode("utf-8")
+  sections["offsets"].append(len(strings))
+  sections["strings"] = strings
+  sections["syllables"] = bytearray(min(counts[word], 255) for word in words)
+
+  # sort the word numbers by length, and remember where each length starts
+  by_length = sorted(range(len(words)), key=lambda i: len(words[i]))
+  sections["by_length"].extend(by_length)
+  lengths = [len(words[i]) for i in by_length]
+  longest = lengths[-1] if words else 0
+  sections["length_starts"].extend(bisect_left(lengths, length) for length in range(longest + 2))
+
+  # the trigram postings -- words are added in order, so every list comes out sorted
+  postings = {}
+  for i, word in enumerate(words):
+    for gram in trigrams("^" + word + "$"):
+      postings.setdefault(gram.encode("utf-8"), array("I")).append(i)
+  grams = bytearray()
+  # sort by the bytes (not the letters), because that's how posting() will search them
+  for gram in sorted(postings):
+    sections["gram_offsets"].append(len(grams))
+    grams += gram
+    sections["posting_starts"].append(len(sections["postings"]))
+    sections["postings"].extend(postings[gram])
+  sections["gram_offsets"].append(len(grams))
+  sections["posting_starts"].append(len(sections["postings"]))
+  sections["grams"] = grams
+
+  # write to a temporary file and then swap it in, so a word that's running right now
+  # never sees half an index
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  temporary = path + ".tmp"
+  with open(temporary, "wb") as f:
+    f.write(bytes(HEADER.size))
+    places = []
+    for name in SECTIONS:
+      # line every section up on 8 bytes, which memoryview.cast() likes
+      f.write(bytes(-f.tell() % 8))
+      data = sections[name]
+      places += [f.tell(), len(data) * getattr(data, "itemsize", 1)]
+      f.write(data)
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, sys.byteorder.encode("ascii").ljust(8), *places))
+  os.replace(temporary, path)
+  return len(words)
+
+class WordIndex(object):
+  """ A word list built by build(), for answering spelled like patterns. """
+
+  # the "url" we put on our answers, so -vv can say where they came from
+  name = "index"
+
+  def __init__(self, data):
+    # data is anything that acts like bytes -- usually an mmap of the file
+    magic, byteorder, *places = HEADER.unpack_from(data)
+    if magic != MAGIC:
+      raise ValueError("not a word index (or an old one -- run word build-index again)")
+    # the numbers are in this computer's byte order, so an index from a different kind
+    # of computer has to be rebuilt
+    if byteorder.strip() != sys.byteorder.encode("ascii"):
+      raise ValueError("this index was built on a different kind of computer")
+    view = memoryview(data)
+    for n, name in enumerate(SECTIONS):
+      start, size = places[2 * n], places[2 * n + 1]
+      section = view[start:start + size]
+      # cast() lets us treat the bytes as an array of ints, without copying anything
+      if name not in ("strings", "grams", "syllables"): section = section.cast("I")
+      setattr(self, name, section)
+    self.size = len(self.offsets) - 1
+
+  @classmethod
+  def from_file(cls, path=INDEX_FILE):
+    """ Map an index file into memory. """
+    with open(path, "rb") as f:
+      # the mmap keeps working after the file is closed
+      return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+  def word(self, i):
+    """ Word number i. """
+    return str(self.strings[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+  def posting(self, gram):
+    """ The (sorted) numbers of every word containing gram, or None if no word does. """
+    gram = gram.encode("utf-8")
+    # binary search through the sorted trigrams
+    low, high = 0, len(self.gram_offsets) - 1
+    while low < high:
+      middle = (low + high) // 2
+      if bytes(self.grams[self.gram_offsets[middle]:self.gram_offsets[middle + 1]]) < gram:
+        low = middle + 1
+      else:
+        high = middle
+    if low == len(self.gram_offsets) - 1 or \
+       bytes(self.grams[self.gram_offsets[low]:self.gram_offsets[low + 1]]) != gram:
+      return None
+    return self.postings[self.posting_starts[low]:self.posting_starts[low + 1]]
+
+  def first_after(self, prefix):
+    """ The number of the first word that comes at or after prefix in alphabetical order. """
+    low, high = 0, self.size
+    while low < high:
+      middle = (low + high) // 2
+      if bytes(self.strings[self.offsets[middle]:self.offsets[middle + 1]]) < prefix:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def candidates(self, pattern):
+    """ Word numbers that might match pattern (all the words that do are in there). """
+    # also says whether they're shortest first, because then answer() can stop early
+    # the letters between the wildcards have to be in the word, and so do their trigrams
+    # e.g. cens?r  ->  ^cens and r$  ->  ^ce cen ens
+    grams = set()
+    for letters in re.split(r'[?*]', "^" + pattern + "$"):
+      grams |= trigrams(letters)
+    lists = []
+    for gram in grams:
+      posting = self.posting(gram)
+      # a trigram that no word has means no word can match
+      if posting is None: return [], False
+      lists.append(posting)
+    if lists:
+      # start with the shortest list, and keep the numbers that are in all the others
+      # (they're sorted, so bisect can find a number without reading the whole list)
+      lists.sort(key=len)
+      found = []
+      for i in lists[0]:
+        for other in lists[1:]:
+          at = bisect_left(other, i)
+          if at == len(other) or other[at] != i: break
+        else:
+          found.append(i)
+      return found, False
+    # no trigrams (a pattern like ??? or s*r), so try the words with the right length...
+    shortest = len(pattern.replace("*", ""))
+    most = len(self.length_starts) - 2
+    if shortest > most: return [], False
+    longest = shortest if "*" not in pattern else most
+    by_length = self.by_length[self.length_starts[shortest]:self.length_starts[longest + 1]]
+    # ...or the words starting with the right letters (they're next to each other, because
+    # the words are in alphabetical order) -- whichever is fewer
+    # (utf-8 never uses the byte 255, so prefix + 255 comes after every word starting with prefix)
+    prefix = re.split(r'[?*]', pattern)[0].encode("utf-8")
+    if prefix:
+      first, last = self.first_after(prefix), self.first_after(prefix + b"\xff")
+      if last - first < len(by_length): return range(first, last), False
+    return by_length, True
+
+  def can_answer(self, query):
+    """ Only spelled like, and only with wildcards (without them it means "fix my spelling"). """
+    asks = [param for param in query if param not in ("max", "md")]
+    return (asks == ["sp"] and query.get("md", "s") == "s" and
+            re.search(r'[?*]', query["sp"]) is not None)
+
+  def answer(self, query):
+    """ Answer a datamuse query. Returns a list like datamuse's, or None if we can't. """
+    if not self.can_answer(query): return None
+    pattern = query["sp"].lower()
+    rx = wildcard(pattern)
+    limit = int(query.get("max", 100))
+    candidates, shortest_first = self.candidates(pattern)
+    matches = []
+    for i in candidates:
+      word = self.word(i)
+      if rx.match(word):
+        matches.append((len(word), i, word))
+        # shortest first means the first few matches are the best ones
+        if shortest_first and len(matches) == limit: break
+    # shortest words first, then alphabetical (which is the order the numbers are in)
+    entries = []
+    for length, i, word in sorted(matches)[:limit]:
+      entry = {"word": word, "score": 100}
+      if self.syllables[i]: entry["numSyllables"] = self.syllables[i]
+      entries.append(entry)
+    return entries
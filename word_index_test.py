@@ -0,0 +1,57 @@
+#!/usr/bin/env pytest
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# Tests for word_index.py (the compiled spelling index)
+# run them with python -m pytest word_index_test.py
+
+import pytest, re
+from word_index import WordIndex, build, read_wordlist
+
+WORDS = ["censor", "censer", "sensor", "cancer", "cat", "at", "a", "cats", "scat",
+         "horse", "norse", "course", "coarse", "naïve", "zebra"]
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+  path = str(tmp_path_factory.mktemp("index") / "words.idx")
+  build(((w, 0) for w in WORDS), path)
+  return WordIndex.from_file(path)
+
+class TestIndex(object):
+
+  def words(self, entries):
+    return [entry["word"] for entry in entries]
+
+  def test_every_word_should_be_in_the_index(self, index):
+    assert index.size == len(WORDS)
+    assert sorted(index.word(i) for i in range(index.size)) == sorted(WORDS)
+
+  def test_patterns_should_match_the_same_words_as_a_regex(self, index):
+    for pattern in ["cens?r", "*rse", "c*", "?", "??", "*", "*at*", "na?ve", "s*r",
+                    "?at", "ca?*", "*a", "xyz*", "??????????*"]:
+      rx = re.compile("^" + re.escape(pattern).replace(r"\?", ".").replace(r"\*", ".*") + "$")
+      expected = sorted((w for w in WORDS if rx.match(w)), key=lambda w: (len(w), w))
+      assert self.words(index.answer({"sp": pattern, "max": 100})) == expected, pattern
+
+  def test_max_should_be_obeyed(self, index):
+    assert self.words(index.answer({"sp": "*", "max": 3})) == ["a", "at", "cat"]
+
+  def test_only_spelling_patterns_should_be_answered(self, index):
+    assert index.answer({"sp": "censor"}) is None
+    assert index.answer({"sp": "c*", "rel_rhy": "horse"}) is None
+    assert index.answer({"sp": "c*", "md": "dr"}) is None
+
+  def test_cmudict_files_should_give_syllables(self, tmp_path):
+    path = str(tmp_path / "words.idx")
+    build(read_wordlist(["culminate  K AH1 L M AH0 N EY2 T", "read  R EH1 D", "read(2)  R IY1 D",
+                         "platypus's"]), path)
+    index = WordIndex.from_file(path)
+    assert index.answer({"sp": "*"}) == [{"word": "read", "score": 100, "numSyllables": 1},
+                                         {"word": "culminate", "score": 100, "numSyllables": 3},
+                                         {"word": "platypus's", "score": 100}]
+
+  def test_other_files_should_be_refused(self, tmp_path):
+    path = tmp_path / "words.idx"
+    path.write_bytes(b"not an index" * 20)
+    with pytest.raises(ValueError):
+      WordIndex.from_file(str(path))
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3.6
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# What the heck is this file? :D
+# word usually asks datamuse (a website) for everything
+# that's great, until you're on a plane, or you've asked it ten thousand questions today
+# this file lets word answer some questions by itself, from a pronouncing dictionary
+# (a big list of words and how to say them) that lives on your computer
+#
+# it answers the same questions datamuse does, in the same shape:
+#   rhymes with norse          rel_rhy
+#   almost rhymes with norse   rel_nry
+#   sounds like doe            sl
+#   sounds like doe but...     rel_hom
+#   spelled like 'cens?r'      sp
+# and it hands back the same kind of list datamuse does:
+#   [{"word": "horse", "score": 110, "numSyllables": 1}, ...]
+# so print_response() in word.py can print it without knowing the difference
+
+# get code from other libraries that we'll need
+import os, re
+
+# The pronouncing dictionary
+# word reads the format of the CMU Pronouncing Dictionary (cmudict), which is free:
+# https://github.com/cmusphinx/cmudict
+# each line is a word and its sounds ("phonemes"), like this:
+#
+#   horse  HH AO1 R S
+#   read  R EH1 D
+#   read(2)  R IY1 D
+#
+# the numbers on the vowels are stress: 1 is the loud syllable, 2 is a bit loud, 0 is quiet
+# (say "CUL-mi-nate" -- K AH1 L M AH0 N EY2 T)
+# a word with two pronunciations gets two lines, the second one is called word(2)
+# put it in ~/.local/share/dusty-word/cmudict.dict, or set WORD_LEXICON to where it is
+LEXICON_FILE = os.environ.get("WORD_LEXICON") or \
+               os.path.join(os.environ.get("XDG_DATA_HOME") or
+                            os.path.join(os.path.expanduser("~"), ".local", "share"),
+                            "dusty-word", "cmudict.dict")
+
+# how common each word is, so the common rhymes come first (this one is optional)
+# one word per line, with how many times it was seen ("the 23135851162"), or just the
+# words, most common first -- any word frequency list will do
+FREQUENCY_FILE = os.environ.get("WORD_FREQUENCIES") or \
+                 os.path.join(os.path.dirname(LEXICON_FILE), "frequencies.txt")
+
+# the datamuse parameters this file knows how to answer
+# (it also understands max, and md=s -- syllables -- which it always sends anyway)
+ANSWERS = ("rel_rhy", "rel_nry", "sl", "rel_hom", "sp")
+
+def read_cmudict(lines):
+  """ Read cmudict lines, and give back (word, phonemes) for each one. """
+  for line in lines:
+    # lines starting with ;;; are comments
+    if not line.strip() or line.startswith(";;;"): continue
+    # some versions put comments at the end of a line too: "word  W ER1 D # a comment"
+    parts = line.split("#")[0].split()
+    if len(parts) < 2: continue
+    # "read(2)" is just another way to say "read"
+    word = re.sub(r'\(\d+\)$', '', parts[0]).lower()
+    yield word, tuple(parts[1:])
+
+def is_vowel(phoneme):
+  """ Vowels are the phonemes with a stress number on the end. """
+  return phoneme[-1].isdigit()
+
+def unstressed(phonemes):
+  """ The phonemes without their stress numbers (AO1 -> AO). """
+  return tuple(p.rstrip("012") for p in phonemes)
+
+def rhyme_key(phonemes):
+  """ The part of a word that has to match for a perfect rhyme. """
+  # that's everything from the last stressed vowel to the end
+  # horse  HH [AO1 R S]         culminate  K AH1 L M AH0 N [EY2 T]
+  # (if nothing is stressed, like "the", we use the last vowel)
+  vowels = [i for i, p in enumerate(phonemes) if is_vowel(p)]
+  if not vowels: return None
+  stressed = [i for i in vowels if phonemes[i][-1] in "12"]
+  start = stressed[-1] if stressed else vowels[-1]
+  return unstressed(phonemes[start:])
+
+def near_key(phonemes):
+  """ The part of a word that has to match for a near rhyme: just the vowels of the rhyme. """
+  # horse [AO] R S, north [AO] R TH, and born [AO] R N all have the key (AO,)
+  # culminate [EY] T and pain [EY] N have (EY,)
+  key = rhyme_key(phonemes)
+  return key and tuple(p for p in key if p in VOWELS)
+
+def read_frequencies(lines):
+  """ Read a word frequency list, and give back (word, how common it is) for each word. """
+  lines = list(lines)
+  for rank, line in enumerate(lines):
+    parts = line.split()
+    if not parts: continue
+    try:
+      count = float(parts[1])
+    # no count means the list is in order, most common first
+    except (IndexError, ValueError):
+      count = len(lines) - rank
+    yield parts[0].lower(), count
+
+def loose_key(phonemes):
+  """ A fuzzier version of the pronunciation, for "sounds like". """
+  # every vowel counts as the same sound, so "tongue" (T AH1 NG) and "tang" (T AE1 NG)
+  # get the same key, T V NG
+  return tuple("V" if is_vowel(p) else p for p in phonemes)
+
+def shared_ending(a, b):
+  """ How many sounds two pronunciations have in common at the end. """
+  a, b = unstressed(a), unstressed(b)
+  count = 0
+  # a[-1] is the last item in a, a[-2] the one before it, and so on
+  while count < min(len(a), len(b)) and a[-1 - count] == b[-1 - count]:
+    count += 1
+  return count
+
+def syllables(phonemes):
+  """ Every syllable has exactly one vowel sound in it, so count the vowels. """
+  return sum(1 for p in phonemes if is_vowel(p))
+
+# Sounds like
+# "sounds like" is fuzzy: tongue sounds a lot like tang, a bit like tonic, and not at all
+# like horse -- so instead of a yes or no, we measure how far apart two words sound,
+# by counting how many sounds you'd have to change, add or take away to get from one to
+# the other (the "edit distance" -- tongue to tang is one change, AH -> AE)
+# some changes are smaller than others: swapping a vowel, or a sound for its "partner"
+# (P and B are the same shape of your mouth, B just adds your voice), only counts half
+SOUND_GROUPS = [("P", "B"), ("T", "D"), ("K", "G"), ("F", "V"), ("TH", "DH"), ("S", "Z"),
+                ("SH", "ZH"), ("CH", "JH"), ("M", "N", "NG"), ("L", "R"), ("W", "Y")]
+PARTNERS = {sound: group[0] for group in SOUND_GROUPS for sound in group}
+# the vowel sounds (without their stress numbers)
+VOWELS = {"AA", "AE", "AH", "AO", "AW", "AY", "EH", "ER", "EY", "IH", "IY", "OW", "OY", "UH", "UW"}
+# how much each kind of change costs
+SAME_GROUP = 0.5
+DIFFERENT = 1.0
+ADD_OR_REMOVE = 1.0
+# words further apart than this don't sound alike (2 is two whole sounds)
+SOUNDS_LIKE_BOUND = 2.0
+
+def change_cost(a, b):
+  """ How much it costs to change sound a into sound b (both without stress numbers). """
+  if a == b: return 0
+  if (a in VOWELS and b in VOWELS) or PARTNERS.get(a, a) == PARTNERS.get(b, b): return SAME_GROUP
+  return DIFFERENT
+
+def distance(a, b, bound=SOUNDS_LIKE_BOUND, cost=change_cost):
+  """ The weighted edit distance from a to b, or None if it's more than bound. """
+  # the usual way to work this out fills in a table with a row for every sound in a and a
+  # column for every sound in b: table[i][j] is the distance from a[:i] to b[:j]
+  # but every add or remove costs ADD_OR_REMOVE, so a path through the table that wanders
+  # more than bound / ADD_OR_REMOVE columns off the diagonal already costs too much
+  # -- so we only fill in a narrow "band" along the diagonal, and stop as soon as a whole
+  # row is over the bound (that's what makes it quick enough to run on every candidate)
+  if abs(len(a) - len(b)) * ADD_OR_REMOVE > bound: return None
+  band = int(bound / ADD_OR_REMOVE)
+  far = float("inf")
+  previous = [j * ADD_OR_REMOVE if j <= band else far for j in range(len(b) + 1)]
+  for i in range(1, len(a) + 1):
+    row = [far] * (len(b) + 1)
+    if i <= band: row[0] = i * ADD_OR_REMOVE
+    for j in range(max(1, i - band), min(len(b), i + band) + 1):
+      row[j] = min(previous[j - 1] + cost(a[i - 1], b[j - 1]),   # change a sound
+                   previous[j] + ADD_OR_REMOVE,                   # take one away
+                   row[j - 1] + ADD_OR_REMOVE)                    # add one
+    if min(row) > bound: return None
+    previous = row
+  return previous[-1] if previous[-1] <= bound else None
+
+def skeleton(phonemes):
+  """ The consonants of a pronunciation, with every sound swapped for its group. """
+  # tongue (T AH1 NG) -> T M, and so does tonne (T AH1 N) -- for finding candidates quickly
+  return tuple(PARTNERS.get(p, p) for p in unstressed(phonemes) if p not in VOWELS)
+
+def metaphone(word):
+  """ A rough "how it sounds" code for a spelling (Lawrence Philips' Metaphone, 1990). """
+  # this is for words that aren't in the pronouncing dictionary -- we can't look up their
+  # sounds, so we guess from the letters: "tung" -> TNK, and so is "tongue"
+  # (0 is the th sound, X is sh, and only a vowel at the start is kept)
+  word = re.sub(r'[^a-z]', '', word.lower())
+  if not word: return ""
+  # some pairs at the start only sound like their second letter (knight, gnome, wrong)
+  if word[:2] in ("kn", "gn", "pn", "ae", "wr"): word = word[1:]
+  if word[0] == "x": word = "s" + word[1:]
+  if word[:2] == "wh": word = "w" + word[2:]
+  vowels = "aeiou"
+  code = []
+  for i, letter in enumerate(word):
+    before = word[i - 1] if i else ""
+    after = word[i + 1:i + 3]
+    # double letters sound like one (except cc, as in "accent")
+    if letter == before and letter != "c": continue
+    if letter in vowels:
+      if i == 0: code.append(letter.upper())
+    elif letter == "b":
+      # the b in "dumb" is silent
+      if not (before == "m" and i == len(word) - 1): code.append("B")
+    elif letter == "c":
+      if after[:1] == "h" or after[:2] in ("ia",): code.append("K" if before == "s" else "X")
+      elif after[:1] in ("i", "e", "y"):
+        if before != "s": code.append("S")
+      else: code.append("K")
+    elif letter == "d":
+      code.append("J" if after[:2] in ("ge", "gy", "gi") else "T")
+    elif letter == "g":
+      # silent in "night" and "gnome" and "signed", soft in "gem", hard everywhere else
+      if after[:1] == "h" and i + 2 < len(word) and word[i + 2] not in vowels: continue
+      if after in ("n", "ne") or word[i + 1:] in ("n", "ned"): continue
+      # and the dge in "judge" is just one J (which d already said)
+      if before == "d" and after[:1] in ("i", "e", "y"): continue
+      code.append("J" if after[:1] in ("i", "e", "y") and before != "g" else "K")
+    elif letter == "h":
+      # silent after a vowel with no vowel after it (ah), and in ch, sh, ph, th, gh
+      if before in "csptg" and before: continue
+      if before in vowels and before and after[:1] not in vowels: continue
+      code.append("H")
+    elif letter == "k":
+      if before != "c": code.append("K")
+    elif letter == "p":
+      code.append("F" if after[:1] == "h" else "P")
+    elif letter == "q": code.append("K")
+    elif letter == "s":
+      code.append("X" if after[:1] == "h" or after[:2] in ("io", "ia") else "S")
+    elif letter == "t":
+      if after[:2] in ("io", "ia"): code.append("X")
+      elif after[:1] == "h": code.append("0")
+      elif after[:2] != "ch": code.append("T")
+    elif letter == "v": code.append("F")
+    elif letter in "wy":
+      if after[:1] in vowels and after: code.append(letter.upper())
+    elif letter == "x": code.extend("KS")
+    elif letter == "z": code.append("S")
+    else: code.append(letter.upper())
+  return "".join(code)
+
+def wildcard(pattern):
+  """ Turn datamuse's spelling pattern into a regular expression. """
+  # datamuse patterns use ? for "any one letter" and * for "any number of letters"
+  # re.escape() makes sure any other punctuation means itself, then we swap those two back in
+  # cens?r  ->  ^cens.r$
+  return re.compile("^" + re.escape(pattern).replace(r"\?", ".").replace(r"\*", ".*") + "$")
+
+class Lexicon(object):
+  """ A pronouncing dictionary, plus indexes for looking things up in it quickly. """
+
+  # the "url" we put on our answers, so -vv can say where they came from
+  name = "lexicon"
+
+  def __init__(self, entries, frequencies=()):
+    # an index is a dictionary from a key to every word with that key, e.g.
+    #   rhymes[("AO", "R", "S")] == ["coarse", "course", "force", "horse", "norse", ...]
+    # building them is slow-ish (once), but then every lookup is a single dictionary lookup
+    self.sounds = {}           # word -> list of its pronunciations
+    self.rhymes = {}           # rhyme_key -> words
+    self.homophones = {}       # pronunciation without stress -> words
+    self.loose = {}            # loose_key -> words
+    self.spellings = {}        # (length, first letter) -> words, for spelled like
+    self.near = {}             # near_key -> words, for almost rhymes with
+    self.frequency = dict(frequencies)
+    # the rhymes, sorted the first time somebody asks for them (see ranked())
+    self.sorted = {}
+    # and two more for sounds like, which are only made if somebody asks (see phonetic_index)
+    self.skeletons = None      # skeleton -> words
+    self.metaphones = None     # metaphone code of the spelling -> words
+    for word, phonemes in entries:
+      if word not in self.sounds:
+        self.sounds[word] = []
+        self.spellings.setdefault((len(word), word[:1]), []).append(word)
+      self.sounds[word].append(phonemes)
+      for index, key in ((self.rhymes, rhyme_key(phonemes)),
+                         (self.near, near_key(phonemes)),
+                         (self.homophones, unstressed(phonemes)),
+                         (self.loose, loose_key(phonemes))):
+        if key is None: continue
+        words = index.setdefault(key, [])
+        # a word with two pronunciations could end up in the same place twice
+        if not words or words[-1] != word: words.append(word)
+
+  @classmethod
+  def from_file(cls, path=LEXICON_FILE, frequencies=FREQUENCY_FILE):
+    """ Load a cmudict-format file (and a word frequency list, if there is one). """
+    try:
+      with open(frequencies, encoding="utf-8", errors="replace") as f:
+        counts = list(read_frequencies(f))
+    # without one, the rhymes just come in alphabetical order
+    except OSError:
+      counts = []
+    # cmudict isn't all plain ascii, so be forgiving about strange characters
+    with open(path, encoding="utf-8", errors="replace") as f:
+      return cls(read_cmudict(f), counts)
+
+  def can_answer(self, query):
+    """ Does this query only ask for things we know how to look up? """
+    asks = [param for param in query if param not in ("max", "md")]
+    return (len(asks) > 0 and all(param in ANSWERS for param in asks) and
+            query.get("md", "s") == "s" and
+            # without any wildcards, spelled like means "fix my spelling" (we can't do that)
+            ("sp" not in query or re.search(r'[?*]', query["sp"]) is not None))
+
+  def answer(self, query):
+    """ Answer a datamuse query. Returns a list like datamuse's, or None if we can't. """
+    if not self.can_answer(query): return None
+    limit = int(query.get("max", 100))
+    # just rhymes (the most common question, by far) are already in order, so we only
+    # have to work out the scores of the ones we're giving back
+    asks = [param for param in query if param in ANSWERS]
+    if asks in (["rel_rhy"], ["rel_nry"]):
+      word = query[asks[0]].lower()
+      return [{"word": rhyme, "score": self.rhyme_score(word, rhyme),
+               "numSyllables": syllables(self.sounds[rhyme][0])}
+              for rhyme in self.rhymes_of(word, near=asks == ["rel_nry"])[:limit]]
+    # each constraint gives a {word: score} dictionary, and a word has to pass all of them
+    found = None
+    for param in ANSWERS:
+      if param not in query: continue
+      scores = getattr(self, "find_" + param)(query[param].lower())
+      if found is None:
+        found = scores
+      else:
+        found = {word: found[word] + scores[word] for word in found if word in scores}
+    # best score first, then shortest words, then alphabetical
+    best = sorted(found, key=lambda word: (-found[word], len(word), word))[:limit]
+    return [{"word": word, "score": found[word], "numSyllables": syllables(self.sounds[word][0])}
+            for word in best]
+
+  # the find_ functions each answer one datamuse parameter
+
+  def rank(self, word):
+    """ How to sort rhymes: fewest syllables first, then the most common, then a to z. """
+    return (syllables(self.sounds[word][0]), -self.frequency.get(word, 0), word)
+
+  def ranked(self, name, key):
+    """ One bucket of the rhymes (or near) index, sorted by rank(). """
+    # sorting a bucket only happens the first time, and after that it's one lookup
+    # (we make a new sorted list instead of sorting the old one, because another thread
+    #  might be reading it right now)
+    found = self.sorted.get((name, key))
+    if found is None:
+      found = self.sorted[(name, key)] = sorted(getattr(self, name).get(key, ()), key=self.rank)
+    return found
+
+  def rhymes_of(self, word, near=False):
+    """ Every word that rhymes with word (or almost rhymes), sorted by rank(). """
+    found = []
+    pronunciations = self.sounds.get(word, ())
+    for phonemes in pronunciations:
+      found += self.ranked("near", near_key(phonemes)) if near else \
+               self.ranked("rhymes", rhyme_key(phonemes))
+    perfect = set()
+    # near rhymes are the ones that *aren't* perfect (those are "rhymes with")
+    if near:
+      for phonemes in pronunciations:
+        perfect.update(self.rhymes.get(rhyme_key(phonemes), ()))
+    # a word doesn't rhyme with itself (or with a different spelling of itself)
+    # and a word with two pronunciations can find the same rhyme twice
+    found = [rhyme for rhyme in dict.fromkeys(found) if rhyme != word and rhyme not in perfect]
+    return sorted(found, key=self.rank) if len(pronunciations) > 1 else found
+
+  def rhyme_score(self, word, rhyme):
+    """ 100, plus 10 for every sound the two words share at the end. """
+    # rhymes that share even more sounds score higher ("course" is closer to "coarse"
+    # than to "force", because the K matches too)
+    return 100 + 10 * max(shared_ending(mine, theirs) for mine in self.sounds[word]
+                                                      for theirs in self.sounds[rhyme])
+
+  def find_rel_rhy(self, word):
+    """ Perfect rhymes: the same sounds from the last stressed vowel on (horse, norse). """
+    return {rhyme: self.rhyme_score(word, rhyme) for rhyme in self.rhymes_of(word)}
+
+  def find_rel_nry(self, word):
+    """ Near rhymes: the same vowels from the last stressed vowel on (horse, north). """
+    return {rhyme: self.rhyme_score(word, rhyme) for rhyme in self.rhymes_of(word, near=True)}
+
+  def find_rel_hom(self, word):
+    """ Homophones: exactly the same sounds, spelled differently (doe, dough). """
+    scores = {}
+    for phonemes in self.sounds.get(word, ()):
+      for other in self.homophones.get(unstressed(phonemes), ()):
+        if other != word: scores[other] = 100
+    return scores
+
+  def phonetic_index(self):
+    """ The indexes for sounds like, made the first time they're needed. """
+    # working out 130,000 metaphone codes takes a second or so, which rhymes and spelled
+    # like shouldn't have to wait for (and "word serve" only does it once)
+    if self.metaphones is None:
+      skeletons, metaphones = {}, {}
+      for word, pronunciations in self.sounds.items():
+        for phonemes in pronunciations:
+          words = skeletons.setdefault(skeleton(phonemes), [])
+          if not words or words[-1] != word: words.append(word)
+        metaphones.setdefault(metaphone(word), []).append(word)
+      # metaphones last, in a line of its own, because that's the one we check -- another
+      # thread that sees it has been set can be sure skeletons has been set too
+      self.skeletons = skeletons
+      self.metaphones = metaphones
+    return self.skeletons, self.metaphones
+
+  def find_sl(self, word):
+    """ Sounds like: the words that are the fewest sound changes away (exactly the same is 100). """
+    skeletons, metaphones = self.phonetic_index()
+    scores = {}
+    # a word the dictionary doesn't know can still be guessed from its spelling
+    if word not in self.sounds:
+      for other in metaphones.get(metaphone(word), ()):
+        # they all sound alike, so the ones that are spelled more alike come first
+        letters = distance(word, other, 4, lambda a, b: 0 if a == b else 1)
+        scores[other] = int(90 - 10 * letters) if letters is not None else 40
+      return scores
+    for phonemes in self.sounds[word]:
+      sounds = unstressed(phonemes)
+      # the candidates are every word in the same bucket of any of these indexes
+      # (every lookup is one dictionary lookup, so this is quick), then distance() sorts
+      # out which of them really sound alike, and how much
+      candidates = set(self.homophones.get(sounds, ()))
+      candidates.update(self.loose.get(loose_key(phonemes), ()))
+      candidates.update(skeletons.get(skeleton(phonemes), ()))
+      candidates.update(metaphones.get(metaphone(word), ()))
+      for other in candidates:
+        apart = [distance(sounds, unstressed(theirs)) for theirs in self.sounds[other]]
+        apart = [d for d in apart if d is not None]
+        if not apart: continue
+        # one change in a short word matters more than one change in a long word
+        score = round(100 * (1 - min(apart) / (len(sounds) + 1)))
+        scores[other] = max(scores.get(other, 0), score)
+    return scores
+
+  def find_sp(self, pattern):
+    """ Spelled like: words matching a pattern with ? and * in it. """
+    rx = wildcard(pattern)
+    first = pattern[:1]
+    # without a *, only words of exactly the right length can match
+    # and if the pattern starts with a real letter, only words starting with it
+    # so we only have to check those buckets, not the whole dictionary
+    buckets = [words for (length, letter), words in self.spellings.items()
+               if ("*" in pattern or length == len(pattern)) and
+                  (first in "?*" or letter == first)]
+    return {word: 100 for words in buckets for word in words if rx.match(word)}
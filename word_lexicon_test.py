@@ -0,0 +1,129 @@
+#!/usr/bin/env pytest
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# Tests for word_lexicon.py (the offline pronouncing dictionary)
+# run them with python -m pytest word_lexicon_test.py
+
+import pytest
+from word_lexicon import Lexicon, read_cmudict, read_frequencies, rhyme_key, near_key, loose_key, \
+                         distance, metaphone
+
+# a tiny pronouncing dictionary, so the tests don't need the real (big) one
+CMUDICT = """\
+;;; a comment line
+censor  S EH1 N S ER0
+censer  S EH1 N S ER0
+sensor  S EH1 N S ER0
+cancer  K AE1 N S ER0
+doe  D OW1
+dough  D OW1
+do  D UW1
+horse  HH AO1 R S
+whores  HH AO1 R Z
+norse  N AO1 R S
+force  F AO1 R S
+course  K AO1 R S
+coarse  K AO1 R S
+north  N AO1 R TH
+born  B AO1 R N
+culminate  K AH1 L M AH0 N EY2 T
+nominate  N AA1 M AH0 N EY2 T
+read  R EH1 D
+read(2)  R IY1 D
+red  R EH1 D
+reed  R IY1 D
+tongue  T AH1 NG
+tang  T AE1 NG
+"""
+
+# build it once, and share it between all the tests
+@pytest.fixture(scope="module")
+def lexicon():
+  return Lexicon(read_cmudict(CMUDICT.splitlines()))
+
+class TestLexicon(object):
+
+  def words(self, entries):
+    return [entry["word"] for entry in entries]
+
+  def test_cmudict_lines_should_be_read(self):
+    entries = list(read_cmudict(CMUDICT.splitlines()))
+    assert entries[0] == ("censor", ("S", "EH1", "N", "S", "ER0"))
+    # the second way to say read is still read
+    assert ("read", ("R", "IY1", "D")) in entries
+
+  def test_rhyme_key_should_start_at_the_last_stressed_vowel(self):
+    assert rhyme_key(("HH", "AO1", "R", "S")) == ("AO", "R", "S")
+    assert rhyme_key(("K", "AH1", "L", "M", "AH0", "N", "EY2", "T")) == ("EY", "T")
+    assert loose_key(("T", "AH1", "NG")) == loose_key(("T", "AE1", "NG"))
+
+  def test_rhymes_should_be_found(self, lexicon):
+    rhymes = self.words(lexicon.answer({"rel_rhy": "horse"}))
+    assert set(rhymes) == {"norse", "force", "course", "coarse"}
+    # "whores" doesn't rhyme with horse (it ends with a Z sound)
+    assert "whores" not in rhymes
+    assert self.words(lexicon.answer({"rel_rhy": "culminate"})) == ["nominate"]
+
+  def test_near_rhymes_should_only_need_the_same_vowels(self, lexicon):
+    assert near_key(("HH", "AO1", "R", "S")) == near_key(("N", "AO1", "R", "TH")) == ("AO",)
+    # the perfect rhymes (and the word itself) are left for "rhymes with"
+    assert set(self.words(lexicon.answer({"rel_nry": "horse"}))) == {"whores", "north", "born"}
+
+  def test_rhymes_should_come_common_ones_first(self):
+    counts = read_frequencies(["course 5000", "", "force\t300", "north 20.5"])
+    lexicon = Lexicon(read_cmudict(CMUDICT.splitlines()), counts)
+    assert self.words(lexicon.answer({"rel_rhy": "horse", "max": 3})) == ["course", "force", "coarse"]
+    assert self.words(lexicon.answer({"rel_nry": "horse"})) == ["north", "born", "whores"]
+    # a list without counts is most common first
+    assert list(read_frequencies(["the", "of"])) == [("the", 2), ("of", 1)]
+
+  def test_homophones_should_be_found(self, lexicon):
+    assert self.words(lexicon.answer({"rel_hom": "doe"})) == ["dough"]
+    # both ways of saying read count
+    assert set(self.words(lexicon.answer({"rel_hom": "read"}))) == {"red", "reed"}
+
+  def test_sounds_like_should_prefer_exact_sounds(self, lexicon):
+    entries = lexicon.answer({"sl": "tongue"})
+    assert entries[0]["word"] == "tongue"
+    assert "tang" in self.words(entries)
+
+  def test_sound_distance_should_be_weighted_and_bounded(self):
+    # a vowel, or a sound's partner (T and D), is half a change
+    assert distance(("T", "AH", "NG"), ("T", "AE", "NG")) == 0.5
+    assert distance(("T", "AH", "NG"), ("D", "AH", "NG")) == 0.5
+    assert distance(("K", "AE", "T"), ("K", "AE", "T", "S")) == 1
+    # more than the bound apart (or too different in length) gives up
+    assert distance(("T", "AH", "NG"), ("HH", "AO", "R", "S")) is None
+    assert distance(("D", "OW"), ("K", "AH", "L", "M", "AH", "N", "EY", "T")) is None
+    assert distance(tuple("kitten"), tuple("sitting"), 3, lambda a, b: int(a != b)) == 3
+
+  def test_metaphone_should_code_spellings_by_sound(self):
+    assert metaphone("tung") == metaphone("tongue") == "TNK"
+    assert metaphone("knight") == metaphone("night") == "NT"
+    assert metaphone("phone") == metaphone("fone") == "FN"
+    assert metaphone("school") == "SKL" and metaphone("thumb") == "0M"
+
+  def test_sounds_like_should_rank_by_how_close_it_sounds(self, lexicon):
+    entries = lexicon.answer({"sl": "reed"})
+    assert [(entry["word"], entry["score"]) for entry in entries] == [("read", 100), ("reed", 100), ("red", 88)]
+    # words that aren't in the dictionary are guessed from their spelling
+    assert set(self.words(lexicon.answer({"sl": "tung"}))) == {"tang", "tongue"}
+
+  def test_spelled_like_should_match_wildcards(self, lexicon):
+    assert set(self.words(lexicon.answer({"sp": "cens?r"}))) == {"censor", "censer"}
+    assert set(self.words(lexicon.answer({"sp": "*rse"}))) == {"horse", "norse", "course", "coarse"}
+
+  def test_constraints_should_be_combined(self, lexicon):
+    assert self.words(lexicon.answer({"rel_rhy": "horse", "sp": "c*"})) == ["coarse", "course"]
+
+  def test_answers_should_look_like_datamuse(self, lexicon):
+    entries = lexicon.answer({"rel_rhy": "nominate", "max": 1, "md": "s"})
+    assert entries == [{"word": "culminate", "score": 150, "numSyllables": 3}]
+
+  def test_other_questions_should_be_left_for_the_internet(self, lexicon):
+    assert lexicon.answer({"ml": "feeling tired"}) is None
+    assert lexicon.answer({"rel_rhy": "horse", "ml": "animal"}) is None
+    # definitions ask for md=dr, and plain spelled like means "fix my spelling"
+    assert lexicon.answer({"sp": "nostrum", "md": "dr"}) is None
+    assert lexicon.answer({"sp": "nostrum"}) is None
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3.6
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# What the heck is this file? :D
+# "word rhymes with norse with 1 syllable as a noun sorted by frequency max 10"
+# datamuse can't do the last part by itself -- it only knows how to find words, not
+# how to throw some away or put them in a different order
+# so word asks datamuse for lots of words (up to 1000), with their syllables, parts of
+# speech and how common they are, and this file sorts them out
+#
+# 1000 words is a lot of little dictionaries to loop through every time, so instead we
+# turn the answer into "columns": one array of scores, one of syllable counts, one of
+# frequencies, and so on (like the columns of a spreadsheet)
+# then "keep the ones with 1 syllable" is one step over one array, not 1000 steps
+# over 1000 dictionaries -- with numpy, that step happens in fast C code
+# numpy is optional: without it, the same columns are plain python arrays (a bit slower)
+
+# get code from other libraries that we'll need
+import math
+from array import array
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# parts of speech, as datamuse tags them (with md=p), and as people say them
+# each one gets its own bit, so a word's parts of speech fit in one number:
+# a word that's a noun and a verb has 1 + 2 == 3
+PARTS_OF_SPEECH = {"noun": ("n", 1), "verb": ("v", 2), "adjective": ("adj", 4),
+                   "adverb": ("adv", 8)}
+TAG_BITS = dict(PARTS_OF_SPEECH.values())
+
+# the orders word can sort in (the column, and whether biggest comes first)
+SORTS = {"score": ("score", True), "frequency": ("frequency", True),
+         "syllables": ("syllables", False), "length": ("length", False),
+         "alphabet": ("word", False), "blend": ("blend", True)}
+
+# "sorted by blend" mixes datamuse's score with how common the word is
+# (each one as a fraction of the best one in the answer, so they're on the same scale)
+BLEND = {"score": 0.7, "frequency": 0.3}
+
+def columns(entries):
+  """ Turn datamuse's list of dictionaries into a dictionary of columns. """
+  words, scores, syllables, frequencies, parts = [], array("d"), array("i"), array("d"), array("i")
+  # this is the only loop over the dictionaries -- everything after it uses the columns
+  for entry in entries:
+    word = entry["word"]
+    words.append(word)
+    scores.append(entry.get("score", 0))
+    syllables.append(entry.get("numSyllables", 0))
+    # frequency comes in a tag like "f:12.345" (how many times per million words)
+    frequency, bits = 0.0, 0
+    for tag in entry.get("tags", ()):
+      if tag.startswith("f:"):
+        try:
+          frequency = float(tag[2:])
+        except ValueError:
+          pass
+      else:
+        bits |= TAG_BITS.get(tag, 0)
+    frequencies.append(frequency)
+    parts.append(bits)
+  table = {"word": words, "score": scores, "syllables": syllables,
+           "frequency": frequencies, "parts": parts, "length": array("i", map(len, words))}
+  if numpy is not None:
+    # numpy can read python arrays without copying them
+    table = {name: numpy.asarray(column) for name, column in table.items()}
+  return table
+
+def blend(table):
+  """ The "sorted by blend" score of every word (a column, like the others). """
+  # log, because "the" is used ten thousand times as often as "horse"
+  # (log1p is log(1 + x), which is 0 for words nobody uses instead of minus infinity)
+  # "or 1" is so an answer with no scores (or no frequencies) doesn't divide by zero
+  if numpy is not None:
+    scores, logs = table["score"], numpy.log1p(table["frequency"])
+    return (BLEND["score"] * scores / (scores.max() or 1) +
+            BLEND["frequency"] * logs / (logs.max() or 1))
+  scores, logs = table["score"], array("d", map(math.log1p, table["frequency"]))
+  best_score, best_log = max(scores) or 1, max(logs) or 1
+  return array("d", (BLEND["score"] * score / best_score + BLEND["frequency"] * log / best_log
+                     for score, log in zip(scores, logs)))
+
+def matching(table, syllables=None, pos=None, frequency=None):
+  """ Which words pass the filters (a column of True/False). """
+  # syllables is (fewest, most), pos is a bit from PARTS_OF_SPEECH, frequency is the least
+  # each test is (column, the test for a whole numpy column, the test for one value)
+  tests = []
+  if syllables:
+    fewest, most = syllables
+    tests.append(("syllables", lambda column: (column >= fewest) & (column <= most),
+                               lambda value: fewest <= value <= most))
+  if pos:
+    tests.append(("parts", lambda column: (column & pos) != 0, lambda value: value & pos))
+  if frequency is not None:
+    tests.append(("frequency", lambda column: column >= frequency, lambda value: value >= frequency))
+  size = len(table["word"])
+  if numpy is not None:
+    # each test makes a column of True/False in one go, and & keeps the words that pass all of them
+    keep = numpy.ones(size, dtype=bool)
+    for name, vectorized, one in tests:
+      keep &= vectorized(table[name])
+    return keep
+  keep = [True] * size
+  for name, vectorized, one in tests:
+    keep = [k and bool(one(value)) for k, value in zip(keep, table[name])]
+  return keep
+
+def order(table, keep, sort=None):
+  """ The numbers of the words that passed, in the order they should be printed. """
+  if numpy is not None:
+    chosen = numpy.flatnonzero(keep)
+    if sort not in SORTS: return chosen
+    name, biggest_first = SORTS[sort]
+    column = blend(table) if name == "blend" else table[name]
+    keys = column[chosen]
+    # a stable sort keeps datamuse's order for ties (and minus flips numbers around,
+    # but not words -- which only ever sort a to z anyway)
+    return chosen[numpy.argsort(-keys if biggest_first else keys, kind="stable")]
+  chosen = [i for i, k in enumerate(keep) if k]
+  if sort not in SORTS: return chosen
+  name, biggest_first = SORTS[sort]
+  column = blend(table) if name == "blend" else table[name]
+  # python's sort is stable too, and reverse=True keeps ties in order
+  return sorted(chosen, key=column.__getitem__, reverse=biggest_first)
+
+def refine(entries, syllables=None, pos=None, frequency=None, sort=None, limit=None):
+  """ Filter and re-rank a datamuse answer. Returns a list like datamuse's. """
+  if not entries: return []
+  table = columns(entries)
+  chosen = order(table, matching(table, syllables, pos, frequency), sort)
+  return [entries[i] for i in chosen[:limit]]
@@ -0,0 +1,58 @@
+#!/usr/bin/env pytest
+
+# GPLv3 Copyright (C) 2018 Seamus Johnston https://seamusjohnston.com
+
+# Tests for word_rank.py (filtering and sorting datamuse's answers)
+# run them with python -m pytest word_rank_test.py
+
+import pytest
+import word_rank
+from word_rank import refine
+
+ENTRIES = [
+  {"word": "horse", "score": 900, "numSyllables": 1, "tags": ["n", "v", "f:60.1"]},
+  {"word": "course", "score": 850, "numSyllables": 1, "tags": ["n", "adv", "f:200.5"]},
+  {"word": "endorse", "score": 700, "numSyllables": 2, "tags": ["v", "f:10.0"]},
+  {"word": "remorse", "score": 600, "numSyllables": 2, "tags": ["n", "f:12.2"]},
+  {"word": "intercourse", "score": 500, "numSyllables": 3, "tags": ["n", "f:5.3"]},
+  {"word": "gorse", "score": 400, "numSyllables": 1},
+]
+
+# every test runs twice: with numpy (if it's installed) and with plain python arrays
+@pytest.fixture(params=["numpy", "arrays"], autouse=True)
+def columns(request, monkeypatch):
+  if request.param == "numpy":
+    if word_rank.numpy is None: pytest.skip("numpy isn't installed")
+  else:
+    monkeypatch.setattr(word_rank, "numpy", None)
+
+class TestRank(object):
+
+  def words(self, entries):
+    return [entry["word"] for entry in entries]
+
+  def test_no_filters_should_change_nothing(self):
+    assert refine(ENTRIES) == ENTRIES
+    assert refine([]) == []
+
+  def test_filters_should_all_have_to_pass(self):
+    assert self.words(refine(ENTRIES, syllables=(1, 1))) == ["horse", "course", "gorse"]
+    assert self.words(refine(ENTRIES, syllables=(2, 3), pos=1)) == ["remorse", "intercourse"]
+    assert self.words(refine(ENTRIES, pos=8)) == ["course"]
+    assert self.words(refine(ENTRIES, frequency=11)) == ["horse", "course", "remorse"]
+
+  def test_sorts_should_keep_ties_in_datamuse_order(self):
+    assert self.words(refine(ENTRIES, sort="frequency", limit=3)) == ["course", "horse", "remorse"]
+    assert self.words(refine(ENTRIES, sort="syllables")) == \
+           ["horse", "course", "gorse", "endorse", "remorse", "intercourse"]
+    assert self.words(refine(ENTRIES, sort="alphabet", limit=2)) == ["course", "endorse"]
+    assert self.words(refine(ENTRIES, sort="length", syllables=(1, 2))) == \
+           ["horse", "gorse", "course", "endorse", "remorse"]
+    # an order we don't know leaves datamuse's order alone
+    assert refine(ENTRIES, sort="elephants") == ENTRIES
+
+  def test_blend_should_mix_score_and_frequency(self):
+    # course is a bit less relevant than horse, but much more common
+    assert self.words(refine(ENTRIES, sort="blend", limit=2)) == ["course", "horse"]
+    # a word nobody uses still gets a blend (from its score), and no scores at all is fine too
+    assert self.words(refine([{"word": "a", "score": 0}, {"word": "b", "score": 0}], sort="blend")) == ["a", "b"]
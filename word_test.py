@@ -20,7 +20,8 @@
 # then running python -m pytest word_test.py
 # make sure you are in the same folder as the tests :)
 
-import pytest, requests, re
+import pytest, requests, re, time, json, threading, subprocess, sys, os
+from urllib.request import urlopen
 import word
 
 # At a high level, I want the app to perform these functions
@@ -38,20 +39,58 @@ class TestWord(object):
 
   # this sets some defaults for all the tests
   @pytest.fixture(scope="function", autouse=True)
-  def globalvars(self,monkeypatch):
-    word.verbose = 0
-    word.query_type = None
+  def globalvars(self,monkeypatch,tmp_path):
+    # use a brand new cache for every test, so old answers can't leak in
+    monkeypatch.setattr(word, 'CACHE_FILE', str(tmp_path / 'cache.sqlite3'))
+    monkeypatch.setattr(word, 'cache_db', None)
+    monkeypatch.setattr(word, 'recent', word.OrderedDict())
+    monkeypatch.setattr(word, 'use_cache', True)
+    monkeypatch.setattr(word, 'refresh_cache', False)
+    monkeypatch.setattr(word, 'output_format', 'grid')
+    monkeypatch.setattr(word, 'use_local', False)
+    monkeypatch.setattr(word, 'offline', False)
+    # and don't use a spelling index somebody built on this computer
+    monkeypatch.setattr(word, 'index', False)
+    monkeypatch.setattr(word, 'fetch_stats', dict.fromkeys(word.fetch_stats, 0))
+    # every test gets fresh rate limits, and doesn't wait between retries
+    monkeypatch.setattr(word, 'buckets', {})
+    monkeypatch.setattr(word, 'breakers', {})
+    monkeypatch.setattr(word, 'BACKOFF_BASE', 0)
+    # no metrics, unless a test turns them on
+    monkeypatch.setattr(word, 'metrics', None)
+    monkeypatch.setattr(word, 'metrics_target', None)
+    monkeypatch.setattr(word, 'METRICS_TARGET', None)
+    # no --timings or prefetching either (main() changes these, so they get put back afterwards)
+    monkeypatch.setattr(word, 'timing', None)
+    monkeypatch.setattr(word, 'prefetching', False)
+    monkeypatch.setattr(word, 'verbose', 0)
+    monkeypatch.setattr(word, 'query_type', None)
     # whenever requests.get() is called in the code, run TestWord.mockget() instead
     monkeypatch.setattr(requests, 'get', TestWord.mockget)
+    # word talks to the internet through a shared session, so send that to requests.get() too
+    monkeypatch.setattr(word, 'session', None)
+    monkeypatch.setattr(requests.Session, 'get', lambda session,url,**kwargs: requests.get(url,**kwargs))
 
   # this creates a "fake" http response without accessing the internet
   # it makes the tests faster and also doesn't waste bandwidth
   def mockget(*args,**kwargs):
+    # timeouts are for real connections, so we don't need them here
+    kwargs.pop('timeout', None)
     response = requests.Response()
     response.request = requests.Request('GET',*args,**kwargs).prepare()
     response.url = response.request.url
     return response
 
+  # this one pretends the api found a word (so it's worth caching)
+  # and counts how many times it was called
+  calls = 0
+  def mockget_ok(*args,**kwargs):
+    TestWord.calls += 1
+    response = TestWord.mockget(*args,**kwargs)
+    response.status_code = 200
+    response._content = b'[{"word":"platypus","score":100}]'
+    return response
+
   # Tests start HERE \o/
 
   def test_simple_query_should_encode_correctly(self):
@@ -170,3 +209,760 @@ class TestWord(object):
     assert re.search(r'qe=sp',responses[0].url)
     assert re.search(r'md=r',responses[0].url)
     assert re.search(r'ipa=1',responses[0].url)
+
+  def test_repeat_queries_should_come_from_the_cache(self,monkeypatch):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    TestWord.calls = 0
+    first = word.go_fetch(word.parse(['platypus'], {}))
+    second = word.go_fetch(word.parse(['platypus'], {}))
+    assert TestWord.calls == 1
+    assert second[0].url == first[0].url
+    assert second[0].json() == [{"word": "platypus", "score": 100}]
+
+  def test_cache_key_should_ignore_order_and_capitals(self):
+    a = word.cache_key('https://api.datamuse.com/words', {"ml": "Egg", "max": "20"})
+    b = word.cache_key('https://api.datamuse.com/words', {"max": "20", "ml": "egg"})
+    assert a == b
+
+  def test_refresh_and_no_cache_should_skip_the_cache(self,monkeypatch):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    TestWord.calls = 0
+    word.go_fetch(word.parse(['platypus'], {}))
+    word.refresh_cache = True
+    word.go_fetch(word.parse(['platypus'], {}))
+    word.refresh_cache, word.use_cache = False, False
+    word.go_fetch(word.parse(['platypus'], {}))
+    assert TestWord.calls == 3
+
+  def test_old_answers_should_expire_and_extra_answers_should_be_evicted(self,monkeypatch):
+    word.cache_put('a', 'url-a', b'[]')
+    word.cache_put('b', 'url-b', b'[]')
+    assert word.cache_get('a', ttl=-1) is None
+    monkeypatch.setattr(word, 'CACHE_SIZE', 1)
+    word.cache_put('c', 'url-c', b'[]')
+    assert word.cache_get('c') == ('url-c', b'[]')
+    assert word.cache_get('a') is None and word.cache_get('b') is None
+
+  def test_cache_reads_should_only_write_when_used_is_out_of_date(self,monkeypatch):
+    word.cache_put('a', 'url-a', b'[]')
+    word.recent.clear()
+    writes = []
+    word.cache_db.set_trace_callback(lambda statement: writes.append(statement) if statement.startswith('UPDATE') else None)
+    # just saved, so reading it again doesn't need to write anything
+    assert word.cache_get('a') == ('url-a', b'[]')
+    assert writes == []
+    word.cache_db.execute("UPDATE responses SET used = used - 7200")
+    word.recent.clear()
+    writes.clear()
+    assert word.cache_get('a') == ('url-a', b'[]')
+    assert len(writes) == 1
+    # and eviction can find the least recently used answers without reading every row
+    indexes = word.cache_db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'responses'").fetchall()
+    assert ('responses_used',) in indexes
+
+  def test_definitions_should_fetch_both_apis_at_the_same_time(self,monkeypatch):
+    def slowget(*args,**kwargs):
+      time.sleep(0.3)
+      return TestWord.mockget_ok(*args,**kwargs)
+    monkeypatch.setattr(requests, 'get', slowget)
+    query = word.parse(['nostrum', 'defined'], {})
+    start = time.monotonic()
+    responses = word.go_fetch(query)
+    assert len(responses) == 2
+    assert time.monotonic() - start < 0.55
+
+  def test_one_broken_api_should_not_hide_the_other(self,monkeypatch):
+    def brokenowlbot(url,**kwargs):
+      if 'owlbot' in url: raise requests.ConnectionError()
+      return TestWord.mockget_ok(url,**kwargs)
+    monkeypatch.setattr(requests, 'get', brokenowlbot)
+    query = word.parse(['nostrum', 'defined'], {})
+    responses = word.go_fetch(query)
+    statuses = sorted((r.status_code, re.search(r'owlbot|datamuse', r.url).group()) for r in responses)
+    assert statuses == [(200, 'datamuse'), (503, 'owlbot')]
+
+  def test_batch_should_print_in_order_and_survive_bad_lines(self,monkeypatch,capsys):
+    def get(url,**kwargs):
+      # the first query is the slowest, but it should still be printed first
+      if kwargs.get('params', {}).get('ml') == 'slow': time.sleep(0.2)
+      return TestWord.mockget_ok(url,**kwargs)
+    monkeypatch.setattr(requests, 'get', get)
+    failures = word.run_batch(["slow", "", "meaning 'unbalanced quote", "elephant trunk"], jobs=2)
+    out = capsys.readouterr().out
+    assert failures == 1
+    # (colorama may or may not have stripped the color codes, depending on the terminal)
+    headers = re.findall(r'==> (.*?)(?:\033\[0m)?$', out, re.MULTILINE)
+    assert headers == ["slow", "meaning 'unbalanced quote", "elephant trunk"]
+    assert out.count("platypus") == 2
+
+  def test_server_should_answer_slow_and_quick_questions_at_once(self,monkeypatch):
+    def get(url,**kwargs):
+      if kwargs.get('params', {}).get('ml') == 'slow': time.sleep(0.5)
+      return TestWord.mockget_ok(url,**kwargs)
+    monkeypatch.setattr(requests, 'get', get)
+    server = word.make_server(0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    try:
+      slow = threading.Thread(target=lambda: urlopen(f"http://127.0.0.1:{port}/query?q=slow").read())
+      slow.start()
+      time.sleep(0.05)
+      start = time.monotonic()
+      with urlopen(f"http://127.0.0.1:{port}/query?q=quick") as response:
+        assert response.status == 200
+      # the quick one didn't have to wait behind the slow one
+      assert time.monotonic() - start < 0.4
+      slow.join()
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def test_forwarded_runs_should_send_back_their_errors_too(self,monkeypatch):
+    def main(argv):
+      print("an answer")
+      print("a warning", file=sys.stderr)
+      sys.exit(3)
+    monkeypatch.setattr(word, 'main', main)
+    assert word.run_captured(['platypus']) == (3, "an answer\n", "a warning\n")
+
+  def test_forwarded_runs_should_not_change_the_servers_settings(self,monkeypatch):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    for argv in (['--refresh', '--format', 'tsv', '-v', 'platypus'], ['--no-cache', '--prefetch', 'platypus']):
+      status, output, errors = word.run_captured(argv)
+      assert status == 0 and 'platypus' in output
+    assert word.use_cache and not word.refresh_cache
+    assert word.output_format == 'grid' and word.verbose == 0 and not word.prefetching
+
+  def test_fetches_should_share_one_session_with_a_timeout(self,monkeypatch):
+    seen = []
+    def get(session,url,**kwargs):
+      seen.append((session, kwargs.get('timeout')))
+      return TestWord.mockget(url,**kwargs)
+    monkeypatch.setattr(requests.Session, 'get', get)
+    word.go_fetch(word.parse(['nostrum', 'defined'], {}))
+    word.query_type = None
+    word.go_fetch(word.parse(['platypus'], {}))
+    assert len(seen) == 3
+    assert all(session is word.session for session, timeout in seen)
+    # (never more than go_fetch() waits, and never more than HTTP_TIMEOUT)
+    assert all(timeout[0] == word.HTTP_TIMEOUT[0] and 0 < timeout[1] <= word.HTTP_TIMEOUT[1]
+               for session, timeout in seen)
+
+  def test_server_should_answer_for_the_thin_client(self,monkeypatch,tmp_path,capsys):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    server = word.make_server(0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    try:
+      monkeypatch.setattr(word, 'SERVE_FILE', str(tmp_path / 'serve.port'))
+      # no note from the server means the client should do it itself
+      assert word.forward_to_server(['platypus']) is None
+      (tmp_path / 'serve.port').write_text(str(port))
+      assert word.forward_to_server(['platypus']) == 0
+      assert 'platypus' in capsys.readouterr().out
+      # help and batch never go to the server
+      assert word.forward_to_server(['--help']) is None
+      # and neither do subcommands, even with flags in front of them
+      assert word.forward_to_server(['-v', 'serve']) is None
+      assert word.forward_to_server(['--no-cache', '--format', 'tsv', 'build-index', 'words.txt']) is None
+      with urlopen(f"http://127.0.0.1:{port}/query?q=rhymes+with+norse") as response:
+        answer = json.loads(response.read().decode("utf-8"))
+      assert answer["query"]["rel_rhy"] == "norse"
+      assert answer["responses"][0]["json"] == [{"word": "platypus", "score": 100}]
+      with urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        assert json.loads(response.read().decode("utf-8"))["misses"] == 2
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  # python -X importtime prints how long every library took to load, like this:
+  # import time: self [us] | cumulative | imported package
+  # import time:       458 |     100946 |   requests
+  def importtime(self, *args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', *args], cwd=here,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    times = re.findall(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)', result.stderr.decode())
+    return {name: int(us) for us, name in times}
+
+  def test_startup_should_not_load_slow_libraries(self):
+    loaded = self.importtime('word.py', '--help')
+    for slow in ['requests', 'colorama', 'sqlite3', 'concurrent.futures', 'http.server', 'subprocess']:
+      assert slow not in loaded
+    # and importing word should take less time than importing requests by itself did
+    assert self.importtime('-c', 'import word')['word'] < self.importtime('-c', 'import requests')['requests']
+
+  def test_new_relations_should_be_in_the_phrase_table(self):
+    assert word.parse(['synonyms', 'of', 'happy'], {}) == {"rel_syn": "happy"}
+    assert word.parse(['opposite', 'of', 'happy', 'max', '3'], {}) == {"rel_ant": "happy", "max": "3"}
+    assert word.parse(['parts', 'of', 'a', 'car'], {}) == {"rel_com": "car"}
+    assert word.parse(['described', 'by', 'gradual'], {}) == {"rel_jja": "gradual"}
+
+  def test_parse_should_not_eat_the_args(self):
+    args = ['ryhmes', 'with', 'cute', 'and', 'comes', 'before', 'bowl']
+    word.parse(args, {})
+    assert args == ['ryhmes', 'with', 'cute', 'and', 'comes', 'before', 'bowl']
+
+  def test_longest_phrase_should_win(self):
+    trie = word.compile_phrases([(("comes",), "a"), (("comes", "after", word.WORD), "b")])
+    assert word.read_phrase(trie, ['comes', 'after', 'sea'], 0) == (3, "b", ["sea"])
+    assert word.read_phrase(trie, ['comes', 'home'], 0) == (1, "a", [])
+    assert word.read_phrase(trie, ['goes', 'home'], 0) is None
+
+  def test_old_misspellings_should_still_be_recognised(self):
+    for keyword, typos in word.KNOWN_TYPOS.items():
+      for typo in typos:
+        assert word.fuzzy_keyword(typo) == keyword
+
+  def test_new_typos_should_be_forgiven_for_every_fuzzy_keyword(self):
+    assert word.is_rhymes('rhymse')
+    assert word.is_pronounced('pronuonced')
+    assert word.parse(['synomyns', 'of', 'happy'], {}) == {"rel_syn": "happy"}
+    assert word.parse(['asociated', 'with', 'feet'], {}) == {"rel_trg": "feet"}
+    assert word.parse(['defintion', 'of', 'nostrum'], {})["md"] == "d"
+
+  def test_real_words_should_not_look_like_typos(self):
+    assert word.fuzzy_keyword('homes') is None
+    assert word.fuzzy_keyword('times') is None
+    assert word.fuzzy_keyword('described') == 'described'
+    assert word.parse(['smelled', 'like', 'roses'], {}) == {"ml": "smelled roses"}
+    # a typo or two away from a keyword is often a real word too
+    for real in ['prescribed', 'scribes', 'opposing', 'opposites', 'associates', 'rhymer',
+                 'trigger', 'triggers', 'acronyms', 'definitive', 'renounced', 'composite']:
+      assert word.fuzzy_keyword(real) is None, real
+    assert word.parse(['prescribed', 'by', 'doctors'], {}) == {"ml": "prescribed by doctors"}
+    assert word.parse(['the', 'definitive', 'guide'], {}) == {"ml": "the definitive guide"}
+    assert word.parse(['acronyms', 'of', 'nasa'], {}) == {"ml": "acronyms of nasa"}
+    # after a word, only "definition" itself asks for a definition
+    assert word.parse(['nostrum', 'defintion'], {}) == {"ml": "nostrum defintion"}
+
+  def test_json_lists_should_be_read_one_item_at_a_time(self):
+    body = '[{"word":"caf\u00e9","score":1}, {"word":"tea","tags":["n"]} ,{"word":"x"}]'.encode('utf-8')
+    # cut the bytes up everywhere, even in the middle of the two-byte é
+    for size in [1, 2, 3, 7, len(body)]:
+      chunks = [body[i:i+size] for i in range(0, len(body), size)]
+      assert list(word.iter_json_list(chunks)) == [{"word": "café", "score": 1},
+                                                   {"word": "tea", "tags": ["n"]}, {"word": "x"}]
+    assert list(word.iter_json_list([b' [ ] '])) == []
+    with pytest.raises(ValueError):
+      list(word.iter_json_list([b'[{"word":']))
+    assert word.is_empty_list(b'\n[ ]\n') and not word.is_empty_list(b'[{}]')
+
+  def test_grid_rows_should_be_printed_before_the_rest_arrives(self,monkeypatch,capsys):
+    response = word.cached_response('https://api.datamuse.com/words', b'')
+    def chunks(size):
+      yield b'[{"word":"one"},{"word":"two"},{"word":"three"},'
+      # by now the first row should already be on the screen
+      assert re.search(r'one.*two.*three', capsys.readouterr().out)
+      yield b'{"word":"four"}]'
+    monkeypatch.setattr(response, 'iter_content', chunks)
+    monkeypatch.setattr(word, 'is_empty_list', lambda body: False)
+    word.print_response([response])
+    assert 'four' in capsys.readouterr().out
+
+  def test_formats_should_print_one_record_per_word(self,monkeypatch,capsys):
+    body = b'[{"word":"tea","score":5,"numSyllables":1,"tags":["n","adj"]},{"word":"t\xc3\xa9","score":2}]'
+    response = lambda: word.cached_response('https://api.datamuse.com/words?ml=drink', body)
+    word.output_format = 'json'
+    word.print_response([response()])
+    assert capsys.readouterr().out == body.decode('utf-8') + '\n'
+    word.output_format = 'jsonl'
+    word.print_response([response()])
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["word"] for line in lines] == ["tea", "té"]
+    word.output_format = 'tsv'
+    word.print_response([response()])
+    assert capsys.readouterr().out.splitlines() == ["tea\t5\t1\tn, adj\t", "té\t2\t\t\t"]
+    word.output_format = 'plain'
+    word.print_response([response()])
+    assert capsys.readouterr().out == "tea\nté\n"
+
+  def test_formats_should_ask_for_syllables(self):
+    word.output_format = 'tsv'
+    responses = word.go_fetch(word.parse(['platypus'], {}))
+    assert re.search(r'md=s',responses[0].url)
+
+  def test_local_backends_should_answer_before_the_internet(self,monkeypatch):
+    class Rhymer(object):
+      name = "rhymer"
+      def answer(self, query):
+        return [{"word": "norse", "score": 100}] if "rel_rhy" in query else None
+    monkeypatch.setattr(word, 'backends', [Rhymer()])
+    monkeypatch.setattr(word, 'use_local', True)
+    TestWord.calls = 0
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    responses = word.go_fetch(word.parse(['rhymes','with','horse'], {}))
+    assert responses[0].json() == [{"word": "norse", "score": 100}]
+    assert responses[0].url.startswith("local://rhymer?")
+    assert TestWord.calls == 0
+    # anything the backend can't answer still goes to the internet
+    word.query_type = None
+    word.go_fetch(word.parse(['meaning','tired'], {}))
+    assert TestWord.calls == 1
+
+  def test_offline_should_never_use_the_internet(self,monkeypatch,capsys):
+    class Shrugger(object):
+      name = "shrugger"
+      def answer(self, query): return None
+    monkeypatch.setattr(word, 'backends', [Shrugger()])
+    monkeypatch.setattr(word, 'offline', True)
+    monkeypatch.setattr(requests, 'get', lambda *args,**kwargs: pytest.fail("went online"))
+    with pytest.raises(SystemExit):
+      word.print_response(word.go_fetch(word.parse(['meaning','tired'], {})))
+    assert "offline" in capsys.readouterr().out
+
+  def test_spelling_patterns_should_come_from_the_index(self,monkeypatch,tmp_path):
+    import word_index
+    path = str(tmp_path / 'words.idx')
+    word_index.build([("censor", 2), ("censer", 2), ("sensor", 2)], path)
+    monkeypatch.setattr(word, 'index', word_index.WordIndex.from_file(path))
+    monkeypatch.setattr(requests, 'get', lambda *args,**kwargs: pytest.fail("went online"))
+    responses = word.go_fetch(word.parse(['spelled','like',"cens?r"], {}))
+    assert [entry["word"] for entry in responses[0].json()] == ["censer", "censor"]
+    assert responses[0].url.startswith("local://index?")
+
+  def test_identical_fetches_at_the_same_time_should_share_one_request(self,monkeypatch):
+    arrived, release = threading.Semaphore(0), threading.Event()
+    def get(url,**kwargs):
+      # hold the first request open until everybody else has asked too
+      arrived.release()
+      release.wait(5)
+      return TestWord.mockget_ok(url,**kwargs)
+    monkeypatch.setattr(requests, 'get', get)
+    TestWord.calls = 0
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(word.cached_get(
+                 'https://api.datamuse.com/words', {"rel_rhy": "norse"}))) for _ in range(5)]
+    threads[0].start()
+    assert arrived.acquire(timeout=5)
+    for thread in threads[1:]: thread.start()
+    # wait until the other four are waiting on the first one
+    deadline = time.time() + 5
+    while word.fetch_stats["coalesced"] < 4 and time.time() < deadline: time.sleep(0.01)
+    release.set()
+    for thread in threads: thread.join(5)
+    assert TestWord.calls == 1
+    assert [r.json() for r in results] == [[{"word": "platypus", "score": 100}]] * 5
+    assert (word.fetch_stats["hits"], word.fetch_stats["misses"], word.fetch_stats["coalesced"]) == (0, 1, 4)
+    # and now it's in the cache
+    word.cached_get('https://api.datamuse.com/words', {"rel_rhy": "norse"})
+    assert word.fetch_stats["hits"] == 1
+    assert word.in_flight == {}
+
+  def test_a_failed_fetch_should_fail_for_everybody_waiting(self,monkeypatch):
+    from concurrent.futures import Future
+    flight = Future()
+    key = word.cache_key('https://api.datamuse.com/words', {"ml": "ouch"})
+    monkeypatch.setitem(word.in_flight, key, flight)
+    flight.set_exception(requests.ConnectionError("no internet"))
+    with pytest.raises(requests.ConnectionError):
+      word.cached_get('https://api.datamuse.com/words', {"ml": "ouch"})
+    assert word.fetch_stats["coalesced"] == 1
+
+  def test_token_bucket_should_keep_to_its_rate(self):
+    bucket = word.TokenBucket(rate=50, burst=2)
+    start = time.monotonic()
+    for _ in range(7): bucket.take()
+    # 2 straight away, then 5 more at 50 a second
+    assert 0.08 < time.monotonic() - start < 0.5
+
+  def test_busy_and_broken_apis_should_be_retried(self,monkeypatch):
+    statuses = [429, 503, 200]
+    def get(url,**kwargs):
+      response = TestWord.mockget_ok(url,**kwargs)
+      response.status_code = statuses.pop(0)
+      return response
+    monkeypatch.setattr(requests, 'get', get)
+    assert word.http_get('https://api.datamuse.com/words', {"ml": "tired"}).status_code == 200
+    assert word.fetch_stats["retries"] == 2
+    # an answer cut off halfway is retried too, and counts against the breaker
+    def cut_off(url,**kwargs):
+      raise requests.exceptions.ChunkedEncodingError("connection broken")
+    monkeypatch.setattr(requests, 'get', cut_off)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+      word.http_get('https://api.datamuse.com/words', {"ml": "sleepy"})
+    assert word.fetch_stats["retries"] == 2 + word.RETRIES
+    assert word.guards('https://api.datamuse.com/words')[1].failed_in_a_row == 1
+
+  def test_retries_should_stop_at_the_deadline(self,monkeypatch):
+    calls = []
+    def busy(url,**kwargs):
+      calls.append(kwargs['timeout'])
+      response = TestWord.mockget_ok(url,**kwargs)
+      response.status_code = 503
+      response.headers["Retry-After"] = "0.3"
+      return response
+    monkeypatch.setattr(requests, 'get', busy)
+    start = time.monotonic()
+    response = word.http_get('https://api.datamuse.com/words', {"ml": "tired"}, start + 0.5)
+    # one wait fits before the deadline, and a second one wouldn't
+    assert response.status_code == 503 and len(calls) == 2
+    assert time.monotonic() - start < 0.5
+    assert calls[1][1] <= 0.2
+
+  def test_a_broken_api_should_serve_old_answers_and_then_rest(self,monkeypatch):
+    url, params = 'https://api.datamuse.com/words', {"rel_rhy": "norse"}
+    # an answer from two days ago
+    word.cache_put(word.cache_key(url, params), url, b'[{"word":"horse","score":1}]')
+    word.recent.clear()
+    word.cache_db.execute("UPDATE responses SET stored = stored - 172800")
+    def broken(url,**kwargs):
+      TestWord.calls += 1
+      response = TestWord.mockget(url,**kwargs)
+      response.status_code = 500
+      return response
+    monkeypatch.setattr(requests, 'get', broken)
+    TestWord.calls = 0
+    assert word.cached_get(url, params).json() == [{"word": "horse", "score": 1}]
+    assert word.fetch_stats["stale"] == 1
+    # (that was one failure, and here come the rest)
+    for _ in range(word.BREAKER_FAILURES - 1): word.http_get(url, {"ml": "anything"})
+    # the breaker is open now, so nobody asks datamuse
+    calls = TestWord.calls
+    assert word.http_get(url, params).status_code == 503
+    assert TestWord.calls == calls and word.fetch_stats["broken"] == 1
+    assert word.cached_get(url, params).json() == [{"word": "horse", "score": 1}]
+
+  def test_engine_should_not_print_exit_or_touch_globals(self,monkeypatch,capsys):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    engine = word.Engine(maximum=5)
+    result = engine.query("nostrum defined")
+    assert result["type"] == "DEF" and word.query_type is None
+    assert [r["status"] for r in result["responses"]] == [200, 200]
+    result = engine.query("rhymes with norse")
+    assert result["query"] == {"rel_rhy": "norse", "max": 5}
+    assert result["responses"][0]["json"] == [{"word": "platypus", "score": 100}]
+    # nothing the api can't answer makes it exit, either
+    monkeypatch.setattr(requests, 'get', lambda *args,**kwargs: TestWord.mockget(*args,**kwargs))
+    assert engine.query("meaning tired")["responses"][0]["json"] is None
+    assert capsys.readouterr().out == ""
+
+  def test_aquery_should_run_lots_of_lookups_on_one_event_loop(self,monkeypatch):
+    import asyncio
+    monkeypatch.setattr(word, 'RATE_LIMITS', {"*": 100000})
+    class Client(object):
+      calls = 0
+      async def get(self, url, params=None, timeout=None):
+        Client.calls += 1
+        # every request takes a while, so they only finish quickly if they wait together
+        await asyncio.sleep(0.05)
+        response = TestWord.mockget_ok(url, params=params)
+        response._content = json.dumps([{"word": params["rel_rhy"], "score": 1}]).encode()
+        return response
+    engine = word.Engine(client=Client())
+    async def lookups():
+      return await asyncio.gather(*(engine.aquery(f"rhymes with word{i % 50}") for i in range(1000)))
+    start = time.monotonic()
+    results = asyncio.run(lookups())
+    assert time.monotonic() - start < 2
+    assert results[7]["responses"][0]["json"] == [{"word": "word7", "score": 1}]
+    # 50 different questions means 50 requests -- the rest waited for them, or hit the cache
+    assert Client.calls == 50
+    assert word.fetch_stats["misses"] == 50
+    assert word.fetch_stats["coalesced"] + word.fetch_stats["hits"] == 950
+
+  def test_aquery_should_filter_answers_from_any_http_library(self,monkeypatch):
+    import asyncio
+    class URL(object):
+      # like httpx.URL: it can be printed, but "x" in url doesn't work
+      def __init__(self, text): self.text = text
+      def __str__(self): return self.text
+      def __iter__(self): raise TypeError("not iterable")
+    class Response(object):
+      def __init__(self, url, entries):
+        self.url, self.status_code, self.headers = URL(url), 200, {}
+        self.content = json.dumps(entries).encode('utf-8')
+    class Client(object):
+      async def get(self, url, params=None, timeout=None):
+        return Response(url + '?rel_rhy=norse', [{"word": "endorse", "score": 900, "numSyllables": 2},
+                                                 {"word": "horse", "score": 800, "numSyllables": 1}])
+    result = asyncio.run(word.Engine(client=Client()).aquery("rhymes with norse with 1 syllable"))
+    assert result["responses"][0]["json"] == [{"word": "horse", "score": 800, "numSyllables": 1}]
+
+  def test_aquery_should_keep_sqlite_off_the_event_loop(self,monkeypatch):
+    import asyncio
+    threads = []
+    def cache_get(key, ttl=None):
+      threads.append(threading.current_thread())
+      return None
+    monkeypatch.setattr(word, 'cache_get', cache_get)
+    monkeypatch.setattr(word, 'cache_put', lambda *args: threads.append(threading.current_thread()))
+    class Portal(object):
+      async def get(self, url, params=None, timeout=None):
+        # a captive portal answers everything with a 200 and a login page
+        response = TestWord.mockget_ok(url, params=params)
+        response._content = b'<html>Please log in to the cafe wifi</html>'
+        return response
+    result = asyncio.run(word.Engine(client=Portal()).aquery("rhymes with norse"))
+    assert result["responses"][0]["status"] == 200 and result["responses"][0]["json"] is None
+    assert len(threads) == 2 and threading.main_thread() not in threads
+
+  def test_aquery_should_use_threads_without_an_async_client(self,monkeypatch):
+    import asyncio
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    monkeypatch.setattr(word.Engine, 'async_client', lambda engine: None)
+    result = asyncio.run(word.aquery("rhymes with norse"))
+    assert result["responses"][0]["json"] == [{"word": "platypus", "score": 100}]
+    # more queries at once than there are helper threads shouldn't wait for each other
+    monkeypatch.setattr(word, 'RATE_LIMITS', {"*": 100000})
+    monkeypatch.setattr(word, 'buckets', {})
+    monkeypatch.setattr(word, 'FETCH_TIMEOUT', 3)
+    def slow(url,**kwargs):
+      time.sleep(0.05)
+      return TestWord.mockget_ok(url,**kwargs)
+    monkeypatch.setattr(requests, 'get', slow)
+    engine = word.Engine()
+    async def lookups():
+      return await asyncio.gather(*(engine.aquery(f"rhymes with many{i}") for i in range(64)))
+    start = time.monotonic()
+    results = asyncio.run(lookups())
+    assert time.monotonic() - start < 2
+    assert all(result["responses"][0]["status"] == 200 for result in results)
+
+  def test_planner_should_split_relations_and_long_topic_lists(self):
+    assert word.plan({"rel_rhy": "norse", "lc": "sea", "max": 20}) == [{"rel_rhy": "norse", "lc": "sea", "max": 20}]
+    assert word.plan({"rel_syn": "happy", "rel_rhy": "bee", "sp": "g*", "max": 20}) == \
+      [{"sp": "g*", "max": 1000, "rel_syn": "happy"}, {"sp": "g*", "max": 1000, "rel_rhy": "bee"}]
+    query = word.parse("about a b c d e f g".split(), {})
+    assert query == {"topics": "a b c d e f g"}
+    assert [part["topics"] for part in word.plan(query)] == ["a b c d e", "f g"]
+
+  def test_planned_queries_should_be_intersected_and_ranked(self,monkeypatch):
+    answers = {"rel_syn": [{"word": "joyful", "score": 900}, {"word": "glee", "score": 300},
+                           {"word": "free", "score": 100}],
+               "rel_rhy": [{"word": "free", "score": 4000}, {"word": "glee", "score": 4000},
+                           {"word": "tree", "score": 2000}]}
+    seen = []
+    def get(url,**kwargs):
+      params = kwargs.get('params')
+      seen.append(params)
+      response = TestWord.mockget_ok(url,**kwargs)
+      response._content = json.dumps(next(answers[p] for p in params if p in answers)).encode()
+      return response
+    monkeypatch.setattr(requests, 'get', get)
+    responses = word.go_fetch(word.parse("synonyms of happy that rhyme with bee".split(), {}))
+    assert len(seen) == 2 and len(responses) == 1
+    # glee is 1/3 of the best synonym and the best rhyme, free is 1/9 and the best rhyme
+    assert responses[0].json() == [{"word": "glee", "score": 1333}, {"word": "free", "score": 1111}]
+    # the engine plans the same way
+    assert word.Engine().query("synonyms of happy that rhyme with bee")["responses"][0]["json"] == responses[0].json()
+
+  def test_prefetch_should_fill_the_cache_with_the_next_questions(self,monkeypatch):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    monkeypatch.setattr(word, 'prefetching', True)
+    TestWord.calls = 0
+    word.go_fetch(word.parse(['nostrum', 'defined'], {}))
+    # wait for the helper threads to finish
+    deadline = time.time() + 5
+    while TestWord.calls < 5 and time.time() < deadline: time.sleep(0.01)
+    time.sleep(0.05)
+    # datamuse + owlbot, then pronunciation, synonyms and rhymes
+    assert TestWord.calls == 5 and word.fetch_stats["prefetched"] == 3
+    # so the follow up questions come straight from the cache
+    word.prefetching = False
+    for args in (['nostrum', 'is', 'said', 'how'], ['synonyms', 'of', 'nostrum'], ['rhymes', 'with', 'nostrum']):
+      word.query_type = None
+      word.go_fetch(word.parse(args, {}))
+    assert TestWord.calls == 5 and word.fetch_stats["hits"] == 3
+
+  def test_prefetch_should_stop_when_the_budget_runs_out(self,monkeypatch):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    monkeypatch.setattr(word, 'PREFETCH_BUDGET', -1)
+    TestWord.calls = 0
+    word.prefetch('nostrum', 'DEF')
+    word.get_pool().submit(lambda: None).result()
+    time.sleep(0.05)
+    assert TestWord.calls == 0
+
+  def test_repl_should_keep_settings_and_recent_words(self,monkeypatch,capsys):
+    seen = []
+    def get(url,**kwargs):
+      seen.append(kwargs.get('params'))
+      return TestWord.mockget_ok(url,**kwargs)
+    monkeypatch.setattr(requests, 'get', get)
+    lines = iter([":max 50", "rhymes with norse", "", "meaning 'unfinished", ":format plain",
+                  "comes after sea max 3", ":recent", ":nonsense"])
+    def read(prompt):
+      try:
+        return next(lines)
+      except StopIteration:
+        raise EOFError
+    repl = word.Repl()
+    monkeypatch.setattr(word, 'verbose', 0)
+    repl.loop(read)
+    out = capsys.readouterr().out
+    assert [query["max"] for query in seen] == ["50", "3"]
+    assert "Couldn't read that" in out and "Unknown setting :nonsense" in out
+    # the last query was printed as plain words, and :recent shows both queries
+    assert re.search(r'rhymes with norse.*\b1\b.*platypus', out)
+    assert word.output_format == "plain"
+    # tab completion knows the keywords and the words from the answers
+    assert repl.complete("rhy", 0) == "rhymes" and repl.complete("rhy", 1) is None
+    assert repl.complete("plat", 0) == "platypus"
+    assert repl.complete(":ma", 0) == ":max"
+
+  def test_interactive_local_should_need_a_pronouncing_dictionary(self,monkeypatch,capsys):
+    def no_dictionary():
+      raise FileNotFoundError("no cmudict.dict here")
+    monkeypatch.setattr(word, 'get_backends', no_dictionary)
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    lines = iter([":local on", "rhymes with norse", ":offline"])
+    def read(prompt):
+      try:
+        return next(lines)
+      except StopIteration:
+        raise EOFError
+    word.Repl().loop(read)
+    out = capsys.readouterr().out
+    # the setting stays off, and the next query still goes to the internet
+    assert out.count("Couldn't read the pronouncing dictionary") == 2
+    assert not word.use_local and not word.offline
+    assert "platypus" in out
+
+  def test_interactive_mode_should_not_go_to_the_server(self):
+    assert not word.forwardable(['-i'])
+    assert not word.forwardable(['--interactive'])
+    assert not word.forwardable(['-v', '--interactive'])
+    # but the flags that do go to the server still do
+    assert word.forwardable(['--no-cache', 'rhymes', 'with', 'norse'])
+
+  def test_timings_should_report_each_stage_on_stderr(self,monkeypatch,capsys):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    word.main(['--timings', 'json', 'rhymes', 'with', 'norse'])
+    captured = capsys.readouterr()
+    assert 'platypus' in captured.out and 'stages_ms' not in captured.out
+    report = word.json.loads(captured.err)
+    # requests and sqlite3 are timed on their own, not as part of fetch
+    assert list(report["stages_ms"]) == ["import", "libraries", "parse", "fetch", "print", "json decode"]
+    assert [request["source"] for request in report["requests"]] == ["cache"]
+    assert report["requests"][0]["status"] == 200
+    assert not word.forwardable(['--timings', 'platypus'])
+
+  def test_timings_should_cover_batch_and_interactive_runs(self,monkeypatch,capsys,tmp_path):
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    (tmp_path / 'queries.txt').write_text("rhymes with norse\nplatypus\n")
+    with pytest.raises(SystemExit):
+      word.main(['--timings', 'json', '--batch', str(tmp_path / 'queries.txt')])
+    report = word.json.loads(capsys.readouterr().err)
+    assert list(report["stages_ms"]) == ["import", "libraries", "batch"]
+    assert len(report["requests"]) == 2
+    # -i reports on every query by itself
+    lines = iter(["rhymes with norse", "platypus"])
+    def read(prompt):
+      try:
+        return next(lines)
+      except StopIteration:
+        raise EOFError
+    monkeypatch.setattr(word, 'timing', 'json')
+    word.Repl().loop(read)
+    reports = [word.json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    assert [list(report["stages_ms"]) for report in reports] == [["parse", "fetch", "print", "json decode"]] * 2
+    assert [len(report["requests"]) for report in reports] == [1, 1]
+
+  def test_profile_should_save_a_pstats_file(self,monkeypatch,capsys,tmp_path):
+    import pstats
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    path = str(tmp_path / 'run.pstats')
+    word.main(['--profile', path, 'platypus'])
+    assert path in capsys.readouterr().err
+    assert any(function == 'go_fetch' for _, _, function in pstats.Stats(path).stats)
+
+  def test_metrics_should_be_saved_for_prometheus(self,monkeypatch,tmp_path):
+    def get(url,**kwargs):
+      response = TestWord.mockget_ok(url,**kwargs)
+      response._content = b'[{"word":"platypus","score":100,"defs":["n\\tan egg laying mammal"]}]'
+      # owlbot has never heard of it
+      if 'owlbot' in url: response.status_code = 404
+      return response
+    monkeypatch.setattr(requests, 'get', get)
+    path = str(tmp_path / 'word.prom')
+    word.main(['--metrics', path, 'define', 'platypus'])
+    text = open(path).read()
+    assert 'word_upstream_requests_total{backend="datamuse",status="200"} 1' in text
+    assert 'word_upstream_requests_total{backend="owlbot",status="404"} 1' in text
+    assert 'word_query_seconds_count 1' in text
+    assert 'word_print_seconds_bucket{format="grid",le="+Inf"} 1' in text
+    assert 'word_fetch_total{result="misses"} 2' in text and 'word_queue_depth 0' in text
+
+  def test_metrics_should_go_to_statsd(self,monkeypatch):
+    import socket
+    monkeypatch.setattr(requests, 'get', TestWord.mockget_ok)
+    statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    statsd.bind(('127.0.0.1', 0))
+    statsd.settimeout(5)
+    monkeypatch.setattr(word, 'metrics', word.Metrics())
+    word.go_fetch(word.parse(['platypus'], {}))
+    word.export_metrics('statsd://127.0.0.1:%d' % statsd.getsockname()[1])
+    lines = statsd.recv(65536).decode('utf-8').splitlines()
+    statsd.close()
+    assert 'word_upstream_requests_total.datamuse.200:1|c' in lines
+    assert any(re.match(r'word_query_seconds:[0-9.]+\|ms$', line) for line in lines)
+    # the counters were sent, so the next export only has the gauges
+    assert all(line.endswith('|g') for line in word.metrics.statsd())
+
+  def test_filters_should_be_read_but_not_sent_to_datamuse(self,monkeypatch):
+    query = word.parse('rhymes with norse with 1-2 syllables as a noun sorted by blend max 2'.split(), {})
+    assert query == {"rel_rhy": "norse", "syllables": "1-2", "pos": "noun", "sort": "blend", "max": "2"}
+    # meaning and about stop where a filter starts, instead of swallowing it
+    parse = lambda text: word.read_query(text.split(), {})
+    assert parse('meaning happy as an adjective') == {"ml": "happy", "pos": "adjective"}
+    assert parse('meaning happy with 2 syllables') == {"ml": "happy", "syllables": "2"}
+    assert parse('meaning refuse about trash frequency 10') == {"ml": "refuse", "topics": "trash", "frequency": "10"}
+    assert parse('about trash as verbs ranked by length') == {"topics": "trash", "pos": "verb", "sort": "length"}
+    # but with and frequency on their own are still part of the meaning
+    assert parse('meaning radio frequency band') == {"ml": "radio frequency band"}
+    assert parse('meaning dressed with care') == {"ml": "dressed with care"}
+    # and neither is a filter that doesn't make sense, anywhere in the query
+    assert parse('radio frequency band') == {"ml": "radio frequency band"}
+    assert parse('poems with many syllables') == {"ml": "poems with many syllables"}
+    assert parse('songs ranked by critics') == {"ml": "songs ranked by critics"}
+    assert word.take_filters({"ml": "songs", "sort": "critics"}) is None
+    seen = []
+    def get(url,**kwargs):
+      seen.append(dict(kwargs.get('params')))
+      response = TestWord.mockget_ok(url,**kwargs)
+      response._content = json.dumps([
+        {"word": "horse", "score": 900, "numSyllables": 1, "tags": ["n", "f:60.1"]},
+        {"word": "endorse", "score": 800, "numSyllables": 2, "tags": ["v", "f:10.0"]},
+        {"word": "course", "score": 850, "numSyllables": 1, "tags": ["n", "f:200.5"]},
+        {"word": "remorse", "score": 600, "numSyllables": 2, "tags": ["n", "f:12.2"]}]).encode('utf-8')
+      return response
+    monkeypatch.setattr(requests, 'get', get)
+    responses = word.go_fetch(query)
+    # datamuse was asked for everything the filters need, and nothing it wouldn't understand
+    assert seen == [{"rel_rhy": "norse", "max": "1000", "md": "fps"}]
+    entries = json.loads(responses[0].content)
+    assert [entry["word"] for entry in entries] == ["course", "horse"]
+    # we asked for the frequency, so it doesn't get printed
+    assert entries[0]["tags"] == ["n"]
+
+  def test_no_results_should_give_a_local_fortune_cookie(self,monkeypatch,capsys,tmp_path):
+    from word_fortune import Fortunes, HEADER
+    (tmp_path / 'cookies').write_bytes(b"Don't Panic.\n%\n")
+    (tmp_path / 'cookies.dat').write_bytes(HEADER.pack(2, 1, 12, 12, 0, b"%") + bytes([0,0,0,0, 0,0,0,15]))
+    monkeypatch.setattr(word, 'fortunes', Fortunes.from_dirs([str(tmp_path)]))
+    # no other programs, and no internet
+    def nope(*args, **kwargs): raise AssertionError("shouldn't be needed")
+    monkeypatch.setattr(subprocess, 'run', nope)
+    monkeypatch.setattr(requests.Session, 'get', nope)
+    response = TestWord.mockget_ok('https://api.datamuse.com/words')
+    response._content = b'[]'
+    with pytest.raises(SystemExit):
+      word.print_response([response])
+    assert "Don't Panic." in capsys.readouterr().out
+
+  def test_fortune_program_and_website_should_be_time_boxed(self,monkeypatch):
+    from word_fortune import Fortunes
+    # no fortune files on this computer
+    monkeypatch.setattr(word, 'fortunes', Fortunes([]))
+    timeouts = []
+    def run(argv, **kwargs):
+      timeouts.append(kwargs['timeout'])
+      raise subprocess.TimeoutExpired(argv, kwargs['timeout'])
+    def get(session, url, **kwargs):
+      timeouts.append(kwargs['timeout'])
+      raise requests.Timeout()
+    monkeypatch.setattr(subprocess, 'run', run)
+    monkeypatch.setattr(requests.Session, 'get', get)
+    assert word.fortune_cookie() is None
+    assert timeouts == [word.FORTUNE_TIMEOUT, word.FORTUNE_TIMEOUT]